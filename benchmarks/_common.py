@@ -0,0 +1,54 @@
+"""
+Shared helpers for the sniftran benchmarks.
+
+The benchmarks generate synthetic sniffer captures by repeating the packets of
+one of the sample files until the requested size is reached.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+SAMPLES_DIR = ROOT_DIR / "tests" / "samples"
+
+# make "fastapi_app" importable when the benchmark is run as a script
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+
+def make_capture(directory: Path, size_mb: float, sample: str = "test3.txt") -> Path:
+    """Create (or reuse) a synthetic capture of roughly size_mb megabytes."""
+    path = Path(directory) / f"sniftran-bench-{sample}-{size_mb:g}MB.txt"
+    target = int(size_mb * 1024 * 1024)
+    if path.exists() and path.stat().st_size >= target:
+        return path
+
+    lines = (SAMPLES_DIR / sample).read_bytes().splitlines(keepends=True)
+    # start with the first packet header, so the repeated block is a sequence of whole packets
+    first = next(i for i, line in enumerate(lines) if line.startswith(b"0x0000")) - 1
+    chunk = b"".join(lines[first:])
+
+    with open(path, "wb") as f:
+        written = 0
+        while written < target:
+            f.write(chunk)
+            written += len(chunk)
+    return path
+
+
+def timed(function, *args, **kwargs):
+    """Run function and return (its result, elapsed seconds)."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def parse_sizes(value: str):
+    """Parse a comma separated list of sizes in megabytes."""
+    return [float(size) for size in value.split(",") if size]
+
+
+def default_directory() -> str:
+    """Directory where the synthetic captures are created."""
+    return os.environ.get("SNIFTRAN_BENCH_DIR", "/tmp")
@@ -0,0 +1,63 @@
+"""
+Benchmark: text-mode DataSource_File vs memory-mapped DataSource_MMap, and
+DataSource_Compressed streaming a gzip copy of the same capture.
+
+Measures lines per second for plain line reading and for the full packet
+line parsing (PacketParser.readPacketLine) on synthetic captures.
+
+Run with: python benchmarks/bench_datasource.py --sizes 100,1024
+"""
+import argparse
+import gzip
+import shutil
+from pathlib import Path
+
+from _common import default_directory, make_capture, parse_sizes, timed
+from fastapi_app.sniftran import DataSource_Compressed, DataSource_File, DataSource_MMap, PacketParser
+
+
+def make_gzip(path: Path) -> Path:
+    """Create (or reuse) a gzip compressed copy of the capture."""
+    compressed = Path(str(path) + ".gz")
+    if not compressed.exists():
+        with open(path, "rb") as source, gzip.open(compressed, "wb", compresslevel=6) as target:
+            shutil.copyfileobj(source, target)
+    return compressed
+
+
+def read_lines(datasource_class, path) -> int:
+    ds = datasource_class(str(path))
+    lines = 0
+    while ds.readline():
+        lines += 1
+    ds.close()
+    return lines
+
+
+def parse_lines(datasource_class, path) -> int:
+    ds = datasource_class(str(path))
+    pp = PacketParser(datasource=ds)
+    while pp.readPacketLine() is not None:
+        pass
+    ds.close()
+    return pp.debug_linesRead
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("100,1024"), help="capture sizes in MB")
+    parser.add_argument("--dir", default=default_directory(), help="where to create the synthetic captures")
+    args = parser.parse_args()
+
+    print("%-8s %-10s %-22s %14s %14s" % ("size", "stage", "source", "lines", "lines/sec"))
+    for size in args.sizes:
+        path = make_capture(args.dir, size)
+        sources = ((DataSource_File, path), (DataSource_MMap, path), (DataSource_Compressed, make_gzip(path)))
+        for stage, function in (("readline", read_lines), ("parse", parse_lines)):
+            for datasource_class, source_path in sources:
+                lines, elapsed = timed(function, datasource_class, source_path)
+                print("%-8s %-10s %-22s %14i %14.0f" % ("%gMB" % size, stage, datasource_class.__name__, lines, lines / elapsed))
+
+
+if __name__ == "__main__":
+    main()
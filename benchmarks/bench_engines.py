@@ -0,0 +1,43 @@
+"""
+Benchmark: hex decoding engines of the PacketParser.
+
+Assembles all packets of a synthetic capture with the scalar engine (one
+bytes.fromhex call per line) and with the batch engines, which decode the
+hex data of many packets at once with a single bytes.fromhex or NumPy call.
+The "numpy" engine is reported as the batch engine when NumPy is not installed.
+
+Run with: python benchmarks/bench_engines.py --sizes 100
+"""
+import argparse
+
+from _common import default_directory, make_capture, parse_sizes, timed
+from fastapi_app.sniftran import DataSource_MMap, PacketParser, PacketAssembler
+
+
+def assemble(path, engine: str):
+    ds = DataSource_MMap(str(path))
+    pp = PacketParser(datasource=ds, engine=engine)
+    pc = PacketAssembler(packetparser=pp)
+    packets = 0
+    for _ in pc.iterPackets():
+        packets += 1
+    ds.close()
+    return packets, pp.engine
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("100"), help="capture sizes in MB")
+    parser.add_argument("--dir", default=default_directory(), help="where to create the synthetic captures")
+    args = parser.parse_args()
+
+    print("%-8s %-8s %-8s %12s %14s" % ("size", "engine", "used", "packets", "packets/sec"))
+    for size in args.sizes:
+        path = make_capture(args.dir, size)
+        for engine in ("scalar", "batch", "numpy"):
+            (packets, used), elapsed = timed(assemble, path, engine)
+            print("%-8s %-8s %-8s %12i %14.0f" % ("%gMB" % size, engine, used, packets, packets / elapsed))
+
+
+if __name__ == "__main__":
+    main()
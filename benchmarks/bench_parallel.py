@@ -0,0 +1,56 @@
+"""
+Benchmark: scaling of the sharded multi-process parser.
+
+Converts a synthetic capture with 1, 2, 4 and 8 worker processes and reports
+the packets per second and the speedup against the serial (1 job) run, which
+does not use the process pool at all.
+
+Run with: python benchmarks/bench_parallel.py --sizes 100 --jobs 1,2,4,8
+"""
+import argparse
+import io
+import os
+
+from _common import default_directory, make_capture, parse_sizes, timed
+from fastapi_app.sniftran import PacketFormatter, PcapNGWriter, iter_formatted_parallel, iter_packets
+
+
+def convert(path, jobs: int) -> int:
+    formatter = PacketFormatter()
+    if jobs > 1:
+        formatted = iter_formatted_parallel(str(path), jobs, formatter)
+    else:
+        formatted = formatter.iterFormatted(iter_packets(str(path)))
+
+    pcap = PcapNGWriter(outfile=io.BytesIO())
+    packets = 0
+    for (iface, linktype, block) in formatted:
+        if block is not None:
+            pcap.writeEnhancedPacket(block, iface=iface, linktype=linktype)
+        packets += 1
+    pcap.close()
+    return packets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("100"), help="capture sizes in MB")
+    parser.add_argument("--jobs", default="1,2,4,8", help="comma separated worker counts")
+    parser.add_argument("--dir", default=default_directory(), help="where to create the synthetic captures")
+    args = parser.parse_args()
+    jobs_list = [int(jobs) for jobs in args.jobs.split(",") if jobs]
+
+    print("cpus available: %i" % (os.cpu_count() or 1,))
+    print("%-8s %6s %12s %14s %10s" % ("size", "jobs", "packets", "packets/sec", "speedup"))
+    for size in args.sizes:
+        path = make_capture(args.dir, size)
+        baseline = None
+        for jobs in jobs_list:
+            packets, elapsed = timed(convert, path, jobs)
+            if baseline is None:
+                baseline = elapsed
+            print("%-8s %6i %12i %14.0f %9.2fx" % ("%gMB" % size, jobs, packets, packets / elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
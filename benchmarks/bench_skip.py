@@ -0,0 +1,52 @@
+"""
+Benchmark: --skip/--limit applied by the consumer vs pushed down into the parser.
+
+Takes a window of --limit packets from the middle and from the end of the
+capture (and the first ones) in two ways:
+- slicing the formatted packets, so every skipped packet is still decoded,
+  assembled and formatted (as the command line did before),
+- passing skip and limit to iter_packets, the skipped packets are only scanned
+  for their boundaries and parsing stops right after the last wanted packet.
+
+Run with: python benchmarks/bench_skip.py --sizes 20 --limit 1000
+"""
+import argparse
+import itertools
+
+from _common import default_directory, make_capture, parse_sizes, timed
+from fastapi_app.sniftran import PacketFormatter, iter_packets
+
+
+def sliced(path, skip: int, limit: int) -> int:
+    formatter = PacketFormatter()
+    formatted = formatter.iterFormatted(iter_packets(str(path), reuse_buffer=True))
+    return sum(1 for _ in itertools.islice(formatted, skip, skip + limit))
+
+
+def pushed_down(path, skip: int, limit: int) -> int:
+    formatter = PacketFormatter()
+    formatted = formatter.iterFormatted(iter_packets(str(path), reuse_buffer=True, skip=skip, limit=limit,
+                                                     interface_filter=formatter.accepts))
+    return sum(1 for _ in formatted)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("20"), help="capture sizes in MB")
+    parser.add_argument("--limit", type=int, default=1000, help="amount of packets taken")
+    parser.add_argument("--dir", default=default_directory(), help="where to create the synthetic captures")
+    args = parser.parse_args()
+
+    print("%-8s %10s %-12s %10s %10s %8s" % ("size", "skip", "mode", "packets", "seconds", "speedup"))
+    for size in args.sizes:
+        path = make_capture(args.dir, size)
+        total = sum(1 for _ in iter_packets(str(path)))
+        for skip in (0, total // 2, max(total - args.limit, 0)):
+            count, elapsed_sliced = timed(sliced, path, skip, args.limit)
+            print("%-8s %10i %-12s %10i %10.3f %8s" % ("%gMB" % size, skip, "sliced", count, elapsed_sliced, ""))
+            count, elapsed = timed(pushed_down, path, skip, args.limit)
+            print("%-8s %10i %-12s %10i %10.3f %7.1fx" % ("%gMB" % size, skip, "pushed down", count, elapsed, elapsed_sliced / elapsed))
+
+
+if __name__ == "__main__":
+    main()
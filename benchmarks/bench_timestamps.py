@@ -0,0 +1,50 @@
+"""
+Benchmark: header line parsing (timestamps, interface and direction).
+
+Measures header lines per second of PacketParser.parseHeaderLine for
+absolute timestamps in the local timezone and in UTC, and for relative
+timestamps. Consecutive lines advance by 100 microseconds, so thousands of
+them share the same second as in real captures.
+
+Run with: python benchmarks/bench_timestamps.py --lines 1000000
+"""
+import argparse
+import datetime
+
+from _common import timed
+from fastapi_app.sniftran import DataSource_Bytes, PacketParser
+
+
+def absolute_lines(count: int):
+    start = datetime.datetime(2024, 3, 1, 12, 0, 0)
+    return [(start + datetime.timedelta(microseconds=100 * i)).strftime("%Y-%m-%d %H:%M:%S.%f")
+            + " port1 in 10.0.0.1.443 -> 10.0.0.2.51234: psh 1 ack 1" for i in range(count)]
+
+
+def relative_lines(count: int):
+    return ["%i.%06i port1 in 10.0.0.1.443 -> 10.0.0.2.51234: psh 1 ack 1" % divmod(100 * i, 1000000) for i in range(count)]
+
+
+def parse_headers(lines, timezone) -> int:
+    pp = PacketParser(datasource=DataSource_Bytes(b""), timezone=timezone)
+    for line in lines:
+        pp.parseHeaderLine(line)
+    return len(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1000000, help="amount of header lines to parse")
+    args = parser.parse_args()
+
+    print("%-20s %12s %16s" % ("timestamps", "lines", "lines/sec"))
+    absolute = absolute_lines(args.lines)
+    for name, lines, timezone in (("absolute, local", absolute, None),
+                                  ("absolute, utc", absolute, datetime.timezone.utc),
+                                  ("relative", relative_lines(args.lines), None)):
+        count, elapsed = timed(parse_headers, lines, timezone)
+        print("%-20s %12i %16.0f" % (name, count, count / elapsed))
+
+
+if __name__ == "__main__":
+    main()
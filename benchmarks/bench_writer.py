@@ -0,0 +1,129 @@
+"""
+Benchmark: Enhanced Packet Block encoding, in EPBs per second.
+
+The packets of a sample capture are assembled once and then encoded over and
+over again by:
+- the previous encoder, one struct.pack call per field and byte-wise padding
+  (kept here only as the baseline),
+- blockEnhancedPacket, precompiled structs packed into one new bytearray,
+- writePacket, precompiled structs packed into the reused buffer of the writer.
+
+Then whole sections of growing size are written by writePackets to /dev/null,
+showing the peak of memory traced while writing (the encoded blocks themselves
+are prepared before tracing starts).
+
+Run with: python benchmarks/bench_writer.py --packets 200000
+"""
+import argparse
+import io
+import os
+import struct
+import tracemalloc
+
+from _common import SAMPLES_DIR, timed
+from fastapi_app.sniftran import PcapNGBlocks, PcapNGWriter, iter_packets
+
+
+def legacy_option(code: int, value: str) -> bytes:
+    valuePad = 0
+    if len(value) % 4 > 0:
+        valuePad = 4-(len(value) % 4)
+    block = struct.pack(">H", code)
+    block += struct.pack(">H", len(value))
+    block += str.encode(value)
+    for i in range(valuePad):
+        block += struct.pack(">b", 0)
+    return block
+
+
+def legacy_enhanced_packet(packet: bytes, timestamp: int, ifaceIndex: int, comment: str) -> bytearray:
+    options = legacy_option(1, comment)
+    options += struct.pack(">H", 0) + struct.pack(">H", 0)
+    packetPad = 0
+    if (len(packet) % 4) > 0:
+        packetPad = 4-(len(packet) % 4)
+    block = bytearray(struct.pack(">I", 0x00000006))
+    block += struct.pack(">I", 32+len(packet)+packetPad+len(options))
+    block += struct.pack(">I", ifaceIndex)
+    block += struct.pack(">Q", timestamp)
+    block += struct.pack(">I", len(packet))
+    block += struct.pack(">I", len(packet))
+    block += packet
+    for i in range(packetPad):
+        block += struct.pack(">b", 0)
+    block += options
+    block += struct.pack(">I", 32+len(packet)+packetPad+len(options))
+    return block
+
+
+def encode_legacy(packets, count: int) -> int:
+    size = 0
+    for i in range(count):
+        (data, ts, comment) = packets[i % len(packets)]
+        size += len(legacy_enhanced_packet(data, ts, 0, comment))
+    return size
+
+
+def encode_blocks(packets, count: int) -> int:
+    blocks = PcapNGBlocks()
+    size = 0
+    for i in range(count):
+        (data, ts, comment) = packets[i % len(packets)]
+        size += len(blocks.blockEnhancedPacket(data, timestamp=ts, ifaceIndex=0, comment=comment))
+    return size
+
+
+def encode_into_buffer(packets, count: int) -> int:
+    output = io.BytesIO()
+    pcap = PcapNGWriter(outfile=output)
+    size = 0
+    for i in range(count):
+        (data, ts, comment) = packets[i % len(packets)]
+        pcap.writePacket(data, timestamp=ts, iface="port1", comment=comment)
+        # do not let the in-memory output dominate the measurement
+        if i % 1000 == 999:
+            size += output.tell()
+            output.seek(0)
+            output.truncate()
+    return size + output.tell()
+
+
+def write_section(blockIfaces: bytes, blockPackets) -> int:
+    tracemalloc.start()
+    pcap = PcapNGWriter(outfile=os.devnull)
+    pcap.writePackets(blockIfaces, blockPackets)
+    pcap.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packets", type=int, default=200000, help="amount of EPBs to encode")
+    parser.add_argument("--sample", default="test3.txt", help="sample capture providing the packets")
+    parser.add_argument("--sections", default="10000,100000", help="comma separated amounts of packets in the written sections")
+    args = parser.parse_args()
+
+    packets = [(bytes(packet.data), packet.ts_us, packet.comment()) for packet in iter_packets(SAMPLES_DIR / args.sample)]
+
+    print("%-22s %10s %12s %10s" % ("encoder", "EPBs", "EPBs/sec", "MB/sec"))
+    for name, encode in (("struct per field", encode_legacy), ("precompiled struct", encode_blocks),
+                         ("into reused buffer", encode_into_buffer)):
+        size, elapsed = timed(encode, packets, args.packets)
+        print("%-22s %10i %12.0f %10.1f" % (name, args.packets, args.packets / elapsed, size / elapsed / 1024 / 1024))
+
+    print()
+    print("%-22s %10s %12s %10s" % ("writePackets", "EPBs", "section MB", "peak KiB"))
+    blocks = PcapNGBlocks()
+    blockIfaces = blocks.blockInterfaceDescription("port1", PcapNGBlocks.LINKTYPE_ETHERNET)
+    for count in [int(value) for value in args.sections.split(",") if value]:
+        section_packets = (packets[i % len(packets)] for i in range(count))
+        blockPackets = [blocks.blockEnhancedPacket(data, timestamp=ts, ifaceIndex=0, comment=comment) for (data, ts, comment) in section_packets]
+        section = sum(len(block) for block in blockPackets)
+        peak = write_section(blockIfaces, blockPackets)
+        print("%-22s %10i %12.1f %10.1f" % ("", count, section / 1024 / 1024, peak / 1024))
+
+
+if __name__ == "__main__":
+    main()
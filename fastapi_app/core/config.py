@@ -13,8 +13,18 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./database.db")
     DATABASE_KEY: Optional[str] = os.getenv("DATABASE_KEY", None)
+    # directory of the uploaded and converted files, encrypted with DATABASE_KEY like the database
+    BLOB_DIR: str = os.getenv("BLOB_DIR", "./blobs")
     DEBUG: bool = os.getenv("DEBUG", "false").lower() == "true"
     ENVIRONMENT: str = os.getenv("ENVIRONMENT", "development")
+    # worker processes converting the uploaded files, 0 runs the conversions in threads of the server process
+    CONVERSION_WORKERS: int = int(os.getenv("CONVERSION_WORKERS", "2"))
+    # the jobs are converted only by the "python -m fastapi_app.worker" processes, not by the server
+    EXTERNAL_WORKERS: bool = os.getenv("EXTERNAL_WORKERS", "false").lower() == "true"
+    # how long a worker owns a job without renewing its lease
+    JOB_LEASE_SECONDS: int = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+    # converted files kept for identical uploads converted with the same options, 0 disables the cache
+    CONVERSION_CACHE_MB: int = int(os.getenv("CONVERSION_CACHE_MB", "256"))
 
     @field_validator("SECRET_KEY", mode="before")
     @classmethod
@@ -1,12 +1,15 @@
+from typing import List
 from sqlmodel import SQLModel, create_engine, Session
-from sqlalchemy import event
+from sqlalchemy import Column, event, inspect, text
+from sqlalchemy.schema import CreateColumn
 from .config import settings
 
 # Only echo SQL in debug mode to prevent information disclosure
 engine = create_engine(
     settings.DATABASE_URL,
     echo=settings.DEBUG,
-    connect_args={"check_same_thread": False}
+    # the server and the worker processes share the database, wait for each other's writes
+    connect_args={"check_same_thread": False, "timeout": 30}
 )
 
 # SQLCipher encryption: set the encryption key on every connection
@@ -17,7 +20,48 @@ if settings.DATABASE_KEY:
         cursor.execute(f"PRAGMA key = '{settings.DATABASE_KEY}'")
         cursor.close()
 
+def missing_columns(bind) -> List[Column]:
+    '''Returns the columns of the models missing in the existing tables, of a database created by an older version'''
+    inspector = inspect(bind)
+    missing = []
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing)
+    return missing
+
+def add_missing_columns(bind) -> List[str]:
+    '''Adds the columns (and their indexes) missing in a database created by an older version, returns their names
+
+    The rows already there get NULL, or the server default of the required columns. A required column
+    without a server default cannot be added, RuntimeError is raised before anything is changed then.
+    '''
+    missing = missing_columns(bind)
+    required = [f"{column.table.name}.{column.name}" for column in missing if not column.nullable and column.server_default is None]
+    if required:
+        raise RuntimeError(f"Cannot add the required columns {', '.join(required)} without a server default")
+    with bind.begin() as connection:
+        for column in missing:
+            connection.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN {CreateColumn(column).compile(dialect=bind.dialect)}"))
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                if any(column in missing for column in index.columns):
+                    index.create(connection, checkfirst=True)
+    return [f"{column.table.name}.{column.name}" for column in missing]
+
+def files_in_database(bind) -> bool:
+    '''Checks whether the files are still stored in the conversion table, as by the versions before the blob store'''
+    inspector = inspect(bind)
+    return inspector.has_table("conversion") and "data" in {column["name"] for column in inspector.get_columns("conversion")}
+
 def create_db_and_tables():
+    if files_in_database(engine):
+        raise RuntimeError("The files are stored in the database, move them to the blob store with: python -m fastapi_app.migrate")
+    missing = missing_columns(engine)
+    if missing:
+        names = ", ".join(f"{column.table.name}.{column.name}" for column in missing)
+        raise RuntimeError(f"The database lacks the columns {names}, upgrade it with: python -m fastapi_app.migrate")
     SQLModel.metadata.create_all(engine)
 
 def get_session():
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
@@ -9,6 +10,9 @@ from slowapi.errors import RateLimitExceeded
 from .core.config import settings
 from .core.database import create_db_and_tables
 from .routers import auth, conversion, frontend
+from .services.cache import ConversionCache
+from .services.jobs import JobQueue
+from .services.pool import ConversionPool
 
 BASE_DIR = Path(__file__).resolve().parent
 FRONTEND_DIR = BASE_DIR.parent / "frontend" / "dist"
@@ -42,6 +46,26 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
         return response
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    create_db_and_tables()
+    # conversions are CPU bound, they run in worker processes instead of blocking the event loop,
+    # or only in the separate "python -m fastapi_app.worker" processes
+    pool_workers = 0 if settings.EXTERNAL_WORKERS else settings.CONVERSION_WORKERS
+    app.state.conversion_pool = ConversionPool(workers=pool_workers)
+    app.state.conversion_pool.start()
+    # the requests only queue the conversions, these workers wait for them
+    job_workers = 0 if settings.EXTERNAL_WORKERS else max(settings.CONVERSION_WORKERS, 1)
+    # repeated conversions of the same files are copied from the cache
+    app.state.conversion_cache = ConversionCache(max_bytes=settings.CONVERSION_CACHE_MB * 1024 * 1024)
+    app.state.job_queue = JobQueue(app.state.conversion_pool, workers=job_workers, lease_seconds=settings.JOB_LEASE_SECONDS,
+                                   cache=app.state.conversion_cache)
+    app.state.job_queue.start()
+    yield
+    await app.state.job_queue.shutdown()
+    app.state.conversion_pool.shutdown()
+
+
 # Disable OpenAPI docs in production
 docs_url = "/docs" if settings.DEBUG or settings.ENVIRONMENT != "production" else None
 redoc_url = "/redoc" if settings.DEBUG or settings.ENVIRONMENT != "production" else None
@@ -82,6 +106,7 @@ Include the token in the `Authorization` header: `Bearer <your-token>`
     docs_url=docs_url,
     redoc_url=redoc_url,
     openapi_url=openapi_url,
+    lifespan=lifespan,
 )
 
 # Add security headers middleware
@@ -100,10 +125,6 @@ app.add_middleware(
 app.state.limiter = auth.limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-@app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
-
 # Always include API routes
 app.include_router(auth.router, tags=["auth"])
 app.include_router(conversion.router, tags=["conversion"])
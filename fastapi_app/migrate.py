@@ -0,0 +1,157 @@
+"""
+Upgrades a database created by an older version: adds the new columns, moves the uploaded
+and converted files stored in the database to the blob store, and computes the digests of the
+uploads stored without one.
+
+Stop the server and the workers first, they do not start on a database which is not upgraded. The migration can be interrupted and run again, it goes on
+with the tasks not moved yet. The database file is compacted at the end.
+
+Run with: python -m fastapi_app.migrate
+"""
+import argparse
+import logging
+from typing import Optional
+
+from sqlalchemy import MetaData, Table, delete, func, inspect, select, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, SQLModel
+
+from .core.database import add_missing_columns, engine as default_engine
+from .models.blob import Blob
+from .models.conversion import Conversion, ConversionCacheEntry
+from .models.user import User
+from .services.blobs import BlobStore, add_blob, get_blob_store
+from .services.cache import data_digest
+
+logger = logging.getLogger("migrate")
+
+# the new conversion table while the tasks are moved to it, renamed to conversion at the end
+MIGRATED_TABLE = "conversion_new"
+
+
+def migrate_blobs(engine: Engine, store: Optional[BlobStore] = None) -> int:
+    '''Moves the files out of the conversion table to the blob store, returns how many tasks were moved'''
+    store = store or get_blob_store()
+    inspector = inspect(engine)
+    columns = {column["name"] for column in inspector.get_columns("conversion")} if inspector.has_table("conversion") else set()
+    cache_columns = ({column["name"] for column in inspector.get_columns("conversioncacheentry")}
+                     if inspector.has_table("conversioncacheentry") else set())
+
+    if "data_converted" in cache_columns:
+        # only a cache, refilled by the next conversions
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DROP TABLE conversioncacheentry")
+    SQLModel.metadata.create_all(engine)
+
+    moved = 0
+    if "data" in columns:
+        moved = move_conversions(engine, store)
+    added = add_missing_columns(engine)
+    if added:
+        logger.info(f"Added the columns {', '.join(added)}")
+    hashed = fill_data_hashes(engine, store)
+    if hashed:
+        logger.info(f"Computed the digests of {hashed} uploaded files")
+    recount_blobs(engine, store)
+
+    if moved:
+        # give the space of the moved files back to the file system
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("VACUUM")
+    return moved
+
+
+def move_conversions(engine: Engine, store: BlobStore) -> int:
+    '''Copies the tasks to a new conversion table with their files in the blob store, then replaces the old table'''
+    metadata = MetaData()
+    # the new table references the users like the old one, its indexes are created after the old one is dropped
+    User.__table__.to_metadata(metadata)
+    migrated = Conversion.__table__.to_metadata(metadata, name=MIGRATED_TABLE)
+    migrated.indexes.clear()
+    migrated.create(engine, checkfirst=True)
+    old = Table("conversion", MetaData(), autoload_with=engine)
+
+    moved = 0
+    with Session(engine) as session:
+        ids = session.exec(
+            select(old.c.id).where(old.c.id.not_in(select(migrated.c.id))).order_by(old.c.id)
+        ).scalars().all()
+        for id in ids:
+            # one task at a time, the files can be large
+            row = session.exec(select(old).where(old.c.id == id)).mappings().one()
+            (data_key, data_size) = add_blob(session, row["data"], store)
+            (converted_key, converted_size) = (None, None)
+            if row["data_converted"] is not None:
+                (converted_key, converted_size) = add_blob(session, row["data_converted"], store)
+            session.exec(migrated.insert().values(
+                id=row["id"], content=row["content"], data_key=data_key, data_size=data_size,
+                date_created=row["date_created"], converted_key=converted_key, converted_size=converted_size,
+                data_hash=row.get("data_hash") or data_digest(row["data"]), options_hash=row.get("options_hash"),
+                user_id=row["user_id"],
+            ))
+            session.commit()
+            moved += 1
+            logger.info(f"Moved the files of conversion task {id} ({data_size + (converted_size or 0)} bytes)")
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE conversion")
+        connection.exec_driver_sql(f"ALTER TABLE {MIGRATED_TABLE} RENAME TO conversion")
+        for index in Conversion.__table__.indexes:
+            index.create(connection, checkfirst=True)
+    return moved
+
+
+def fill_data_hashes(engine: Engine, store: BlobStore) -> int:
+    '''Sets the digests of the uploads stored before they were computed, returns how many were set
+
+    The server only looks up the conversion cache for uploads with a digest, it does not read them to compute it.
+    '''
+    filled = 0
+    with Session(engine) as session:
+        ids = session.exec(select(Conversion.id).where(Conversion.data_hash.is_(None)).order_by(Conversion.id)).scalars().all()
+        for id in ids:
+            conversion = session.get(Conversion, id)
+            conversion.data_hash = data_digest(store.read(conversion.data_key))
+            session.add(conversion)
+            session.commit()
+            filled += 1
+    return filled
+
+
+def recount_blobs(engine: Engine, store: BlobStore) -> int:
+    '''Sets the reference counts of the blobs from the rows referencing them, deletes the unreferenced ones
+
+    Repairs the counts left too high by an interrupted migration, returns how many blobs were deleted.
+    '''
+    references = {}
+    with Session(engine) as session:
+        for column in (Conversion.data_key, Conversion.converted_key, ConversionCacheEntry.converted_key):
+            for (key, count) in session.exec(select(column, func.count()).where(column.is_not(None)).group_by(column)):
+                references[key] = references.get(key, 0) + count
+
+        unreferenced = []
+        for (key, refs) in session.exec(select(Blob.key, Blob.refs)).all():
+            if key not in references:
+                unreferenced.append(key)
+            elif refs != references[key]:
+                session.exec(update(Blob).where(Blob.key == key).values(refs=references[key]))
+        for key in unreferenced:
+            session.exec(delete(Blob).where(Blob.key == key))
+            store.delete(key)
+        session.commit()
+    if unreferenced:
+        logger.info(f"Deleted {len(unreferenced)} unreferenced blobs")
+    return len(unreferenced)
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Upgrades the database of an older version, moving its files to the blob store.")
+    parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    moved = migrate_blobs(default_engine)
+    print(f"Moved the files of {moved} conversion tasks to the blob store")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+from datetime import datetime
+from sqlmodel import SQLModel, Field
+
+class Blob(SQLModel, table=True):
+    key: str = Field(primary_key=True)  # address of the file in the blob store
+    size: int
+    # rows referencing the file (uploads, converted files, cache entries), it is deleted with the last one
+    refs: int = 0
+    date_created: datetime = Field(default_factory=datetime.utcnow)
@@ -1,14 +1,62 @@
 from typing import Optional
 from datetime import datetime
+from sqlalchemy import UniqueConstraint
 from sqlmodel import SQLModel, Field, Relationship
 from .user import User
 
+# states of a conversion job, in the order they are passed
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
 class Conversion(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str  # Filename
-    data: bytes
+    # the uploaded and converted files are in the blob store, by their keys
+    data_key: str
+    data_size: int
     date_created: datetime = Field(default_factory=datetime.utcnow)
-    data_converted: Optional[bytes] = None
+    converted_key: Optional[str] = None
+    converted_size: Optional[int] = None
+    # SHA-256 of the uploaded file, and of the options it was converted with (keys of the conversion cache)
+    data_hash: Optional[str] = Field(default=None, index=True)
+    options_hash: Optional[str] = None
+    # rows of the Wireshark esp_sa file of the IPSec tunnels found by the conversion, which decrypt its ESP packets
+    esp_sa: Optional[str] = None
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     
     user: Optional[User] = Relationship(back_populates="conversions")
+
+class ConversionJob(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    conversion_id: int = Field(foreign_key="conversion.id", index=True)
+    user_id: int = Field(foreign_key="user.id")
+    status: str = Field(default=JOB_QUEUED, index=True)
+    options: str = "{}"  # JSON with the keyword arguments of Convert2Pcap.run_conversion
+    date_created: datetime = Field(default_factory=datetime.utcnow)
+    date_started: Optional[datetime] = None
+    date_finished: Optional[datetime] = None
+    packets: Optional[int] = None
+    error: Optional[str] = None
+    # the worker converting the job holds a lease, renewed by its heartbeat;
+    # jobs with an expired lease (e.g. of a crashed worker) are claimed again
+    worker: Optional[str] = None
+    lease_expires: Optional[datetime] = None
+    # added to older databases by the migration, hence the server default
+    attempts: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+
+class ConversionCacheEntry(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("data_hash", "options_hash"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    data_hash: str = Field(index=True)
+    options_hash: str
+    converted_key: str
+    packets: int
+    esp_sa: Optional[str] = None
+    size: int  # bytes of the converted file, the cache is bounded by their total
+    date_created: datetime = Field(default_factory=datetime.utcnow)
+    date_used: datetime = Field(default_factory=datetime.utcnow, index=True)  # the least recently used are evicted
+    hits: int = 0
@@ -1,15 +1,21 @@
+import io
 import os
-from typing import List
+import zipfile
+from typing import List, Literal, Optional
 from urllib.parse import quote
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, status
+from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File, status
 from fastapi.responses import FileResponse, Response
 from sqlmodel import Session, select
 from ..core.database import get_session
-from ..core.logging import log_conversion_error
 from ..models.user import User
-from ..models.conversion import Conversion
-from ..schemas.conversion import ConversionRead, ConversionRename
-from ..services.converter import Convert2Pcap
+from ..models.conversion import Conversion, ConversionJob
+from ..schemas.conversion import ConversionJobRead, ConversionRead, ConversionRename
+from ..services.blobs import add_blob, read_blob, release_blobs
+from ..services.cache import data_digest
+from ..services.converter import converted_file_type
+from ..services.jobs import JobQueue, get_job_queue, latest_jobs
+from ..sniftran import PacketFilter
+from ..sniftran.compression import compression_available
 from ..core.security import settings
 from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer
@@ -137,7 +143,9 @@ async def upload_files(
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
 
-        conversion = Conversion(content=filename, data=content, user_id=current_user.id)
+        (data_key, data_size) = add_blob(session, content)
+        conversion = Conversion(content=filename, data_key=data_key, data_size=data_size,
+                                data_hash=data_digest(content), user_id=current_user.id)
         session.add(conversion)
         session.commit()
         session.refresh(conversion)
@@ -148,7 +156,7 @@ async def upload_files(
             id=conversion.id,
             date_created=conversion.date_created,
             user_id=conversion.user_id,
-            has_converted_data=conversion.data_converted is not None
+            has_converted_data=conversion.converted_key is not None
         ))
     return results
 
@@ -170,68 +178,120 @@ async def list_conversions(current_user: User = Depends(get_current_user), sessi
     """
     statement = select(Conversion).where(Conversion.user_id == current_user.id)
     conversions = session.exec(statement).all()
+    jobs = latest_jobs(session, [c.id for c in conversions])
     return [
         ConversionRead(
             content=c.content,
             id=c.id,
             date_created=c.date_created,
             user_id=c.user_id,
-            has_converted_data=c.data_converted is not None
+            has_converted_data=c.converted_key is not None,
+            job_id=jobs[c.id].id if c.id in jobs else None,
+            job_status=jobs[c.id].status if c.id in jobs else None
         ) for c in conversions
     ]
 
 @router.post(
     "/convert/{id}",
     summary="Convert sniffer file to PCAP",
-    description="Convert a previously uploaded FortiGate sniffer file to PCAPNG format. The converted file can then be downloaded.",
+    description="Queue the conversion of a previously uploaded FortiGate sniffer file to PCAPNG (default) or legacy PCAP format, optionally compressed and limited to some interfaces or to packets matching a filter expression. Poll /jobs/{job_id} until it is done, the converted file can then be downloaded.",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=ConversionJobRead,
     responses={
-        200: {"description": "Conversion successful, returns packet count"},
+        202: {"description": "Conversion queued, returns the job"},
+        400: {"description": "Compression not available or invalid filter expression"},
         401: {"description": "Not authenticated"},
         404: {"description": "Conversion task not found"},
-        500: {"description": "Conversion failed"},
     },
 )
 async def convert_file(
     id: int,
+    response: Response,
+    output_format: Literal["pcapng", "pcap"] = Query(
+        "pcapng", alias="format",
+        description="pcapng, or pcap for libpcap with nanosecond timestamps (no comments and no embedded IPSec secrets)",
+    ),
+    compression: Literal["none", "gzip", "zstd"] = Query(
+        "none",
+        description="Compress the converted file while it is written, it is stored and downloaded compressed",
+    ),
+    include: List[str] = Query(
+        [],
+        description="Keep only packets from/to these interfaces (repeat the parameter for more interfaces)",
+    ),
+    exclude: List[str] = Query(
+        [],
+        description="Drop packets from/to these interfaces (repeat the parameter for more interfaces)",
+    ),
+    packet_filter: Optional[str] = Query(
+        None, alias="filter",
+        description="Keep only packets matching this expression, e.g. \"tcp port 443 and not host 10.0.0.1\" "
+                    "(host, net, port, proto, tcp, udp, icmp, ip, ip6, arp, src/dst, and/or/not)",
+    ),
     current_user: User = Depends(get_current_user),
     session: Session = Depends(get_session),
+    jobs: JobQueue = Depends(get_job_queue),
 ):
     """
-    Convert a sniffer file to PCAPNG format.
+    Queue the conversion of a sniffer file to PCAPNG or PCAP format.
 
     - **id**: The conversion task ID returned from upload
+    - **format**: Output format, pcapng (default) or pcap
+    - **compression**: none (default), gzip or zstd
+    - **include**: Interfaces to keep, all of them by default
+    - **exclude**: Interfaces to drop
+    - **filter**: Packet filter expression, a subset of the tcpdump syntax
     """
     conversion = session.get(Conversion, id)
     if not conversion or conversion.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
-    try:
-        pcap_path, packets = Convert2Pcap.run_conversion(
-            tid=conversion.id,
-            cid=current_user.id,
-            tuid=conversion.user_id,
-            fname=conversion.content,
-            file_to_convert=conversion.data
-        )
-
-        with open(pcap_path, "rb") as f:
-            conversion.data_converted = f.read()
+    output_compression = None if compression == "none" else compression
+    if not compression_available(output_compression):
+        raise HTTPException(status_code=400, detail=f"Compression {compression} is not available")
 
-        session.add(conversion)
-        session.commit()
+    if packet_filter:
+        try:
+            PacketFilter(packet_filter)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+
+    # the conversion runs in a worker process, the client polls the job instead of waiting for it
+    job = jobs.submit(session, conversion, dict(
+        output_format=output_format,
+        compression=output_compression,
+        interfaces_include=include,
+        interfaces_exclude=exclude,
+        packet_filter=packet_filter
+    ))
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return job
 
-        # Cleanup
-        os.remove(pcap_path)
+@router.get(
+    "/jobs/{id}",
+    summary="Get conversion job",
+    description="Get the state of a conversion job: queued, running, done (with the packet count) or failed (with the reason).",
+    response_model=ConversionJobRead,
+    responses={
+        200: {"description": "The job"},
+        401: {"description": "Not authenticated"},
+        404: {"description": "Job not found"},
+    },
+)
+async def get_job(
+    id: int,
+    current_user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """
+    Get the state of a conversion job.
 
-        return {"message": f"Converted {packets} packets to PCAP successfully"}
-    except Exception as e:
-        # Log the error internally with full details
-        log_conversion_error(id, current_user.id, e)
-        # Return generic error message to client
-        raise HTTPException(
-            status_code=500,
-            detail="Conversion failed. Please check your file format and try again."
-        )
+    - **id**: The job ID returned by /convert
+    """
+    job = session.get(ConversionJob, id)
+    if not job or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @router.get(
     "/conversions/{id}/download/original",
@@ -258,7 +318,7 @@ async def download_original(
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
     return Response(
-        content=conversion.data,
+        content=read_blob(conversion.data_key),
         media_type="application/octet-stream",
         headers={"Content-Disposition": get_safe_content_disposition(conversion.content)}
     )
@@ -266,9 +326,10 @@ async def download_original(
 @router.get(
     "/conversions/{id}/download/pcap",
     summary="Download converted PCAP file",
-    description="Download the converted PCAPNG file. The file must be converted first using the /convert endpoint.",
+    description="Download the converted PCAPNG (or PCAP) file, compressed if it was converted with compression. The file must be converted first using the /convert endpoint.",
     responses={
-        200: {"description": "PCAPNG file download", "content": {"application/x-pcapng": {}}},
+        200: {"description": "PCAPNG or PCAP file download", "content": {"application/x-pcapng": {}, "application/vnd.tcpdump.pcap": {},
+                                                                         "application/gzip": {}, "application/zstd": {}}},
         400: {"description": "File not converted yet"},
         401: {"description": "Not authenticated"},
         404: {"description": "Conversion task not found"},
@@ -280,7 +341,7 @@ async def download_pcap(
     session: Session = Depends(get_session),
 ):
     """
-    Download the converted PCAPNG file.
+    Download the converted PCAPNG (or PCAP) file.
 
     - **id**: The conversion task ID
 
@@ -290,13 +351,102 @@ async def download_pcap(
     if not conversion or conversion.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
-    if not conversion.data_converted:
+    if not conversion.converted_key:
+        raise HTTPException(status_code=400, detail="File not converted yet")
+
+    data_converted = read_blob(conversion.converted_key)
+    (extension, media_type) = converted_file_type(data_converted)
+    return Response(
+        content=data_converted,
+        media_type=media_type,
+        headers={"Content-Disposition": get_safe_content_disposition(f"{conversion.content}.{extension}")}
+    )
+
+@router.get(
+    "/conversions/{id}/download/esp_sa",
+    summary="Download Wireshark IPSec SAs",
+    description="Download the IPSec tunnels found in the sniffer file by its conversion as rows of the Wireshark esp_sa file, which decrypt the ESP packets of the converted file.",
+    responses={
+        200: {"description": "Wireshark esp_sa file download", "content": {"text/plain": {}}},
+        400: {"description": "File not converted yet"},
+        401: {"description": "Not authenticated"},
+        404: {"description": "Conversion task not found or no IPSec tunnels in it"},
+    },
+)
+async def download_esp_sa(
+    id: int,
+    current_user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """
+    Download the Wireshark `esp_sa` rows of the IPSec tunnels in the sniffer file.
+
+    - **id**: The conversion task ID
+
+    The rows are collected while the file is converted, it must be converted first using POST /convert/{id}.
+    Append them to the `esp_sa` file in the Wireshark configuration directory
+    (e.g. ~/.config/wireshark/esp_sa) to decrypt the ESP packets.
+    """
+    conversion = session.get(Conversion, id)
+    if not conversion or conversion.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Conversion task not found")
+
+    if not conversion.converted_key:
+        raise HTTPException(status_code=400, detail="File not converted yet")
+
+    if not conversion.esp_sa:
+        raise HTTPException(status_code=404, detail="No IPSec tunnels found")
+
+    return Response(
+        content=conversion.esp_sa,
+        media_type="text/plain",
+        headers={"Content-Disposition": get_safe_content_disposition("esp_sa")}
+    )
+
+@router.get(
+    "/conversions/{id}/download/bundle",
+    summary="Download converted file with its IPSec SAs",
+    description="Download a ZIP archive with the converted file and, if IPSec tunnels were found, the Wireshark esp_sa file decrypting its ESP packets.",
+    responses={
+        200: {"description": "ZIP archive download", "content": {"application/zip": {}}},
+        400: {"description": "File not converted yet"},
+        401: {"description": "Not authenticated"},
+        404: {"description": "Conversion task not found"},
+    },
+)
+async def download_bundle(
+    id: int,
+    current_user: User = Depends(get_current_user),
+    session: Session = Depends(get_session),
+):
+    """
+    Download the converted file together with the Wireshark `esp_sa` rows of its IPSec tunnels.
+
+    - **id**: The conversion task ID
+
+    The archive has the converted file and an `esp_sa` file, the latter only if IPSec tunnels were found.
+    Copy `esp_sa` to the Wireshark configuration directory (or append its rows to the existing one)
+    to decrypt the ESP packets.
+    """
+    conversion = session.get(Conversion, id)
+    if not conversion or conversion.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Conversion task not found")
+
+    if not conversion.converted_key:
         raise HTTPException(status_code=400, detail="File not converted yet")
 
+    data_converted = read_blob(conversion.converted_key)
+    (extension, _) = converted_file_type(data_converted)
+    archive = io.BytesIO()
+    # the packets are stored as they are, compressing them again would only take time
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as bundle:
+        bundle.writestr(f"{conversion.content}.{extension}", data_converted)
+        if conversion.esp_sa:
+            bundle.writestr("esp_sa", conversion.esp_sa)
     return Response(
-        content=conversion.data_converted,
-        media_type="application/x-pcapng",
-        headers={"Content-Disposition": get_safe_content_disposition(f"{conversion.content}.pcapng")}
+        content=archive.getvalue(),
+        media_type="application/zip",
+        headers={"Content-Disposition": get_safe_content_disposition(f"{conversion.content}.zip")}
     )
 
 @router.delete(
@@ -325,8 +475,13 @@ async def delete_conversion(
     if not conversion or conversion.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
+    for job in session.exec(select(ConversionJob).where(ConversionJob.conversion_id == id)).all():
+        session.delete(job)
+    keys = (conversion.data_key, conversion.converted_key)
     session.delete(conversion)
     session.commit()
+    # the files are deleted unless other tasks (or the conversion cache) have the same ones
+    release_blobs(session, *keys)
     return {"message": "Deleted successfully"}
 
 @router.put(
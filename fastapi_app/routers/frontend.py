@@ -7,11 +7,14 @@ from fastapi.templating import Jinja2Templates
 from sqlmodel import Session, select
 from ..core.database import get_session
 from ..core.security import settings, create_access_token, verify_password, get_password_hash
-from ..core.logging import log_conversion_error, log_auth_event
+from ..core.logging import log_auth_event
 from ..models.user import User
-from ..models.conversion import Conversion
-from ..schemas.conversion import ConversionRead
-from ..services.converter import Convert2Pcap
+from ..models.conversion import Conversion, ConversionJob
+from ..schemas.conversion import ConversionJobRead, ConversionRead
+from ..services.blobs import add_blob, read_blob, release_blobs
+from ..services.cache import data_digest
+from ..services.converter import converted_file_type
+from ..services.jobs import JobQueue, get_job_queue, latest_jobs
 from datetime import timedelta
 from jose import jwt, JWTError
 import os
@@ -77,8 +80,9 @@ async def home(request: Request, session: Session = Depends(get_session)):
     
     statement = select(Conversion).where(Conversion.user_id == user.id)
     tasks = session.exec(statement).all()
+    jobs = latest_jobs(session, [task.id for task in tasks])
     
-    return templates.TemplateResponse("convert.html", {"request": request, "user": user, "tasks": tasks})
+    return templates.TemplateResponse("convert.html", {"request": request, "user": user, "tasks": tasks, "jobs": jobs})
 
 @router.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
@@ -189,15 +193,18 @@ async def upload_files(request: Request, session: Session = Depends(get_session)
             filename = sanitize_filename(file.filename)
         except ValueError:
             filename = "uploaded_file"
-        conversion = Conversion(content=filename, data=content, user_id=user.id)
+        (data_key, data_size) = add_blob(session, content)
+        conversion = Conversion(content=filename, data_key=data_key, data_size=data_size,
+                                data_hash=data_digest(content), user_id=user.id)
         session.add(conversion)
     session.commit()
 
     return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
 
-# Convert file (cookie-based auth)
+# Convert file (cookie-based auth), the page shows the job and polls it until the file is converted
 @router.get("/convert/{id}")
-async def convert_file(id: int, request: Request, session: Session = Depends(get_session)):
+async def convert_file(id: int, request: Request, session: Session = Depends(get_session),
+                       jobs: JobQueue = Depends(get_job_queue)):
     user = get_current_user_from_cookie(request, session)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_302_FOUND)
@@ -206,28 +213,7 @@ async def convert_file(id: int, request: Request, session: Session = Depends(get
     if not conversion or conversion.user_id != user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
-    try:
-        pcap_path, packets = Convert2Pcap.run_conversion(
-            tid=conversion.id,
-            cid=user.id,
-            tuid=conversion.user_id,
-            fname=conversion.content,
-            file_to_convert=conversion.data
-        )
-
-        with open(pcap_path, "rb") as f:
-            conversion.data_converted = f.read()
-
-        session.add(conversion)
-        session.commit()
-        os.remove(pcap_path)
-    except Exception as e:
-        log_conversion_error(id, user.id, e)
-        raise HTTPException(
-            status_code=500,
-            detail="Conversion failed. Please check your file format and try again."
-        )
-
+    jobs.submit(session, conversion, {})
     return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
 
 # Download original file
@@ -242,7 +228,7 @@ async def download_original(id: int, request: Request, session: Session = Depend
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
     return Response(
-        content=conversion.data,
+        content=read_blob(conversion.data_key),
         media_type="application/octet-stream",
         headers={"Content-Disposition": get_safe_content_disposition(conversion.content)}
     )
@@ -258,13 +244,15 @@ async def download_pcap(id: int, request: Request, session: Session = Depends(ge
     if not conversion or conversion.user_id != user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
-    if not conversion.data_converted:
+    if not conversion.converted_key:
         raise HTTPException(status_code=400, detail="File not converted yet")
 
+    data_converted = read_blob(conversion.converted_key)
+    (extension, media_type) = converted_file_type(data_converted)
     return Response(
-        content=conversion.data_converted,
-        media_type="application/vnd.tcpdump.pcap",
-        headers={"Content-Disposition": get_safe_content_disposition(f"{conversion.content}.pcap")}
+        content=data_converted,
+        media_type=media_type,
+        headers={"Content-Disposition": get_safe_content_disposition(f"{conversion.content}.{extension}")}
     )
 
 # Delete conversion
@@ -278,8 +266,13 @@ async def delete_conversion(id: int, request: Request, session: Session = Depend
     if not conversion or conversion.user_id != user.id:
         raise HTTPException(status_code=404, detail="Conversion task not found")
 
+    for job in session.exec(select(ConversionJob).where(ConversionJob.conversion_id == id)).all():
+        session.delete(job)
+    keys = (conversion.data_key, conversion.converted_key)
     session.delete(conversion)
     session.commit()
+    # the files are deleted unless other tasks (or the conversion cache) have the same ones
+    release_blobs(session, *keys)
 
     return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
 
@@ -329,23 +322,51 @@ async def _get_conversions_api(request: Request, session: Session = Depends(get_
 
     statement = select(Conversion).where(Conversion.user_id == user.id)
     conversions = session.exec(statement).all()
+    jobs = latest_jobs(session, [c.id for c in conversions])
     return [
         ConversionRead(
             content=c.content,
             id=c.id,
             date_created=c.date_created,
             user_id=c.user_id,
-            has_converted_data=c.data_converted is not None
+            has_converted_data=c.converted_key is not None,
+            job_id=jobs[c.id].id if c.id in jobs else None,
+            job_status=jobs[c.id].status if c.id in jobs else None
         ) for c in conversions
     ]
 
+async def _convert_api(id: int, request: Request, session: Session = Depends(get_session),
+                       jobs: JobQueue = Depends(get_job_queue)):
+    user = get_current_user_from_cookie(request, session)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    conversion = session.get(Conversion, id)
+    if not conversion or conversion.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Conversion task not found")
+    return jobs.submit(session, conversion, {})
+
+async def _get_job_api(id: int, request: Request, session: Session = Depends(get_session)):
+    user = get_current_user_from_cookie(request, session)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    job = session.get(ConversionJob, id)
+    if not job or job.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 # Register on main router (for template mode)
 router.get("/api/me")(_get_current_user_api)
 router.get("/api/conversions", response_model=List[ConversionRead])(_get_conversions_api)
+router.post("/api/convert/{id}", status_code=status.HTTP_202_ACCEPTED, response_model=ConversionJobRead)(_convert_api)
+router.get("/api/jobs/{id}", response_model=ConversionJobRead)(_get_job_api)
 
 # Register on api_router (for React mode)
 api_router.get("/api/me")(_get_current_user_api)
 api_router.get("/api/conversions", response_model=List[ConversionRead])(_get_conversions_api)
+api_router.post("/api/convert/{id}", status_code=status.HTTP_202_ACCEPTED, response_model=ConversionJobRead)(_convert_api)
+api_router.get("/api/jobs/{id}", response_model=ConversionJobRead)(_get_job_api)
 
 # API-compatible login/signup for React (returns JSON, not templates)
 @api_router.post("/login")
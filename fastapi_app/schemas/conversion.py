@@ -1,3 +1,4 @@
+from typing import Optional
 from datetime import datetime
 from pydantic import BaseModel, Field
 
@@ -25,6 +26,8 @@ class ConversionRead(ConversionBase):
         description="Whether the file has been converted to PCAP format",
         examples=[True],
     )
+    job_id: Optional[int] = Field(None, description="The last conversion job of this task, if any", examples=[1])
+    job_status: Optional[str] = Field(None, description="State of the last conversion job", examples=["done"])
 
     class Config:
         from_attributes = True
@@ -39,3 +42,19 @@ class ConversionRename(BaseModel):
         description="New filename for the conversion task",
         examples=["renamed_capture.txt"],
     )
+
+
+class ConversionJobRead(BaseModel):
+    """Schema for reading the state of a conversion job."""
+
+    id: int = Field(..., description="Unique job identifier", examples=[1])
+    conversion_id: int = Field(..., description="The conversion task being converted", examples=[1])
+    status: str = Field(..., description="queued, running, done or failed", examples=["running"])
+    date_created: datetime = Field(..., description="When the conversion was requested")
+    date_started: Optional[datetime] = Field(None, description="When a worker started the conversion")
+    date_finished: Optional[datetime] = Field(None, description="When the conversion finished or failed")
+    packets: Optional[int] = Field(None, description="Packets captured by the sniffer (or converted, when it does not say), once done", examples=[1403])
+    error: Optional[str] = Field(None, description="Why the conversion failed")
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,209 @@
+import abc
+import hashlib
+import hmac
+import logging
+import os
+import tempfile
+from contextlib import suppress
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from ..core.config import settings
+from ..models.blob import Blob
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+logger = logging.getLogger(__name__)
+
+# size of the random nonce stored before each encrypted file
+NONCE_SIZE = 12
+
+
+class BlobStore(abc.ABC):
+    '''Storage of the uploaded and converted files, addressed by their content
+
+    The same content is stored once, the rows referencing it are counted in the Blob table.
+    '''
+
+    @abc.abstractmethod
+    def key(self, data: bytes) -> str:
+        '''Returns the address of the content'''
+
+    @abc.abstractmethod
+    def write(self, key: str, data: bytes) -> None:
+        '''Stores the content under its address, if not there already'''
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        '''Returns the content, raises KeyError if it is not stored'''
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        '''Removes the content, if stored'''
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        '''Returns whether the content is stored'''
+
+    def put(self, data: bytes) -> str:
+        '''Stores the content, returns its address'''
+        key = self.key(data)
+        self.write(key, data)
+        return key
+
+
+class FileBlobStore(BlobStore):
+    '''Blob store in a local directory, with the files sharded in subdirectories by the first bytes of their keys
+
+    The files are written to a temporary file renamed over their path, so they are never seen incomplete.
+    With a secret they are encrypted (AES-256-GCM), and addressed by a keyed hash which tells nothing of
+    their content.
+    '''
+
+    def __init__(self, root: str, secret: Optional[str] = None):
+        self.root = root
+        self.cipher = None
+        self.address_key = None
+        if secret:
+            if AESGCM is None:
+                raise RuntimeError("Encrypting the blob store needs the cryptography package")
+            self.cipher = AESGCM(self._derive(secret, b"blob encryption"))
+            self.address_key = self._derive(secret, b"blob address")
+
+    @staticmethod
+    def _derive(secret: str, purpose: bytes) -> bytes:
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose).derive(secret.encode())
+
+    def key(self, data: bytes) -> str:
+        if self.address_key is not None:
+            return hmac.new(self.address_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, key: str) -> str:
+        '''Returns the path of the file, e.g. root/ab/cd/abcd...'''
+        if len(key) < 8 or not key.isalnum():
+            raise KeyError(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def write(self, key: str, data: bytes) -> None:
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        (fd, temporary) = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if self.cipher is not None:
+                    nonce = os.urandom(NONCE_SIZE)
+                    f.write(nonce)
+                    data = self.cipher.encrypt(nonce, data, key.encode())
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(temporary)
+            raise
+
+    def read(self, key: str) -> bytes:
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+        if self.cipher is not None:
+            data = self.cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], key.encode())
+        return data
+
+    def delete(self, key: str) -> None:
+        with suppress(FileNotFoundError):
+            os.unlink(self.path(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+
+@lru_cache(maxsize=None)
+def get_blob_store() -> BlobStore:
+    '''Returns the blob store of the settings, encrypted like the database'''
+    return FileBlobStore(settings.BLOB_DIR, secret=settings.DATABASE_KEY)
+
+
+def add_blob(session: Session, data: bytes, store: Optional[BlobStore] = None) -> Tuple[str, int]:
+    '''Stores the content with one more reference to it, returns its key and size
+
+    The reference is committed before the file is written, so a concurrent release of the last
+    other reference either sees it and keeps the file, or removes the file before it is written again.
+    If the file cannot be written, the reference is released again, so no row points at a missing file.
+    '''
+    store = store or get_blob_store()
+    key = store.key(data)
+    commit_reference(session, key, len(data))
+    try:
+        store.write(key, data)
+    except BaseException:
+        release_blobs(session, key, store=store)
+        raise
+    return key, len(data)
+
+
+def add_stored_blob(session: Session, key: str, size: int, store: Optional[BlobStore] = None) -> None:
+    '''Adds a reference to content written to the store beforehand, e.g. by a worker process
+
+    Raises KeyError if the file was deleted before the reference was committed, by the release of
+    the last other reference to the same content; the content has to be written again then.
+    '''
+    store = store or get_blob_store()
+    commit_reference(session, key, size)
+    if not store.exists(key):
+        release_blobs(session, key, store=store)
+        raise KeyError(key)
+
+
+def commit_reference(session: Session, key: str, size: int) -> None:
+    '''Commits one more reference to the content, adding its row for the first one'''
+    while True:
+        if session.exec(update(Blob).where(Blob.key == key).values(refs=Blob.refs + 1)).rowcount:
+            session.commit()
+            return
+        session.add(Blob(key=key, size=size, refs=1))
+        try:
+            session.commit()
+            return
+        except IntegrityError:
+            # added meanwhile by another request or worker
+            session.rollback()
+
+
+def ref_blob(session: Session, key: str) -> None:
+    '''Adds a reference to stored content, committed with the row referencing it'''
+    session.exec(update(Blob).where(Blob.key == key).values(refs=Blob.refs + 1))
+
+
+def release_blobs(session: Session, *keys: Optional[str], store: Optional[BlobStore] = None) -> None:
+    '''Removes a reference to each of the contents (None keys are skipped), deleting those referenced no more'''
+    store = store or get_blob_store()
+    for key in keys:
+        if key is None:
+            continue
+        session.exec(update(Blob).where(Blob.key == key).values(refs=Blob.refs - 1))
+        if session.exec(delete(Blob).where(Blob.key == key, Blob.refs <= 0)).rowcount:
+            # removed before the deletion commits, while the row lock keeps the others from adding it again
+            store.delete(key)
+        session.commit()
+
+
+def read_blob(key: str, store: Optional[BlobStore] = None) -> bytes:
+    '''Returns the stored content'''
+    return (store or get_blob_store()).read(key)
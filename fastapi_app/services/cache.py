@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from ..models.conversion import ConversionCacheEntry
+from .blobs import ref_blob, release_blobs
+from .converter import OUTPUT_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# keyword arguments of Convert2Pcap.run_conversion changing the converted file, with their defaults
+CONVERSION_OPTIONS = {
+    "output_format": OUTPUT_FORMATS[0],
+    "compression": None,
+    "interfaces_include": None,
+    "interfaces_exclude": None,
+    "packet_filter": None,
+}
+
+
+def data_digest(data: bytes) -> str:
+    '''Returns the SHA-256 of an uploaded file'''
+    return hashlib.sha256(data).hexdigest()
+
+
+def options_digest(options: Dict[str, Any]) -> str:
+    '''Returns the SHA-256 of the conversion options, the same for options converting the same way
+
+    Other keys (e.g. the remaining run_conversion arguments) are ignored, options left out or set
+    to their default are the same, and so are the interfaces given in another order.
+    '''
+    normalized = {}
+    for (name, default) in CONVERSION_OPTIONS.items():
+        value = options.get(name) or default
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(value)
+        if value != default:
+            normalized[name] = value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class ConversionCache:
+    '''Converted files of the uploads, by the digests of their data and conversion options
+
+    A repeated conversion of the same file is copied from the cache instead of being converted again.
+    The cached files are references to the converted files in the blob store, so a hit only copies the reference.
+    The cache is bounded by the total size of the converted files, the least recently used are evicted.
+    The hit and miss counters are those of this process.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def stats(self) -> Dict[str, int]:
+        '''Returns the counters of the cache'''
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def lookup(self, session: Session, data_hash: str, options_hash: str) -> Optional[ConversionCacheEntry]:
+        '''Returns the cached conversion, marking it as recently used, or None'''
+        if not self.enabled:
+            return None
+        entry = session.exec(
+            select(ConversionCacheEntry).where(ConversionCacheEntry.data_hash == data_hash,
+                                               ConversionCacheEntry.options_hash == options_hash)
+        ).first()
+        if entry is None:
+            self.misses += 1
+            return None
+        session.exec(
+            update(ConversionCacheEntry).where(ConversionCacheEntry.id == entry.id)
+            .values(date_used=datetime.utcnow(), hits=ConversionCacheEntry.hits + 1)
+        )
+        session.commit()
+        session.refresh(entry)
+        self.hits += 1
+        return entry
+
+    def store(self, session: Session, data_hash: str, options_hash: str, converted_key: str, size: int,
+              packets: int, esp_sa: Optional[str] = None) -> bool:
+        '''Caches a conversion and evicts the least recently used ones above the size limit, returns False if not cached'''
+        if not self.enabled or size > self.max_bytes:
+            return False
+        ref_blob(session, converted_key)
+        session.add(ConversionCacheEntry(data_hash=data_hash, options_hash=options_hash,
+                                         converted_key=converted_key, packets=packets, esp_sa=esp_sa, size=size))
+        try:
+            session.commit()
+        except IntegrityError:
+            # the same file was converted by another worker meanwhile
+            session.rollback()
+            return False
+        self.evict(session)
+        return True
+
+    def evict(self, session: Session) -> int:
+        '''Removes the least recently used conversions until the cache fits its size limit, returns how many'''
+        entries = session.exec(
+            select(ConversionCacheEntry.id, ConversionCacheEntry.size, ConversionCacheEntry.converted_key)
+            .order_by(ConversionCacheEntry.date_used.desc())
+        ).all()
+        total = 0
+        evicted = []
+        for (entry_id, size, converted_key) in entries:
+            total += size
+            if total > self.max_bytes:
+                evicted.append((entry_id, converted_key))
+        if evicted:
+            session.exec(delete(ConversionCacheEntry).where(ConversionCacheEntry.id.in_([entry_id for (entry_id, _) in evicted])))
+            session.commit()
+            release_blobs(session, *(converted_key for (_, converted_key) in evicted))
+            self.evictions += len(evicted)
+            logger.info(f"Evicted {len(evicted)} conversions from the cache")
+        return len(evicted)
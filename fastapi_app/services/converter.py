@@ -1,182 +1,187 @@
-import os
+import io
 import re
 import logging
-from pathlib import Path
-from typing import Optional, Tuple
+from typing import BinaryIO, Iterable, NamedTuple, Optional, Tuple, Union
 
-from ..sniftran import DataSource_File, PacketParser, PacketAssembler, PcapNGWriter
+from ..sniftran import DataSource_Bytes, IPSec, PacketFilter, PacketFormatter, PcapNGWriter, PcapWriter, iter_formatted_parallel, iter_packets
+from ..sniftran.compression import compression_available, decompress_prefix, detect_compression
+from .blobs import get_blob_store, read_blob
 
 logger = logging.getLogger(__name__)
 
+# output formats of the conversion, the first one is the default
+OUTPUT_FORMATS = ("pcapng", "pcap")
+
+# (file extension, media type) of the converted files, recognized by their first bytes
+CONVERTED_FILE_TYPES = {
+    b"\x0a\x0d\x0d\x0a": ("pcapng", "application/x-pcapng"),
+    b"\xa1\xb2\x3c\x4d": ("pcap", "application/vnd.tcpdump.pcap"),
+}
+
+# (file extension suffix, media type) of the compressed converted files
+COMPRESSED_FILE_TYPES = {
+    "gzip": ("gz", "application/gzip"),
+    "zstd": ("zst", "application/zstd"),
+}
+
+
+def converted_file_type(data: bytes) -> Tuple[str, str]:
+    '''Returns the file extension and media type of converted data, compressed data are served as they are'''
+    (extension, media_type) = CONVERTED_FILE_TYPES.get(bytes(decompress_prefix(data, 4)), CONVERTED_FILE_TYPES[b"\x0a\x0d\x0d\x0a"])
+    compression = detect_compression(data)
+    if compression in COMPRESSED_FILE_TYPES:
+        (suffix, media_type) = COMPRESSED_FILE_TYPES[compression]
+        extension = f"{extension}.{suffix}"
+    return extension, media_type
+
+
+class ConvertedFile(NamedTuple):
+    '''Result of Convert2Pcap.convert_blob, the converted file is in the blob store but not referenced yet'''
+    key: str
+    size: int
+    packets: int
+    # rows of the Wireshark esp_sa file of the IPSec tunnels found in the upload, None without any
+    esp_sa: Optional[str] = None
+
 
 class Convert2Pcap:
-    def __init__(self, tid: int, cid: int, tuid: int, fname: str, file_to_convert: bytes):
+    def __init__(self, tid: int, cid: int, tuid: int, fname: str, file_to_convert: bytes, jobs: int = 1,
+                 output_format: str = "pcapng", compression: Optional[str] = None,
+                 interfaces_include: Optional[Iterable[str]] = None, interfaces_exclude: Optional[Iterable[str]] = None,
+                 packet_filter: Optional[str] = None):
         self.taskid = f'_{tid}'
         self.currentuserid = f'_{cid}'
         self.taskuserid = f'_{tuid}'
         self.file_to_convert = file_to_convert
-
-        # Define paths
-        self.base_path = Path(os.getcwd()) / 'fastapi_app' / 'utils'
-        self.conv_folder = self.base_path / 'pcap_conversion_files'
-        self.logs_folder = self.base_path / '_logs'
+        self.jobs = jobs
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.output_format = output_format
+        if not compression_available(compression):
+            raise ValueError(f"Compression not available: {compression}")
+        self.compression = compression
+        # packets from/to other interfaces are passed over by the parser without being decoded
+        self.interfaces_include = set(interfaces_include or ())
+        self.interfaces_exclude = set(interfaces_exclude or ())
+        # raises ValueError for invalid expressions
+        self.packet_filter = PacketFilter(packet_filter) if packet_filter else None
 
         self.filename_nopath = fname
-        self.filename = self.conv_folder / fname
         self.num_of_packets_captured = ''
-
-    def create_directories(self) -> bool:
-        '''Creates and checks for directories'''
-        self.logs_folder.mkdir(parents=True, exist_ok=True)
-        self.conv_folder.mkdir(parents=True, exist_ok=True)
-        return True
-
-    def writeout_file(self) -> bool:
-        '''Writes out file to disk for processing'''
-        try:
-            with open(self.filename, 'wb') as output_file:
-                output_file.write(self.file_to_convert)
-            return True
-        except Exception as e:
-            logger.error(f"Error writing file: {e}")
-            raise
+        # packets shorter than their IP header says, dropped by the integrity checks
+        self.packets_truncated = 0
+        # packets of other link types than the first one, which do not fit in one libpcap file
+        self.packets_skipped = 0
+        # IPSec tunnels (SAs) found in the sniffer output during the conversion
+        self.ipsec = IPSec()
 
     def packets_captured(self) -> bool:
         '''Returns number of packets originally received by filter'''
-        regex_string = r"\d+ packets received by filter"
+        regex_string = rb"(\d+) packets received by filter"
         regex_compiled = re.compile(regex_string)
 
         try:
-            with open(self.filename, 'r', encoding='utf-8', errors='ignore') as ofile:
-                ofile_contents = ofile.read()
-
-            regex_results = re.findall(regex_compiled, ofile_contents)
-            if regex_results:
-                num_packets_captured = regex_results[0].split().pop(0)
-                if num_packets_captured:
-                    logger.info(f"Packets originally captured in {self.filename} is {num_packets_captured}")
-                    self.num_of_packets_captured = num_packets_captured
+            regex_result = regex_compiled.search(self.file_to_convert)
+            if regex_result:
+                num_packets_captured = regex_result.group(1).decode('ascii')
+                logger.info(f"Packets originally captured in {self.filename_nopath} is {num_packets_captured}")
+                self.num_of_packets_captured = num_packets_captured
             return True
         except Exception as e:
             logger.error(f"Error reading packets captured: {e}")
             return False
 
-    def remove_file(self, file_path: Path):
-        '''Removes files from disk'''
-        try:
-            if file_path.exists():
-                os.remove(file_path)
-        except Exception as e:
-            logger.error(f"Error removing file {file_path}: {e}")
-
-    def run_sniftran_conversion(self, input_file: Path, output_file: Path) -> int:
-        '''Converts sniffer output to pcapng using sniftran'''
+    def run_sniftran_conversion(self, source, output: Union[str, BinaryIO]) -> int:
+        '''Converts sniffer output to pcapng (or libpcap) using sniftran, one packet at a time'''
         try:
-            # Initialize sniftran components
-            ds = DataSource_File(str(input_file))
-            pp = PacketParser(datasource=ds, compatible=True, normalize_lines=True)
-            pc = PacketAssembler(packetparser=pp, stop_on_error=False)
-            pcap = PcapNGWriter(outfile=str(output_file), debug=0)
-
-            ifaces_blocks = {}
-            ifaces_block = b""
-            ifaces = set()
+            if self.output_format == "pcap":
+                pcap = PcapWriter(outfile=output, compression=self.compression, debug=0)
+            else:
+                pcap = PcapNGWriter(outfile=output, compression=self.compression, debug=0)
+            formatter = PacketFormatter(interfaces_include=self.interfaces_include, interfaces_exclude=self.interfaces_exclude,
+                                        packet_filter=self.packet_filter, check_packet_size=True)
             packets_count = 0
 
-            # Assemble all packets
-            while True:
-                eof = not pc.assemblePacket()
-                if eof:
-                    break
-
-            # Process assembled packets
-            binary_packets = []
-            current_ifaces = set()
-
-            while True:
-                try:
-                    (packetBytes, additionalInfo) = pc.getPacket()
-                except IndexError:
-                    break
-
-                try:
-                    iface = additionalInfo[2]
-                    current_ifaces.add(iface)
-                    timestamp = additionalInfo[0] * 1000000 + additionalInfo[1]
-                    comment = f"({additionalInfo[3]}){' ' * (4 - len(additionalInfo[3]))}{additionalInfo[2]}"
-                    binary_packets.append((iface, timestamp, comment, packetBytes))
+            # Stream packets: each one is assembled, formatted and written before the
+            # next one is parsed, so memory is bounded by the largest single packet.
+            # With more jobs the input is parsed in shards by worker processes instead.
+            # IPSec tunnels are collected from the non-packet lines in the same pass
+            if self.jobs > 1 and isinstance(source, (str, bytes)):
+                formatted = iter_formatted_parallel(source, self.jobs, formatter, ipsec=self.ipsec,
+                                                    compatible=True, normalize_lines=True, stop_on_error=False)
+            else:
+                formatted = formatter.iterFormatted(iter_packets(source, compatible=True, normalize_lines=True, stop_on_error=False,
+                                                                 reuse_buffer=True, line_observer=self.ipsec.feedLine,
+                                                                 interface_filter=formatter.accepts))
+
+            try:
+                for (iface, linktype, block) in formatted:
+                    # packets failing the integrity checks come without any block
+                    if block is None:
+                        self.packets_truncated += 1
+                        continue
+                    pcap.writeEnhancedPacket(block, iface=iface, linktype=linktype)
                     packets_count += 1
-                except IndexError:
-                    logger.warning(f"Invalid data for packet {packets_count + 1}, ignoring")
-                    continue
-
-            # Create interface blocks for new interfaces
-            for new_iface in (current_ifaces - ifaces):
-                new_index = len(ifaces_blocks)
-                iface_type = pcap.LINKTYPE_ETHERNET
-                ifaces_blocks[new_iface] = {
-                    'index': new_index,
-                    'block': pcap.blockInterfaceDescription(new_iface, iface_type)
-                }
-
-            # Rebuild interface block
-            if len(current_ifaces - ifaces) > 0:
-                for iface in sorted(ifaces_blocks, key=lambda x: ifaces_blocks[x]['index']):
-                    ifaces_block += ifaces_blocks[iface]['block']
-
-            ifaces |= current_ifaces
-
-            # Format packets
-            blockPackets = []
-            for (iface_name, timestamp, comment, packetBytes) in binary_packets:
-                blockPackets.append(
-                    pcap.blockEnhancedPacket(
-                        packetBytes,
-                        timestamp=timestamp,
-                        ifaceIndex=ifaces_blocks[iface_name]['index'],
-                        comment=comment
-                    )
-                )
-
-            # Write to file
-            if blockPackets:
-                pcap.writePackets(ifaces_block, blockPackets)
-
-            pcap.close()
-            logger.info(f'Converted {packets_count} packets to {output_file}')
+            finally:
+                pcap.close()
+
+            if isinstance(pcap, PcapWriter) and pcap.skippedPackets:
+                self.packets_skipped = sum(pcap.skippedPackets.values())
+                packets_count -= self.packets_skipped
+                linktypes = ", ".join(str(linktype) for linktype in sorted(pcap.skippedPackets))
+                logger.warning(f'Skipped {self.packets_skipped} packets with link type {linktypes} from {self.filename_nopath}, '
+                               f'a pcap file holds only one link type, convert to pcapng to keep them')
+            logger.info(f'Converted {packets_count} packets from {self.filename_nopath}')
+            if self.packets_truncated:
+                logger.warning(f'Dropped {self.packets_truncated} incomplete packets from {self.filename_nopath}')
+            if self.ipsec.tunnels:
+                logger.info(f'Found {len(self.ipsec.tunnels)} IPSec tunnels in {self.filename_nopath}')
             return packets_count
 
         except Exception as e:
             logger.error(f"sniftran conversion failed: {e}")
             raise Exception(f"Conversion failed: {e}")
 
-    def convert_to_pcap(self) -> Tuple[Optional[Path], str]:
-        '''Converts sniffer output to pcap using sniftran'''
-        self.create_directories()
-        self.writeout_file()
+    def convert_to_pcap(self) -> Tuple[bytes, str]:
+        '''Converts sniffer output to pcap using sniftran, entirely in memory'''
         self.packets_captured()
 
-        input_filename = self.filename
-        pcap_file = self.conv_folder / f'task{self.taskid}_user{self.currentuserid}_{self.filename_nopath}.pcapng'
+        output = io.BytesIO()
+        if self.jobs > 1:
+            packets_converted = self.run_sniftran_conversion(self.file_to_convert, output)
+        else:
+            source = DataSource_Bytes(self.file_to_convert)
+            try:
+                packets_converted = self.run_sniftran_conversion(source, output)
+            finally:
+                source.close()
 
-        try:
-            packets_converted = self.run_sniftran_conversion(input_filename, pcap_file)
+        # Use converted count if original count not available
+        if not self.num_of_packets_captured:
+            self.num_of_packets_captured = str(packets_converted)
 
-            if not pcap_file.exists():
-                raise Exception('Unable to create PCAP File')
-
-            # Use converted count if original count not available
-            if not self.num_of_packets_captured:
-                self.num_of_packets_captured = str(packets_converted)
-
-            return pcap_file, self.num_of_packets_captured
-
-        finally:
-            # Cleanup input file
-            self.remove_file(input_filename)
+        return output.getvalue(), self.num_of_packets_captured
 
     @classmethod
-    def run_conversion(cls, tid, cid, tuid, fname, file_to_convert) -> Tuple[Optional[Path], str]:
-        '''Used to execute the class'''
-        converter = cls(tid, cid, tuid, fname, file_to_convert)
+    def run_conversion(cls, tid, cid, tuid, fname, file_to_convert, jobs: int = 1,
+                       output_format: str = "pcapng", compression: Optional[str] = None,
+                       interfaces_include: Optional[Iterable[str]] = None,
+                       interfaces_exclude: Optional[Iterable[str]] = None,
+                       packet_filter: Optional[str] = None) -> Tuple[bytes, str]:
+        '''Used to execute the class, returns the converted (and possibly compressed) content and the packet count'''
+        converter = cls(tid, cid, tuid, fname, file_to_convert, jobs=jobs, output_format=output_format,
+                        compression=compression, interfaces_include=interfaces_include,
+                        interfaces_exclude=interfaces_exclude, packet_filter=packet_filter)
         return converter.convert_to_pcap()
+
+    @classmethod
+    def convert_blob(cls, tid, cid, tuid, fname, data_key: str, **options) -> ConvertedFile:
+        '''Converts an uploaded file of the blob store and writes the converted file to it, in the calling (worker) process
+
+        Only the keys, counts and the esp_sa rows of the IPSec tunnels are passed between the processes,
+        not the files. The caller adds the reference to the converted file (see add_stored_blob).
+        '''
+        converter = cls(tid, cid, tuid, fname, read_blob(data_key), **options)
+        pcap_data, packets = converter.convert_to_pcap()
+        esp_sa = "".join(f"{row}\n" for row in converter.ipsec.esp_sa_rows(warn=False)) or None
+        return ConvertedFile(get_blob_store().put(pcap_data), len(pcap_data), int(packets), esp_sa)
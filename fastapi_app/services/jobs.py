@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+from fastapi import Request
+from sqlalchemy import and_, or_, update
+from sqlmodel import Session, select
+
+from ..core.database import engine
+from ..core.logging import log_conversion_error
+from ..models.conversion import Conversion, ConversionJob, JOB_ACTIVE_STATES, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+from .blobs import add_stored_blob, ref_blob, release_blobs
+from .cache import ConversionCache, options_digest
+from .converter import Convert2Pcap, ConvertedFile
+from .pool import ConversionPool
+
+logger = logging.getLogger(__name__)
+
+# shown to the users, the details are only logged
+JOB_ERROR = "Conversion failed. Please check your file format and try again."
+# a job whose workers keep dying (e.g. killed for using too much memory) is given up after this many claims
+MAX_JOB_ATTEMPTS = 3
+# idle workers look for claimable jobs this often, also for the jobs of crashed workers
+JOB_POLL_SECONDS = 1.0
+
+
+def worker_name(kind: str) -> str:
+    '''Returns a name identifying this worker in the leases, unique even for restarted containers'''
+    return f"{socket.gethostname()}:{os.getpid()}:{kind}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_job(session: Session, worker: str, lease_seconds: int) -> Optional[ConversionJob]:
+    '''Takes the oldest queued job, or one whose lease expired, for the worker
+
+    The job is taken by a conditional update, so when more workers (processes, containers)
+    share the database, only one of them gets it.
+    '''
+    while True:
+        now = datetime.utcnow()
+        claimable = or_(ConversionJob.status == JOB_QUEUED,
+                        and_(ConversionJob.status == JOB_RUNNING, ConversionJob.lease_expires < now))
+        job = session.exec(select(ConversionJob).where(claimable).order_by(ConversionJob.id).limit(1)).first()
+        if job is None:
+            return None
+
+        if job.attempts >= MAX_JOB_ATTEMPTS:
+            values = dict(status=JOB_FAILED, date_finished=now, error=JOB_ERROR, worker=None, lease_expires=None)
+        else:
+            values = dict(status=JOB_RUNNING, date_started=now, worker=worker,
+                          lease_expires=now + timedelta(seconds=lease_seconds), attempts=ConversionJob.attempts + 1)
+        claimed = session.exec(update(ConversionJob).where(ConversionJob.id == job.id, claimable).values(**values)).rowcount
+        session.commit()
+        if claimed and values["status"] == JOB_RUNNING:
+            session.refresh(job)
+            return job
+        if claimed:
+            logger.error(f"Conversion job {job.id} failed {job.attempts} times, giving up")
+        # another worker was faster, or the job was given up, look for the next one
+
+
+def renew_lease(session: Session, job_id: int, worker: str, lease_seconds: int) -> bool:
+    '''Extends the lease of the job, returns False if the worker does not hold it anymore'''
+    renewed = session.exec(
+        update(ConversionJob)
+        .where(ConversionJob.id == job_id, ConversionJob.worker == worker, ConversionJob.status == JOB_RUNNING)
+        .values(lease_expires=datetime.utcnow() + timedelta(seconds=lease_seconds))
+    ).rowcount
+    session.commit()
+    return renewed == 1
+
+
+def finish_job(session: Session, job_id: int, worker: str, status: str, packets: Optional[int] = None,
+               error: Optional[str] = None, converted_key: Optional[str] = None, converted_size: Optional[int] = None,
+               options_hash: Optional[str] = None, esp_sa: Optional[str] = None) -> bool:
+    '''Records the result of the job and sets the converted file of its conversion task
+
+    Only the worker still holding the lease records it, returns False for the others
+    (their job was claimed again meanwhile, or deleted together with its conversion task).
+    '''
+    job = session.get(ConversionJob, job_id)
+    finished = session.exec(
+        update(ConversionJob)
+        .where(ConversionJob.id == job_id, ConversionJob.worker == worker, ConversionJob.status == JOB_RUNNING)
+        .values(status=status, date_finished=datetime.utcnow(), packets=packets, error=error, lease_expires=None)
+    ).rowcount
+    replaced = None
+    if finished and converted_key is not None:
+        replaced = session.exec(select(Conversion.converted_key).where(Conversion.id == job.conversion_id)).first()
+        session.exec(update(Conversion).where(Conversion.id == job.conversion_id)
+                     .values(converted_key=converted_key, converted_size=converted_size, options_hash=options_hash,
+                             esp_sa=esp_sa))
+    session.commit()
+    # the file of an earlier conversion of the task
+    release_blobs(session, replaced)
+    return finished == 1
+
+
+def release_jobs(session: Session, worker: str) -> int:
+    '''Puts the jobs of a stopping worker back to the queue, returns how many'''
+    released = session.exec(
+        update(ConversionJob)
+        .where(ConversionJob.worker == worker, ConversionJob.status == JOB_RUNNING)
+        .values(status=JOB_QUEUED, date_started=None, worker=None, lease_expires=None, attempts=ConversionJob.attempts - 1)
+    ).rowcount
+    session.commit()
+    return released
+
+
+def conversion_arguments(session: Session, job: ConversionJob) -> Optional[Dict[str, Any]]:
+    '''Returns the keyword arguments of Convert2Pcap.convert_blob for the job, None if its task was deleted
+
+    The uploaded file is passed by its key, the worker process reads it itself.
+    '''
+    conversion = session.get(Conversion, job.conversion_id)
+    if conversion is None:
+        return None
+    return dict(tid=conversion.id, cid=job.user_id, tuid=conversion.user_id,
+                fname=conversion.content, data_key=conversion.data_key, **json.loads(job.options))
+
+
+def store_conversion(session: Session, job_id: int, worker: str, cache: Optional[ConversionCache],
+                     arguments: Dict[str, Any], converted: ConvertedFile) -> bool:
+    '''Records the converted file written by the worker process and finishes the job, caching the file
+    for the same upload converted again
+
+    Returns False if the worker does not hold the job anymore, the converted file is dropped then.
+    Raises KeyError if the converted file was deleted before it was referenced, the job is converted again then.
+    '''
+    add_stored_blob(session, converted.key, converted.size)
+    options_hash = options_digest(arguments)
+    if not finish_job(session, job_id, worker, JOB_DONE, packets=converted.packets, converted_key=converted.key,
+                      converted_size=converted.size, options_hash=options_hash, esp_sa=converted.esp_sa):
+        release_blobs(session, converted.key)
+        return False
+    if cache is not None:
+        data_hash = session.exec(
+            select(Conversion.data_hash).join(ConversionJob, ConversionJob.conversion_id == Conversion.id)
+            .where(ConversionJob.id == job_id)
+        ).first()
+        if data_hash is not None:
+            cache.store(session, data_hash, options_hash, converted.key, converted.size, converted.packets, converted.esp_sa)
+    return True
+
+
+class JobQueue:
+    '''Queue of conversion jobs in the database, drained by worker tasks which run the conversions in the ConversionPool
+
+    The jobs can be converted by the "python -m fastapi_app.worker" processes as well (or only by them, with
+    no worker tasks here), all of them claim the jobs with a lease renewed while the conversion runs.
+    '''
+
+    def __init__(self, pool: ConversionPool, workers: int, lease_seconds: int = 60,
+                 cache: Optional[ConversionCache] = None,
+                 session_factory: Callable[[], ContextManager[Session]] = lambda: Session(engine)):
+        self.pool = pool
+        self.cache = cache
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        # the workers outlive the requests, they open their own database sessions
+        self.session_factory = session_factory
+        self.worker = worker_name("server")
+        self.wakeup: Optional[asyncio.Event] = None
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        '''Starts the worker tasks'''
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def shutdown(self) -> None:
+        '''Stops the worker tasks, the interrupted jobs go back to the queue'''
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        with self.session_factory() as session:
+            released = release_jobs(session, self.worker)
+        if released:
+            logger.info(f"Requeued {released} interrupted conversion jobs")
+        if self.cache is not None and self.cache.enabled:
+            logger.info(f"Conversion cache: {self.cache.hits} hits, {self.cache.misses} misses, {self.cache.evictions} evictions")
+
+    def submit(self, session: Session, conversion: Conversion, options: Dict[str, Any]) -> ConversionJob:
+        '''Queues the conversion, or returns the job already converting it'''
+        job = session.exec(
+            select(ConversionJob).where(ConversionJob.conversion_id == conversion.id,
+                                        ConversionJob.status.in_(JOB_ACTIVE_STATES))
+        ).first()
+        if job is not None:
+            return job
+
+        options_hash = options_digest(options)
+        cached = None
+        # uploads stored before the digests were computed are not read here, the migration computes them
+        if self.cache is not None and conversion.data_hash is not None:
+            cached = self.cache.lookup(session, conversion.data_hash, options_hash)
+        if cached is not None:
+            # the same file was converted the same way before, only a reference to its result is copied
+            now = datetime.utcnow()
+            replaced = conversion.converted_key
+            ref_blob(session, cached.converted_key)
+            conversion.converted_key = cached.converted_key
+            conversion.converted_size = cached.size
+            conversion.options_hash = options_hash
+            conversion.esp_sa = cached.esp_sa
+            job = ConversionJob(conversion_id=conversion.id, user_id=conversion.user_id, options=json.dumps(options),
+                                status=JOB_DONE, date_started=now, date_finished=now, packets=cached.packets)
+            session.add(conversion)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            release_blobs(session, replaced)
+            logger.info(f"Conversion of {conversion.content} copied from the cache")
+            return job
+
+        session.add(conversion)
+        job = ConversionJob(conversion_id=conversion.id, user_id=conversion.user_id, options=json.dumps(options))
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job
+
+    async def work(self) -> None:
+        '''Worker task, converts the claimed jobs one after another'''
+        while True:
+            # cleared before looking, so a job submitted meanwhile wakes the worker right away
+            self.wakeup.clear()
+            try:
+                with self.session_factory() as session:
+                    job = claim_job(session, self.worker, self.lease_seconds)
+                    job_id = job.id if job is not None else None
+                    arguments = conversion_arguments(session, job) if job is not None else None
+                if job_id is None:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.run(job_id, arguments)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Conversion job could not be processed: {e}")
+                await asyncio.sleep(JOB_POLL_SECONDS)
+
+    async def run(self, job_id: int, arguments: Optional[Dict[str, Any]]) -> None:
+        '''Converts one claimed job, renewing its lease until the conversion is finished'''
+        if arguments is None:
+            with self.session_factory() as session:
+                finish_job(session, job_id, self.worker, JOB_FAILED, error="Conversion task was deleted")
+            return
+
+        heartbeat = asyncio.create_task(self.heartbeat(job_id))
+        try:
+            # the worker process reads the upload and writes the converted file, only their keys are sent
+            converted = await self.pool.run(Convert2Pcap.convert_blob, **arguments)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_conversion_error(arguments["tid"], arguments["cid"], e)
+            with self.session_factory() as session:
+                finish_job(session, job_id, self.worker, JOB_FAILED, error=JOB_ERROR)
+            return
+        finally:
+            heartbeat.cancel()
+
+        with self.session_factory() as session:
+            if not store_conversion(session, job_id, self.worker, self.cache, arguments, converted):
+                logger.warning(f"Conversion job {job_id} was taken over or deleted, its result is dropped")
+
+    async def heartbeat(self, job_id: int) -> None:
+        '''Renews the lease of the job while it converts'''
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            with self.session_factory() as session:
+                if not renew_lease(session, job_id, self.worker, self.lease_seconds):
+                    return
+
+
+def latest_jobs(session: Session, conversion_ids: List[int]) -> Dict[int, ConversionJob]:
+    '''Returns the last job of each of the conversion tasks which have any'''
+    jobs = session.exec(
+        select(ConversionJob).where(ConversionJob.conversion_id.in_(conversion_ids)).order_by(ConversionJob.id)
+    ).all()
+    return {job.conversion_id: job for job in jobs}
+
+
+def get_job_queue(request: Request) -> JobQueue:
+    '''Returns the job queue started by the application lifespan'''
+    return request.app.state.job_queue
@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionPool:
+    '''Runs the CPU bound conversions in worker processes, so the event loop keeps serving other requests'''
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        '''Starts the worker processes, without any workers the conversions run in the default thread pool'''
+        if self.workers > 0 and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"Started conversion pool with {self.workers} worker processes")
+
+    def shutdown(self) -> None:
+        '''Stops the worker processes, waiting for the running conversions'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        '''Runs func in a worker and waits for its result without blocking the event loop'''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, call)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for using too much memory), the next conversions need a new pool
+            # (only the first of the conversions failing together replaces it)
+            if self.executor is executor:
+                logger.error("Conversion worker process died, restarting the conversion pool")
+                executor.shutdown(wait=False)
+                self.executor = None
+                self.start()
+            raise
+
+
+def get_conversion_pool(request: Request) -> ConversionPool:
+    '''Returns the pool started by the application lifespan, or a thread based one when the lifespan did not run'''
+    pool = getattr(request.app.state, "conversion_pool", None)
+    if pool is None:
+        pool = ConversionPool(workers=0)
+        request.app.state.conversion_pool = pool
+    return pool
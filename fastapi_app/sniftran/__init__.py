@@ -7,10 +7,15 @@ License: BSD-3-Clause (see LICENSE file for full terms)
 Copyright (c) 2015 - 2022, Ondrej Holecek
 """
 
-from .parser import PacketParser, DataSource_File
+from .parser import PacketParser, DataSource_File, DataSource_Bytes, DataSource_MMap, DataSource_Compressed, open_datasource, parse_timezone
 from .assembler import PacketAssembler
-from .writer import PcapNGWriter
+from .packets import Packet, iter_packets
+from .writer import PcapNGBlocks, PcapNGWriter, PcapWriter
+from .filter import PacketFilter
+from .integrity import expected_packet_size, find_truncated
+from .formatter import PacketFormatter
+from .parallel import iter_formatted_parallel
 from .ipsec import IPSec
 from .cli import SnifTranCLI
 
-__all__ = ['PacketParser', 'DataSource_File', 'PacketAssembler', 'PcapNGWriter', 'IPSec', 'SnifTranCLI']
+__all__ = ['PacketParser', 'DataSource_File', 'DataSource_Bytes', 'DataSource_MMap', 'DataSource_Compressed', 'open_datasource', 'parse_timezone', 'PacketAssembler', 'Packet', 'iter_packets', 'PcapNGBlocks', 'PcapNGWriter', 'PcapWriter', 'PacketFilter', 'expected_packet_size', 'find_truncated', 'PacketFormatter', 'iter_formatted_parallel', 'IPSec', 'SnifTranCLI']
@@ -1,5 +1,6 @@
+import binascii
 import collections
-from typing import Deque, Tuple, Optional
+from typing import Deque, Generator, Tuple, Optional, Iterator, List, Union
 from .parser import PacketParser
 
 class PacketAssembler:
@@ -9,73 +10,310 @@ class PacketAssembler:
     This class takes a PacketParser and uses it to read packet lines.
     It assembles these lines into complete packets, handling cases where
     a packet is split across multiple lines.
+
+    With reuse_buffer enabled all packets are assembled in one growable buffer
+    and handed out as memoryview windows into it, which are only valid until
+    the next packet is assembled. This avoids allocating and zeroing a new
+    buffer for every packet when the packets are written out right away.
     """
-    def __init__(self, packetparser: PacketParser, stop_on_error: bool = False):
+    def __init__(self, packetparser: PacketParser, stop_on_error: bool = False, batch_size: int = 256,
+                 reuse_buffer: bool = False):
         """
         Initialize the PacketAssembler.
 
         Args:
             packetparser: The PacketParser instance to use for reading lines.
             stop_on_error: Whether to raise an exception when a parsing error occurs.
+            batch_size: Amount of packets decoded at once by the batch engines of the parser.
+            reuse_buffer: Whether to hand out views into one reused buffer instead of a new bytearray per packet.
         """
         self.pp = packetparser
         self.stop_on_error = stop_on_error
-        self.packetLines: Deque[Tuple[int, bytes, tuple]] = collections.deque()
+        self.batch_size = batch_size
+        self.reuse_buffer = reuse_buffer
+        self.buffer = bytearray(2048)
         self.packets: Deque[Tuple[bytearray, tuple]] = collections.deque()
+        self.packetIterator: Optional[Iterator[Tuple[bytearray, tuple]]] = None
 
-    def assemblePacket(self) -> bool:
+    def iterPackets(self, skip: int = 0) -> Iterator[Tuple[bytearray, tuple]]:
+        """
+        Yields assembled packets until the end of file.
+
+        Lines are collected until the next packet start (offset 0) or EOF,
+        then the lines of the *previous* packet are assembled into a single bytearray.
+
+        Args:
+            skip: Amount of packets at the beginning which are only scanned, see iterSkippedPackets.
+
+        Yields:
+            A tuple containing:
+                - binaryPacket (bytearray): The assembled packet data, None for skipped packets.
+                - additionalInfo (tuple): Additional info (timestamp, interface, etc.).
+        """
+        if self.pp.engine != "scalar":
+            yield from self.iterPacketsBatched(skip)
+            return
+
+        packetLines: List[Tuple[int, bytes, tuple]] = []
+        if skip > 0:
+            firstLine = yield from self.iterSkippedPackets(skip)
+            if firstLine is None:
+                return
+            (c_offset, c_hex, c_length, c_line, c_additional) = firstLine
+            packetLines.append((c_offset, binascii.unhexlify(c_hex), c_additional))
+
+        while True:
+            try:
+                packetLine = self.pp.readPacketLine()
+            except Exception:
+                print("WARNING: packet decoder problem occurred on line %i, packet ignored" % (self.pp.debug_linesRead))
+                if self.stop_on_error:
+                    raise
+                continue
+
+            if packetLine is None:
+                break
+
+            if packetLine[0] == 0 and len(packetLines) > 0:  # extract the old packet
+                yield self.buildPacket(packetLines)
+                packetLines = []
+
+            packetLines.append(packetLine)
+
+        if len(packetLines) > 0:
+            yield self.buildPacket(packetLines)
+
+    def iterPacketsBatched(self, skip: int = 0) -> Iterator[Tuple[bytearray, tuple]]:
         """
-        Reads as many lines as necessary to assemble a full packet.
+        Yields assembled packets until the end of file, decoding batch_size packets at once.
 
-        This method reads lines from the parser until it encounters a new packet
-        start or EOF. It then assembles the lines of the *previous* packet
-        into a single bytearray.
+        The hex data of all lines of the batch is decoded by a single call of the
+        parser's decodeHex and the decoded bytes are then scattered into the packets.
+
+        Args:
+            skip: Amount of packets at the beginning which are only scanned, see iterSkippedPackets.
+
+        Yields:
+            The same tuples as iterPackets.
+        """
+        batch: List[List[tuple]] = []
+        packetLines: List[tuple] = []
+        if skip > 0:
+            firstLine = yield from self.iterSkippedPackets(skip)
+            if firstLine is None:
+                return
+            packetLines.append(firstLine)
+
+        while True:
+            try:
+                packetLine = self.pp.readPacketHex()
+            except Exception:
+                print("WARNING: packet decoder problem occurred on line %i, packet ignored" % (self.pp.debug_linesRead))
+                if self.stop_on_error:
+                    raise
+                continue
+
+            if packetLine is None:
+                break
+
+            if packetLine[0] == 0 and len(packetLines) > 0:
+                batch.append(packetLines)
+                packetLines = []
+                if len(batch) >= self.batch_size:
+                    yield from self.decodeBatch(batch)
+                    batch = []
+
+            packetLines.append(packetLine)
+
+        if len(packetLines) > 0:
+            batch.append(packetLines)
+        if len(batch) > 0:
+            yield from self.decodeBatch(batch)
+
+    def iterSkippedPackets(self, count: int) -> Generator[Tuple[None, tuple], None, Optional[tuple]]:
+        """
+        Scans over the first packets without decoding or assembling them.
+
+        Packet boundaries are found exactly as when the packets are assembled, but only
+        the first line of each packet is decoded (to recognize it) and its header line parsed,
+        the other lines are passed over by the parser's readPacketStart.
+        Packets without the header line do not count (nor those rejected by the interface
+        filter of the parser, which are not seen here at all).
+
+        Args:
+            count: Amount of packets to skip.
+
+        Yields:
+            A tuple of None and the additional info for each scanned packet.
 
         Returns:
-            True if a packet was successfully assembled (or if there are more packets),
-            False if EOF was reached and no more packets can be assembled.
+            The first line of the next packet as returned by the parser's readPacketHex,
+            or None if the end of file was reached.
         """
-        EOF = False
+        packetInfo: Optional[tuple] = None  # additional info of the scanned packet, None before its first line
+        skipped = 0
 
         while True:
             try:
-                (offset, content, additional) = self.pp.getPacketLine()
-            except Exception as e:
-                if str(e) == "end of file":
-                    EOF = True
-                else: 
-                    print("WARNING: packet decoder problem occurred on line %i, packet ignored" % (self.pp.debug_linesRead))
+                if packetInfo is None:
+                    # the first lines may be the rest of a packet without its header line
+                    packetLine = self.pp.readPacketHex()
+                else:
+                    packetLine = self.pp.readPacketStart()
+            except Exception:
+                print("WARNING: packet decoder problem occurred on line %i, packet ignored" % (self.pp.debug_linesRead))
+                if self.stop_on_error:
+                    raise
+                continue
+
+            if packetLine is None:
+                if packetInfo is not None:
+                    yield (None, packetInfo)
+                return None
+
+            if packetLine[0] == 0 or packetInfo is None:
+                if packetInfo is not None:
+                    yield (None, packetInfo)
+                if skipped >= count:
+                    return packetLine
+
+                packetInfo = packetLine[4]
+                if len(packetInfo) > 0:
+                    skipped += 1
+
+    def decodeBatch(self, batch: List[List[tuple]]) -> Iterator[Tuple[bytearray, tuple]]:
+        """
+        Decodes and assembles a batch of packets read by readPacketHex.
+
+        If the batch cannot be decoded at once (e.g. a line with unexpected characters),
+        its lines are parsed again one by one, exactly as the scalar engine would.
+
+        Args:
+            batch: The lines of each packet of the batch.
+
+        Yields:
+            The same tuples as iterPackets.
+        """
+        try:
+            data = self.pp.decodeHex([line[1] for packetLines in batch for line in packetLines])
+            if len(data) != sum(line[2] for packetLines in batch for line in packetLines):
+                raise ValueError("unexpected amount of decoded data")
+        except ValueError:
+            yield from self.decodeBatchScalar(batch)
+            return
+
+        view = memoryview(data)
+        position = 0
+        for packetLines in batch:
+            decodedLines: List[Tuple[int, memoryview, tuple]] = []
+            for (c_offset, c_hex, c_length, c_line, c_additional) in packetLines:
+                decodedLines.append((c_offset, view[position:position+c_length], c_additional))
+                position += c_length
+
+            yield self.buildPacket(decodedLines)
+
+    def decodeBatchScalar(self, batch: List[List[tuple]]) -> Iterator[Tuple[bytearray, tuple]]:
+        """
+        Decodes a batch of packets line by line with the scalar parser.
+
+        Args:
+            batch: The lines of each packet of the batch.
+
+        Yields:
+            The same tuples as iterPackets.
+        """
+        for packetLines in batch:
+            decodedLines: List[Tuple[int, bytes, tuple]] = []
+            for (c_offset, c_hex, c_length, c_line, c_additional) in packetLines:
+                try:
+                    (linePosition, binBytes) = self.pp.parsePacketLine(c_line)
+                except Exception:
+                    print("WARNING: packet decoder problem occurred on line \"%s\", packet ignored" % (c_line,))
                     if self.stop_on_error:
                         raise
                     continue
+                if len(binBytes) > 0:
+                    decodedLines.append((linePosition, binBytes, c_additional))
 
-            if EOF or (offset == 0):  # extract the old packet
-                if len(self.packetLines) > 0: 
-                    packetLength = self.packetLines[-1][0] + len(self.packetLines[-1][1])
-                    binaryPacket = bytearray(packetLength)
-                    additionalInfo = ()
-    
-                    while len(self.packetLines) > 0:
-                        (c_offset, c_content, c_additional) = self.packetLines.popleft()
-                        if c_offset == 0:
-                            additionalInfo = c_additional # additional information is only in the first line of the packet
-                        binaryPacket[c_offset:c_offset+len(c_content)] = c_content
-    
-                    self.packets.append( (binaryPacket, additionalInfo) )
-                    if not EOF:
-                        self.packetLines.append( (offset, content, additional) )
-                    break
-
-            if not EOF:
-                self.packetLines.append( (offset, content, additional) )
-            if EOF:
-                break
-        
-        if EOF:
+            if len(decodedLines) > 0:
+                yield self.buildPacket(decodedLines)
+
+    def buildPacket(self, packetLines: List[Tuple[int, bytes, tuple]]) -> Tuple[Union[bytearray, memoryview], tuple]:
+        """
+        Assembles the collected lines of one packet.
+
+        Args:
+            packetLines: The (offset, content, additional) tuples of the packet lines.
+
+        Returns:
+            A tuple containing the packet (bytearray, or memoryview with reuse_buffer) and its additional information.
+        """
+        packetLength = packetLines[-1][0] + len(packetLines[-1][1])
+        if self.reuse_buffer:
+            packet = self.buildPacketInBuffer(packetLines, packetLength)
+            if packet is not None:
+                return packet
+
+        binaryPacket = bytearray(packetLength)
+        additionalInfo = ()
+
+        for (c_offset, c_content, c_additional) in packetLines:
+            if c_offset == 0:
+                additionalInfo = c_additional # additional information is only in the first line of the packet
+            binaryPacket[c_offset:c_offset+len(c_content)] = c_content
+
+        return (binaryPacket, additionalInfo)
+
+    def buildPacketInBuffer(self, packetLines: List[Tuple[int, bytes, tuple]], packetLength: int) -> Optional[Tuple[memoryview, tuple]]:
+        """
+        Assembles the collected lines of one packet in the reused buffer.
+
+        Args:
+            packetLines: The (offset, content, additional) tuples of the packet lines.
+            packetLength: The length of the packet, given by its last line.
+
+        Returns:
+            A tuple containing the memoryview of the packet and its additional information,
+            or None if some line reaches behind the last one (then a new bytearray is used).
+        """
+        if len(self.buffer) < packetLength:
+            # do not resize the buffer, views of the previous packets may still exist
+            self.buffer = bytearray(max(packetLength, 2 * len(self.buffer)))
+
+        buffer = self.buffer
+        additionalInfo = ()
+        written = 0
+        for (c_offset, c_content, c_additional) in packetLines:
+            c_end = c_offset + len(c_content)
+            if c_end > packetLength:
+                return None
+            if c_offset == 0:
+                additionalInfo = c_additional # additional information is only in the first line of the packet
+            if c_offset > written:
+                buffer[written:c_offset] = bytes(c_offset - written) # missing lines are zeros, as in a new bytearray
+            buffer[c_offset:c_end] = c_content
+            if c_end > written:
+                written = c_end
+
+        return (memoryview(buffer)[:packetLength], additionalInfo)
+
+    def assemblePacket(self) -> bool:
+        """
+        Assembles the next packet and puts it into the queue.
+
+        Returns:
+            True if a packet was assembled, False if EOF was reached and
+            no more packets can be assembled.
+        """
+        if self.packetIterator is None:
+            self.packetIterator = self.iterPackets()
+
+        packet = next(self.packetIterator, None)
+        if packet is None:
             return False
-        else:
-            return True
 
+        self.packets.append(packet)
+        return True
 
     def getPacketsCount(self) -> int:
         """
@@ -85,7 +323,7 @@ class PacketAssembler:
             The number of packets.
         """
         return len(self.packets)
-            
+
     def getPacket(self) -> Tuple[bytearray, tuple]:
         """
         Returns the next assembled packet from the queue.
@@ -94,7 +332,7 @@ class PacketAssembler:
             A tuple containing:
                 - binaryPacket (bytearray): The assembled packet data.
                 - additionalInfo (tuple): Additional info (timestamp, interface, etc.).
-        
+
         Raises:
             IndexError: If the queue is empty.
         """
@@ -1,13 +1,17 @@
+import os
 import sys
 import getopt
 import time
 import datetime
-import binascii
 from typing import Set, Optional
 
-from .parser import DataSource_File, PacketParser
-from .assembler import PacketAssembler
-from .writer import PcapNGWriter
+from .parser import DataSource_File, open_datasource, parse_timezone, ENGINES
+from .packets import iter_packets
+from .filter import PacketFilter
+from .formatter import PacketFormatter
+from .parallel import iter_formatted_parallel
+from .writer import PcapNGWriter, PcapWriter
+from .compression import compression_available, detect_file_compression, split_compression_suffix
 from .ipsec import IPSec
 
 class SnifTranCLI:
@@ -32,7 +36,9 @@ class SnifTranCLI:
         self.interfaces_exclude: Set[str] = set()
         self.interfaces_ptp: Set[str] = set()
         self.interfaces_nolink: Set[str] = set()
+        self.packet_filter: Optional[PacketFilter] = None
 
+        self.output_format: str = "pcapng"
         self.section_size: Optional[int] = None
         self.max_packets_in_file: Optional[int] = None
 
@@ -41,9 +47,14 @@ class SnifTranCLI:
         self.show_timestamps: bool = False
         self.normalize_lines: bool = True
         self.wireshark_ipsec: bool = True
+        self.ipsec_full_scan: bool = False
         self.stop_on_error: bool = False
         self.include_packet_line: bool = False
         self.show_progress: bool = False
+        self.use_mmap: bool = True
+        self.jobs: int = 1
+        self.timezone: str = "local"
+        self.engine: str = "scalar"
 
     def usage(self) -> None:
         """
@@ -58,20 +69,31 @@ class SnifTranCLI:
         message += "\n"
         message += "   mandatory parameters:\n"
         message += "    --in <inputfile>                   ... text file with captured packets, \"-in\" can be used for compatability\n"
+        message += "                                           can be compressed (gzip, bzip2, xz, zip or zstd), it is decompressed while reading\n"
         message += "\n"
         message += "   optional parameters:\n"
-        message += "    --out <outputfile>                 ... name of the output pcap file, by default <inputfile>.pcapng\n"
+        message += "    --out <outputfile>                 ... name of the output pcap file, by default <inputfile>.pcapng (or .pcap)\n"
+        message += "                                           with suffix .gz or .zst (requires zstandard) the output is compressed\n"
+        message += "    --format <format>                  ... output format: pcapng (default) or pcap (libpcap with nanosecond timestamps,\n"
+        message += "                                           one file per link type, without comments)\n"
         message += "    --no-overwrite                     ... do not overwrite the output file if it already exists\n"
         message += "    --no-compat                        ... disable the compatability with new FE and FAC sniffers outputs\n"
         message += "    --skip <number>                    ... skip first <number> packets\n"
-        message += "    --limit <number>                   ... save only <number> packets\n"
+        message += "    --limit <number>                   ... save only <number> packets, the input file is read no further\n"
         message += "    --no-checks                        ... disable packet integrity checks\n"
         message += "    --no-normalize-lines               ... do not try to normalize packet lines before parsing them\n"
         message += "    --no-wireshark-ipsec               ... do not update Wireshark config file with found IPSec tunnels\n"
+        message += "    --ipsec-full-scan                  ... with --limit, read the rest of the input file for IPSec tunnels too\n"
         message += "    --include <interface>              ... save only packets from/to this interface (can be used multiple times)\n"
         message += "    --exclude <interface>              ... ignore packets from/to this interface (can be used multiple times)\n"
+        message += "    --filter <expression>              ... save only packets matching the expression, e.g. \"tcp port 443 and not host 10.0.0.1\"\n"
+        message += "                                           (host, net, port, proto, tcp, udp, icmp, ip, ip6, arp, src/dst, and/or/not)\n"
         message += "    --p2p <interface>                  ... mark interface as point-to-point, will try to correctly remove artifical ethernet header\n"
         message += "    --nolink <interface>               ... for this interface, do not expect any link layer information (for sniffer with parameter 5)\n"
+        message += "    --no-mmap                          ... read a plain text input file in text mode instead of memory-mapping it\n"
+        message += "    --jobs <number>                    ... parse the input file in <number> parallel processes, default 1\n"
+        message += "    --engine <engine>                  ... hex decoding engine: scalar (default), batch or numpy (requires NumPy)\n"
+        message += "    --timezone <tz>                    ... timezone of absolute timestamps: local (default), utc, +HH:MM or name like Europe/Prague\n"
         message += "\n"
         message += "   pcapng parameters:\n"
         message += "    --section-size <number>            ... amount if packets in one SHB, default unlimited (Wireshark does not support anything else!)\n"
@@ -114,9 +136,9 @@ class SnifTranCLI:
         # first get options from user
         try:
             opts, args = getopt.getopt(sys.argv[paramsStartFrom:], "h", 
-                         ["help", "in=", "out=", "no-overwrite", "no-compat", "skip=", "limit=", "no-checks", "include=", "exclude=", "p2p=", "nolink=", "no-normalize-lines",
-                              "section-size=", "max-packets=",
-                              "no-wireshark-ipsec",
+                         ["help", "in=", "out=", "no-overwrite", "no-compat", "skip=", "limit=", "no-checks", "include=", "exclude=", "filter=", "p2p=", "nolink=", "no-normalize-lines", "no-mmap", "jobs=", "timezone=", "engine=",
+                              "format=", "section-size=", "max-packets=",
+                              "no-wireshark-ipsec", "ipsec-full-scan",
                               "debug=", "show-packets", "show-timestamps", "stop-on-error", "include-packet-line", "progress"])
         except getopt.GetoptError as err:
             print(str(err)) # will print something like "option -a not recognized"
@@ -145,10 +167,26 @@ class SnifTranCLI:
                 self.interfaces_include.add(a)
             elif o in ("--exclude",):
                 self.interfaces_exclude.add(a)
+            elif o in ("--filter",):
+                try:
+                    self.packet_filter = PacketFilter(a)
+                except ValueError as err:
+                    sys.stderr.write("ERROR: %s\n" % (err,))
+                    sys.exit(2)
             elif o in ("--p2p",):
                 self.interfaces_ptp.add(a)
             elif o in ("--nolink",):
                 self.interfaces_nolink.add(a)
+            elif o in ("--no-mmap",):
+                self.use_mmap = False
+            elif o in ("--jobs",):
+                self.jobs = max(1, int(a))
+            elif o in ("--timezone",):
+                self.timezone = a
+            elif o in ("--engine",):
+                self.engine = a
+            elif o in ("--format",):
+                self.output_format = a
             elif o in ("--section-size",):
                 self.section_size = int(a)
             elif o in ("--max-packets",):
@@ -163,6 +201,8 @@ class SnifTranCLI:
                 self.normalize_lines = False
             elif o in ("--no-wireshark-ipsec",):
                 self.wireshark_ipsec = False
+            elif o in ("--ipsec-full-scan",):
+                self.ipsec_full_scan = True
             elif o in ("--stop-on-error",):
                 self.stop_on_error = True
             elif o in ("--include-packet-line",):
@@ -173,8 +213,11 @@ class SnifTranCLI:
                 assert False, "unhandled option"
 
         # configure some additional defaults
+        input_compression = detect_file_compression(self.input_file) if self.input_file else None
         if not self.output_file and self.input_file:
-            self.output_file = "%s.pcapng" % (self.input_file,)
+            # "capture.txt.gz" is converted to "capture.txt.pcapng"
+            input_name = os.path.splitext(self.input_file)[0] if input_compression else self.input_file
+            self.output_file = "%s.%s" % (input_name, self.output_format,)
         
         # make sure all required parameters are present and correct
         if not self.input_file: 
@@ -182,6 +225,34 @@ class SnifTranCLI:
             self.usage()
             sys.exit(2)
 
+        if self.output_format not in ("pcapng", "pcap"):
+            sys.stderr.write("ERROR: unknown output format \"%s\", use pcapng or pcap\n" % (self.output_format,))
+            sys.exit(2)
+
+        (_, _, compression) = split_compression_suffix(self.output_file)
+        if not compression_available(compression):
+            sys.stderr.write("ERROR: %s compression of the output file requires the zstandard module\n" % (compression,))
+            sys.exit(2)
+
+        if input_compression == "zstd" and not compression_available(input_compression):
+            sys.stderr.write("ERROR: zstd compressed input file requires the zstandard module\n")
+            sys.exit(2)
+
+        # compressed input is read as one stream, it cannot be split between the jobs
+        if self.jobs > 1 and input_compression is not None:
+            print("WARNING: input file is compressed, it cannot be parsed in parallel, using 1 job")
+            self.jobs = 1
+
+        if self.engine not in ENGINES:
+            sys.stderr.write("ERROR: unknown engine \"%s\", use one of: %s\n" % (self.engine, ", ".join(ENGINES),))
+            sys.exit(2)
+
+        try:
+            parse_timezone(self.timezone)
+        except ValueError as err:
+            sys.stderr.write("ERROR: %s\n" % (err,))
+            sys.exit(2)
+
         # check the existence of the output file
         exists = True
         try:
@@ -199,6 +270,7 @@ class SnifTranCLI:
             print("DEBUG: parameters in use:")
             print("DEBUG:   input file: %s" % (self.input_file,))
             print("DEBUG:   output file: %s" % (self.output_file,))
+            print("DEBUG:   output format: %s" % (self.output_format,))
             print("DEBUG:   allow output file overwrite: %s" % (self.overwrite,))
             print("DEBUG:   FE and FAD compatibility mode: %s" % (self.compat_mode,))
             print("DEBUG:   skip packets: %i" % (self.skip_packets,))
@@ -208,8 +280,13 @@ class SnifTranCLI:
             print("DEBUG:   normalize lines: %s" % (self.normalize_lines,))
             print("DEBUG:   include interfaces: \"%s\"" % ("\", \"".join(self.interfaces_include),))
             print("DEBUG:   exclude interfaces: \"%s\"" % ("\", \"".join(self.interfaces_exclude),))
+            print("DEBUG:   packet filter: %s" % (self.packet_filter.expression if self.packet_filter else "none",))
             print("DEBUG:   p2p interfaces: \"%s\"" % ("\", \"".join(self.interfaces_ptp),))
             print("DEBUG:   nolink interfaces: \"%s\"" % ("\", \"".join(self.interfaces_nolink),))
+            print("DEBUG:   memory-mapped input: %s" % (self.use_mmap,))
+            print("DEBUG:   parallel jobs: %i" % (self.jobs,))
+            print("DEBUG:   timezone: %s" % (self.timezone,))
+            print("DEBUG:   hex decoding engine: %s" % (self.engine,))
             if self.section_size: print("DEBUG:   section size: %i" % (self.section_size,))
             else: print("DEBUG:   section size: unlimited")
             if self.max_packets_in_file: print("DEBUG:   max packets in file: %i" % (self.max_packets_in_file,))
@@ -218,6 +295,7 @@ class SnifTranCLI:
             print("DEBUG:   show packets: %s" % (self.show_packets,))
             print("DEBUG:   show timestamps: %s" % (self.show_timestamps,))
             print("DEBUG:   process ipsec for wireshark: %s" % (self.wireshark_ipsec,))
+            print("DEBUG:   scan whole file for ipsec tunnels: %s" % (self.ipsec_full_scan,))
             print("DEBUG:   stop on error: %s" % (self.stop_on_error,))
             print("DEBUG:   include packet line: %s" % (self.include_packet_line,))
             print("DEBUG:   show progress: %s" % (self.show_progress,))
@@ -227,11 +305,11 @@ class SnifTranCLI:
         Execute the main packet conversion process.
 
         This method:
-        1. Initializes the data source, parser, assembler, and writer.
-        2. Reads packets from the input file.
-        3. Assembles them into full packets.
-        4. Writes them to the output PCAPng file.
-        5. Optionally handles IPSec tunnel discovery and Wireshark configuration.
+        1. Initializes the data source and the writer.
+        2. Iterates over the packets assembled from the input file, either in this
+           process or in a pool of --jobs worker processes.
+        3. Writes each of them to the output PCAPng (or libpcap) file right away.
+        4. Optionally configures Wireshark with the IPSec tunnels found in the same pass.
         """
         #timestamp_start = int (datetime.datetime.now().strftime("%s"))
         # the above expression does not work on Windows :(
@@ -239,213 +317,106 @@ class SnifTranCLI:
         if self.show_timestamps:
             print("DEBUG: processing started at %i, referred as T" % (timestamp_start,))
 
-        ds = DataSource_File(self.input_file)
+        if self.output_format == "pcap":
+            pcap = PcapWriter(outfile = self.output_file, max_in_file = self.max_packets_in_file, debug=self.debug)
+        else:
+            pcap = PcapNGWriter(outfile = self.output_file, max_in_file = self.max_packets_in_file, section_size = self.section_size, debug=self.debug)
+        formatter = PacketFormatter(interfaces_include = self.interfaces_include, interfaces_exclude = self.interfaces_exclude,
+                                    interfaces_ptp = self.interfaces_ptp, interfaces_nolink = self.interfaces_nolink,
+                                    check_packet_size = self.check_packet_size, include_packet_line = self.include_packet_line,
+                                    show_packets = self.show_packets, packet_filter = self.packet_filter, debug = self.debug)
 
-        pp = PacketParser(datasource = ds, compatible=self.compat_mode, normalize_lines=self.normalize_lines)
-        pc = PacketAssembler(packetparser = pp, stop_on_error=self.stop_on_error)
-        pcap = PcapNGWriter(outfile = self.output_file, max_in_file = self.max_packets_in_file, debug=self.debug)
-        
-        
-        ifaces_blocks = {}   # holds reusable block of interfaces - key is the index in pcap
-        ifaces_block = b""
-        ifaces = set() # holds all known interfaces
-        
-        packets_assembled = 0
         packets_read = 0
         packets_formated = 0
-        
-        while True:
-            eof = False
-        
-            # first assemble preconfigured amount of packets
-            if self.debug >= 2:
-                print("DEBUG: assembling packets from input file")
-            if self.show_timestamps: 
-                timestart_start_assembling = int(time.mktime(datetime.datetime.now().timetuple()))
-                print("DEBUG: assembling started at %i, T+%i" % (timestart_start_assembling, timestart_start_assembling-timestamp_start))
-
-            packets_assembled_in_section = 0
-            while True:
-                if self.section_size and (packets_assembled_in_section >= self.section_size):
-                    break
-        
-                eof = not pc.assemblePacket()
-                packets_assembled += 1
-                packets_assembled_in_section += 1
-                if (self.debug >= 3) and (packets_assembled % 10000 == 0):
-                    print("DEBUG: assembled %i packets" % (packets_assembled,))
-
-                # display progress if requested
-                if self.show_progress and packets_assembled % 1000 == 0: 
-                    progress_current = pp.debug_bytesRead * 100 / pp.sourcefile_size
-                    if 'progress_last' not in vars():
-                        progress_last = None
-                    if progress_current != progress_last:
-                        sys.stdout.write("PROGRESS: assembling: %3i %%\r" % (pp.debug_bytesRead * 100 / pp.sourcefile_size))
-                        sys.stdout.flush()
-                        progress_last = progress_current
-        
-                if eof:
-                    break
-            if self.debug >= 2:
-                print("DEBUG: assembled %i packets totally, %i in current section" % (packets_assembled, packets_assembled_in_section,))
-            
-            # then go through all of them, and
-            # - extract the interface name (to see whenther we need to define a new iface in pcap)
-            # - move packet to the local list called "packets"
-            current_ifaces = set()  # holds a set of interfaces used in this part of the capture
-            binary_packets = []
-        
-            if self.debug >= 2:
-                print("DEBUG: reading packets")
-            if self.show_timestamps: 
-                timestart_start_reading = int(time.mktime(datetime.datetime.now().timetuple()))
-                print("DEBUG: reading started at %i, T+%i" % (timestart_start_reading, timestart_start_reading-timestamp_start))
+        packets_written = 0
+        packets_truncated = 0
+
+        progress_last = None
+        def show_progress(bytes_read: int, bytes_total: int) -> None:
+            nonlocal progress_last
+            if bytes_total == 0:
+                return
+            progress_current = int(bytes_read * 100 / bytes_total)
+            if progress_current != progress_last:
+                sys.stdout.write("PROGRESS: converting: %3i %%\r" % (progress_current,))
+                sys.stdout.flush()
+                progress_last = progress_current
+
+        if self.debug >= 2:
+            print("DEBUG: converting packets from input file")
+
+        # IPSec tunnels are collected from the non-packet lines while the packets are parsed
+        ipsec = None
+        if self.wireshark_ipsec:
+            ipsec = IPSec(sourcefile = self.input_file, debug=self.debug, show_progress=self.show_progress)
 
-            packets_read_in_section = 0
-            while True:
-                try:
-                    (packetBytes, additionalInfo) = pc.getPacket()
-                except IndexError:
-                    break
+        parser_options = dict(compatible=self.compat_mode, normalize_lines=self.normalize_lines, stop_on_error=self.stop_on_error,
+                              timezone=parse_timezone(self.timezone), engine=self.engine)
+        ds = None
+        skip_packets = self.skip_packets
+        if self.jobs > 1:
+            formatted = iter_formatted_parallel(self.input_file, self.jobs, formatter, debug=self.debug, ipsec=ipsec,
+                                                progress=show_progress if self.show_progress else None, **parser_options)
+        else:
+            if self.use_mmap or detect_file_compression(self.input_file) is not None:
+                # compressed input is always decompressed as a stream, the text mode is for plain files only
+                ds = open_datasource(self.input_file)
+            else:
+                ds = DataSource_File(self.input_file)
+            # packets from other interfaces and the skipped packets are only scanned for their boundaries,
+            # the parser stops at the limit (the packet filter needs the data, so then they are counted here)
+            push_down = self.packet_filter is None
+            formatted = formatter.iterFormatted(iter_packets(ds, progress=show_progress if self.show_progress else None, reuse_buffer=True,
+                                                             line_observer=ipsec.feedLine if ipsec else None,
+                                                             skip=self.skip_packets if push_down else 0,
+                                                             limit=(self.limit_packets or None) if push_down else None,
+                                                             interface_filter=formatter.accepts, **parser_options))
+            if push_down:
+                skip_packets = 0
+
+        parsed_all = True
+        for (iface_name, iface_type, block) in formatted:
+            packets_read += 1
+            if packets_read <= skip_packets:
+                continue
+
+            # packets failing the integrity checks come without any block
+            if block is not None:
+                pcap.writeEnhancedPacket(block, iface=iface_name, linktype=iface_type)
+                packets_written += 1
+            else:
+                packets_truncated += 1
 
-                try:
-                    iface = additionalInfo[2]
-                    if (len(self.interfaces_include) > 0) and (iface not in self.interfaces_include):
-                        continue
-                    if (len(self.interfaces_exclude) > 0) and (iface in self.interfaces_exclude):
-                        continue
-                    current_ifaces.add(iface)
-                    timestamp = additionalInfo[0] * 1000000 + additionalInfo[1]  # convert seconds and useconds to one large us number
-                    comment = "(%s)%s%s" % (additionalInfo[3], " "*(4-len(additionalInfo[3])), additionalInfo[2],) # comment contains the direction of the packet and the interface
-                    if self.include_packet_line:
-                        comment += "  %5i" % (additionalInfo[4],)
-                    binary_packets.append( (iface, timestamp, comment, packetBytes,) )
-                    packets_read += 1
-                    packets_read_in_section += 1
-                    if (self.debug >= 3) and (packets_read % 10000 == 0):
-                        print("DEBUG: prepared %i packets" % (packets_read,))
-                except IndexError:
-                    print("WARNING: invalid data for packet %i, ignoring" % (packets_read+1,))
-                    continue
-
-            if self.debug >= 2:
-                print("DEBUG: read packets %i totally, %i in current section" % (packets_read, packets_read_in_section,))
-        
-            if self.debug >= 2:
-                print("DEBUG: looking for yet unknown interfaces")
-            if self.show_timestamps: 
-                timestart_start_interfaces = int(time.mktime(datetime.datetime.now().timetuple()))
-                print("DEBUG: interfaces lookup started at %i, T+%i" % (timestart_start_interfaces, timestart_start_interfaces-timestamp_start))
-
-            # for new interfaces, create a pcap interface block
-            for new_iface in (current_ifaces-ifaces):
-                new_index = len(ifaces_blocks)
-                iface_type = pcap.LINKTYPE_ETHERNET
-
-                # if this interface is marked as point-to-point, make it also in pcap interface description
-                if new_iface in self.interfaces_ptp:
-                    iface_type = pcap.LINKTYPE_NULL
-
-                # if this interface is marked as nolink, do not modify the packet, but mark as RAW (layer 3)
-                if new_iface in self.interfaces_nolink:
-                    iface_type = pcap.LINKTYPE_RAW
-
-                ifaces_blocks[new_iface] = { 'index' : new_index, 'block' : pcap.blockInterfaceDescription(new_iface, iface_type) }
-                if self.debug >= 3:
-                    print("DEBUG: new iface found: \"%s\", assigning index %i" % (new_iface, ifaces_blocks[new_iface]['index'],))
-            if self.debug >= 2:
-                print("DEBUG: found %i new interfaces" % (len(current_ifaces-ifaces),))
-        
-            # if the amount of interfaces has changed, rebuild the block
-            if len(current_ifaces - ifaces) > 0:
-                if self.debug >= 2:
-                    print("DEBUG: rebuilding interfaces block")
-                for iface in sorted(ifaces_blocks, key=lambda x: ifaces_blocks[x]['index']):
-                    #print "new interface: ", iface, ifaces_blocks[iface]
-                    ifaces_block += ifaces_blocks[iface]['block']
-        
-            ifaces |= current_ifaces   # copy new interfaces to known ifaces
-        
-            # prepare the packets block
-            if self.debug >= 2:
-                print("DEBUG: formating packets")
-            if self.show_timestamps: 
-                timestart_start_formating = int(time.mktime(datetime.datetime.now().timetuple()))
-                print("DEBUG: packet formating started at %i, T+%i" % (timestart_start_formating, timestart_start_formating-timestamp_start))
-
-            packets_formated_in_section = 0
-            ignore_packets = 0
-            blockPackets = []
-            for i in range(self.skip_packets, len(binary_packets)):
-                (iface_name, timestamp, comment, packetBytes) = binary_packets[i]
-                if self.show_packets:
-                    print("DEBUG: packet: iface=\"%s\", timestamp=\"%s\", comment=\"%s\", binary: \"%s\"" % (
-                                           iface_name, timestamp, comment, binascii.hexlify(packetBytes)))
-
-                # if this interface is marked as point-to-point, remove artificial ethernet header
-                if iface_name in self.interfaces_ptp:
-                    packetBytes = packetBytes[10:]  # remove 6 bytes for src and 6 byte for dst MAC, keep 2 byte protocol ("ethertype") 
-                    packetBytes[0] = 0              # however,  because LINKTYPE_NULL is used as L2 and it needs first 4 bytes for protocl
-                    packetBytes[1] = 0              # we need to prepend another 2 bytes (0x0) to ethertype
-        
-                # if allowed, check whether the packet has the right size
-                # - currently only IPv4 over ethernet is supported
-                if self.check_packet_size:
-                    ethertype = "0x%02x%02x" % (packetBytes[12], packetBytes[13],)
-                    if ethertype == "0x0800": 
-                        totallength = int("0x%02x%02x" % (packetBytes[16], packetBytes[17],), 16)
-                        if totallength+14 > len(packetBytes):
-                            print("WARNING: packet #%i is not complete, ignoring" % (packets_formated+1,))
-                            if self.debug >= 3:
-                                print("DEBUG: packet size from IP header %i, (%i including ethernet) total packet size %i" % (totallength, totallength+14, len(packetBytes),))
-                            ignore_packets = 1
-        
-                if ignore_packets > 0:
-                    ignore_packets -= 1
-                else:
-                    blockPackets.append(pcap.blockEnhancedPacket(packetBytes, timestamp=timestamp, ifaceIndex=ifaces_blocks[iface_name]['index'], comment=comment))
-        
-                packets_formated += 1
-                packets_formated_in_section += 1
-                if (self.debug >= 3) and (packets_formated % 10000 == 0):
-                    print("DEBUG: formated %i packets" % (packets_formated,))
-
-                if self.show_progress and packets_formated % 1000 == 0:
-                    progress_current = i * 100 / len(binary_packets)
-                    if 'progress_last' not in vars():
-                        progress_last = None
-                    if progress_current != progress_last:
-                        sys.stdout.write("PROGRESS: formating: %3i %%\r" % (progress_current,))
-                        sys.stdout.flush()
-                        progress_last = progress_current
-
-                if self.limit_packets and (packets_formated >= self.limit_packets):
-                    break
-            if self.debug >= 2:
-                print("DEBUG: formated %i packets totally, %i in current section" % (packets_formated, packets_formated_in_section,))
-        
-            # now create a new section with interfaces and the packets we have collected in this block
-            if self.debug >= 2:
-                print("DEBUG: saving current section into the output file")
-            if self.show_timestamps: 
-                timestart_start_saving = int(time.mktime(datetime.datetime.now().timetuple()))
-                print("DEBUG: packet saving started at %i, T+%i" % (timestart_start_saving, timestart_start_saving-timestamp_start))
+            packets_formated += 1
+            if (self.debug >= 3) and (packets_formated % 10000 == 0):
+                print("DEBUG: formated %i packets" % (packets_formated,))
 
-            pcap.writePackets(ifaces_block, blockPackets)
-        
-            # if that was the last packet, we can finish here
-            if eof:
+            if self.limit_packets and (packets_formated >= self.limit_packets):
+                formatted.close()
+                parsed_all = False
                 break
 
-        # if wireshark SA check is enabled
-        if self.wireshark_ipsec:
+        pcap.close()
+        if ds is not None:
+            ds.close()
+
+        if ipsec is not None and not parsed_all and self.ipsec_full_scan:
+            # the rest of the file was not parsed because of --limit, it can still contain tunnels
             if self.show_timestamps: 
                 timestart_start_ipsec = int(time.mktime(datetime.datetime.now().timetuple()))
                 print("DEBUG: ipsec SA lookup started at %i, T+%i" % (timestart_start_ipsec, timestart_start_ipsec-timestamp_start))
 
             ipsec = IPSec(sourcefile = self.input_file, debug=self.debug, show_progress=self.show_progress)
             ipsec.find_tunnels()
+
+        if packets_truncated > 0:
+            print("WARNING: %i packets were not complete, ignoring them (--debug 3 shows their lines)" % (packets_truncated,))
+        if self.debug >= 2:
+            print("DEBUG: read %i packets, formated %i packets, written %i packets, truncated %i packets" % (
+                                   packets_read, packets_formated, packets_written, packets_truncated,))
+
+        # if wireshark SA check is enabled
+        if ipsec is not None and self.wireshark_ipsec:
             ipsec.configure_wireshark()
 
         if self.show_timestamps: 
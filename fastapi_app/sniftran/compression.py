@@ -0,0 +1,213 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import stat
+import zipfile
+import zlib
+from typing import BinaryIO, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compressions of the output, by the suffix of the output file name
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+# first bytes of the compressed streams, the input can be any of them, the output gzip or zstd
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+    b"BZh": "bzip2",
+    b"\xfd7zXZ\x00": "xz",
+    b"PK\x03\x04": "zip",
+}
+
+# the output is compressed while the packets are converted, so prefer speed over ratio
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# the decompressed input is read line by line through a buffer of this size,
+# so each line is cut out in C instead of calling into the decompressor
+DECOMPRESSED_BUFFER_SIZE = 1024 * 1024
+
+
+def compression_available(compression: Optional[str]) -> bool:
+    """
+    Checks whether the compression can be used.
+
+    Args:
+        compression: "gzip", "zstd" or None for no compression.
+
+    Returns:
+        False for unknown compressions and for zstd without the zstandard module.
+    """
+    if compression == "zstd":
+        return zstandard is not None
+    return compression in (None, "gzip")
+
+
+def split_compression_suffix(filename: str) -> Tuple[str, str, Optional[str]]:
+    """
+    Splits the compression suffix from a file name.
+
+    Args:
+        filename: File name, e.g. "out.pcapng.gz".
+
+    Returns:
+        The name without the suffix, the suffix and the compression, e.g. ("out.pcapng", ".gz", "gzip"),
+        or the unchanged name, an empty suffix and None.
+    """
+    for (suffix, compression) in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return (filename[:-len(suffix)], suffix, compression)
+    return (filename, "", None)
+
+
+def detect_compression(data: bytes) -> Optional[str]:
+    """
+    Recognizes compressed data by its first bytes.
+
+    Args:
+        data: At least the first 4 bytes of the data.
+
+    Returns:
+        The compression, or None for uncompressed data.
+    """
+    for (magic, compression) in COMPRESSION_MAGIC.items():
+        if data[:len(magic)] == magic:
+            return compression
+    return None
+
+
+def detect_file_compression(filename: str) -> Optional[str]:
+    """
+    Recognizes a compressed file by its first bytes.
+
+    Args:
+        filename: The path to the file.
+
+    Returns:
+        The compression, or None for uncompressed files and for anything else than
+        regular files (reading from a pipe or fifo would consume the data).
+    """
+    try:
+        if not stat.S_ISREG(os.stat(filename).st_mode):
+            return None
+        with open(filename, "rb") as f:
+            return detect_compression(f.read(6))
+    except OSError:
+        return None
+
+
+def open_compressed_input(f: BinaryIO, compression: str) -> BinaryIO:
+    """
+    Opens a streaming decompressor reading from a binary file object.
+
+    Zip archives are expected to contain just the sniffer output, only the
+    first file in the archive is read.
+
+    Args:
+        f: The file object with the compressed data, positioned at the beginning.
+        compression: "gzip", "zstd", "bzip2", "xz" or "zip".
+
+    Returns:
+        Readable binary file with the decompressed data, supporting readline.
+        Closing it does not close f.
+
+    Raises:
+        ValueError: If the compression is not supported or available, or the zip archive is empty.
+    """
+    if compression == "gzip":
+        stream = gzip.GzipFile(fileobj=f, mode="rb")
+    elif compression == "bzip2":
+        stream = bz2.BZ2File(f, "rb")
+    elif compression == "xz":
+        stream = lzma.LZMAFile(f, "rb")
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compressed input requires the zstandard module")
+        stream = zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+    elif compression == "zip":
+        archive = zipfile.ZipFile(f)
+        members = [member for member in archive.infolist() if not member.is_dir()]
+        if len(members) == 0:
+            raise ValueError("zip archive does not contain any file")
+        if len(members) > 1:
+            print("WARNING: zip archive contains %i files, reading only \"%s\"" % (len(members), members[0].filename,))
+        stream = archive.open(members[0])
+    else:
+        raise ValueError("unsupported compression \"%s\"" % (compression,))
+    return io.BufferedReader(stream, DECOMPRESSED_BUFFER_SIZE)
+
+
+def open_compressed_output(filename: str, compression: Optional[str]) -> BinaryIO:
+    """
+    Opens an output file, writing through a streaming compressor.
+
+    Args:
+        filename: The path to the output file.
+        compression: "gzip", "zstd" or None for no compression.
+
+    Returns:
+        Writable binary file, closing it finishes the compressed stream and closes the file.
+
+    Raises:
+        ValueError: If the compression is not available.
+    """
+    if not compression_available(compression):
+        raise ValueError("compression \"%s\" is not available" % (compression,))
+    if compression == "gzip":
+        return gzip.open(filename, "wb", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        return zstandard.open(filename, "wb", cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
+    return open(filename, "wb")
+
+
+def compressed_writer(f: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    """
+    Wraps a writable binary file object in a streaming compressor.
+
+    Args:
+        f: The file object receiving the compressed stream (e.g. io.BytesIO).
+        compression: "gzip", "zstd" or None for no compression.
+
+    Returns:
+        Writable binary file, closing it finishes the compressed stream but leaves f open.
+        Without compression f itself.
+
+    Raises:
+        ValueError: If the compression is not available.
+    """
+    if not compression_available(compression):
+        raise ValueError("compression \"%s\" is not available" % (compression,))
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=False)
+    return f
+
+
+def decompress_prefix(data: bytes, size: int = 64) -> bytes:
+    """
+    Decompresses the beginning of compressed data, e.g. to find out what is inside.
+
+    Args:
+        data: Data, compressed or not.
+        size: Wanted amount of decompressed bytes.
+
+    Returns:
+        At most size first bytes of the decompressed data, the data itself if it is not compressed.
+    """
+    compression = detect_compression(data)
+    try:
+        if compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data[:4096], size)
+        if compression == "zstd" and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data[:4096])[:size]
+    except Exception:
+        # damaged stream, nothing can be recognized
+        return b""
+    return data[:size]
@@ -0,0 +1,385 @@
+import ipaddress
+import re
+import struct
+from typing import Callable, List, Optional, Tuple, Union
+
+# ethertypes understood by the filter, VLAN tags and PPPoE sessions are skipped to the IP header
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_PPPOE_SESSION = 0x8864
+VLAN_ETHERTYPES = (0x8100, 0x88A8, 0x9100)
+PPP_PROTOCOLS = {0x0021: ETHERTYPE_IPV4, 0x0057: ETHERTYPE_IPV6}
+
+# IP protocol numbers accepted by "proto", the first five are also primitives on their own
+PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17, "icmp6": 58, "sctp": 132, "igmp": 2, "gre": 47, "esp": 50, "ah": 51, "ospf": 89}
+PORT_PROTOCOLS = (6, 17, 132)
+# IPv6 extension headers skipped on the way to the transport header
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+
+# ver/ihl, flags/fragment offset, protocol, source, destination
+IPV4_HEADER = struct.Struct(">B5xHxB2xII")
+# hardware type, protocol type, hardware size, protocol size
+ARP_HEADER = struct.Struct(">HHBB")
+PORTS = struct.Struct(">HH")
+
+# the decoded headers: (ethertype, IP protocol, source address, destination address, source port, destination port),
+# addresses are integers, fields that the packet does not have are None
+Headers = Tuple[int, Optional[int], Optional[int], Optional[int], Optional[int], Optional[int]]
+NO_HEADERS: Headers = (0, None, None, None, None, None)
+
+Predicate = Callable[[Headers], bool]
+
+TOKENS = re.compile(r"\s*(\(|\)|!|&&|\|\||[^\s()!&|]+)")
+# the binary operators, of the same priority
+AND_OPERATORS = ("and", "&&")
+OR_OPERATORS = ("or", "||")
+
+
+def decode_headers(data: Union[bytes, bytearray, memoryview], raw: bool = False) -> Headers:
+    """
+    Decodes the fields of the L2/L3/L4 headers the filter expressions can test.
+
+    Args:
+        data: The packet, starting with the ethernet header (or the IP header when raw).
+        raw: Whether the packet has no link layer header (LINKTYPE_RAW).
+
+    Returns:
+        The headers tuple, NO_HEADERS for packets too short to have an ethertype.
+    """
+    length = len(data)
+    if raw:
+        if length < 1:
+            return NO_HEADERS
+        version = data[0] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else 0
+        offset = 0
+    else:
+        if length < 14:
+            return NO_HEADERS
+        ethertype = (data[12] << 8) | data[13]
+        offset = 14
+        while ethertype in VLAN_ETHERTYPES and length >= offset + 4:
+            ethertype = (data[offset+2] << 8) | data[offset+3]
+            offset += 4
+        if ethertype == ETHERTYPE_PPPOE_SESSION and length >= offset + 8:
+            ethertype = PPP_PROTOCOLS.get((data[offset+6] << 8) | data[offset+7], ethertype)
+            offset += 8
+
+    if ethertype == ETHERTYPE_IPV4:
+        if length < offset + 20:
+            return (ethertype, None, None, None, None, None)
+        (versionLength, fragment, proto, src, dst) = IPV4_HEADER.unpack_from(data, offset)
+        transport = offset + (versionLength & 0x0F) * 4
+        # only the first fragment has the ports
+        if proto not in PORT_PROTOCOLS or (fragment & 0x1FFF) != 0 or length < transport + 4:
+            return (ethertype, proto, src, dst, None, None)
+        (sport, dport) = PORTS.unpack_from(data, transport)
+        return (ethertype, proto, src, dst, sport, dport)
+
+    if ethertype == ETHERTYPE_IPV6:
+        if length < offset + 40:
+            return (ethertype, None, None, None, None, None)
+        proto = data[offset+6]
+        src = int.from_bytes(data[offset+8:offset+24], "big")
+        dst = int.from_bytes(data[offset+24:offset+40], "big")
+        transport = offset + 40
+        while proto in IPV6_EXTENSION_HEADERS and length >= transport + 8:
+            proto = data[transport]
+            transport += (data[transport+1] + 1) * 8
+        if proto == IPV6_FRAGMENT_HEADER and length >= transport + 8:
+            fragment = (data[transport+2] << 8) | data[transport+3]
+            proto = data[transport]
+            transport += 8
+            if (fragment & 0xFFF8) != 0:
+                return (ethertype, proto, src, dst, None, None)
+        if proto not in PORT_PROTOCOLS or length < transport + 4:
+            return (ethertype, proto, src, dst, None, None)
+        (sport, dport) = PORTS.unpack_from(data, transport)
+        return (ethertype, proto, src, dst, sport, dport)
+
+    if ethertype == ETHERTYPE_ARP and length >= offset + 28:
+        (hardwareType, protocolType, hardwareSize, protocolSize) = ARP_HEADER.unpack_from(data, offset)
+        if protocolType == ETHERTYPE_IPV4 and hardwareSize == 6 and protocolSize == 4:
+            # sender and target protocol address
+            src = int.from_bytes(data[offset+14:offset+18], "big")
+            dst = int.from_bytes(data[offset+24:offset+28], "big")
+            return (ethertype, None, src, dst, None, None)
+
+    return (ethertype, None, None, None, None, None)
+
+
+class PacketFilter:
+    """
+    Packet filter expression, a subset of the tcpdump (BPF) syntax.
+
+    Supported primitives are "[src|dst] host <address>", "[src|dst] net <network/prefix>",
+    "[tcp|udp] [src|dst] port <number>", "proto <name|number>" and "ip", "ip6", "arp",
+    "tcp", "udp", "icmp", "icmp6", combined by "and" ("&&"), "or" ("||"), "not" ("!")
+    and parentheses. IPv4 and IPv6 addresses can be used, "host" and "net" with an
+    IPv4 address also match the sender/target addresses of ARP packets.
+
+    The expression is compiled once into nested predicates over the decoded headers
+    (see decode_headers). Only the expression is pickled, so the filter can be sent to
+    the worker processes of the parallel engine together with the formatter.
+    """
+    def __init__(self, expression: str):
+        """
+        Initialize the PacketFilter.
+
+        Args:
+            expression: The filter expression, e.g. "tcp port 443 and not host 10.0.0.1".
+
+        Raises:
+            ValueError: If the expression cannot be parsed.
+        """
+        self.expression = expression
+        self.predicate = self.compile(expression)
+
+    def __getstate__(self) -> dict:
+        # the predicates are closures, which cannot be pickled, they are compiled again instead
+        return {"expression": self.expression}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["expression"])
+
+    def __repr__(self) -> str:
+        return "PacketFilter(%r)" % (self.expression,)
+
+    def matches(self, data: Union[bytes, bytearray, memoryview], raw: bool = False) -> bool:
+        """
+        Checks whether the packet matches the expression.
+
+        Args:
+            data: The packet, starting with the ethernet header (or the IP header when raw).
+            raw: Whether the packet has no link layer header.
+
+        Returns:
+            True if the packet should be kept.
+        """
+        return self.predicate(decode_headers(data, raw))
+
+    def compile(self, expression: str) -> Predicate:
+        """
+        Parses the expression into a predicate over the decoded headers.
+
+        Args:
+            expression: The filter expression.
+
+        Returns:
+            The predicate.
+
+        Raises:
+            ValueError: If the expression cannot be parsed.
+        """
+        self.tokens: List[str] = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            g = TOKENS.match(expression, position)
+            if not g:
+                raise ValueError("invalid filter expression \"%s\"" % (expression,))
+            self.tokens.append(g.group(1).lower())
+            position = g.end()
+        if len(self.tokens) == 0:
+            raise ValueError("empty filter expression")
+
+        self.position = 0
+        predicate = self.parseExpression()
+        if self.position < len(self.tokens):
+            raise ValueError("unexpected \"%s\" in filter expression" % (self.tokens[self.position],))
+        return predicate
+
+    def peekToken(self) -> Optional[str]:
+        """
+        Returns the next token without consuming it, None at the end of the expression.
+        """
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def nextToken(self, expected: str) -> str:
+        """
+        Consumes the next token.
+
+        Args:
+            expected: What is expected, for the error message.
+
+        Returns:
+            The token.
+
+        Raises:
+            ValueError: At the end of the expression.
+        """
+        token = self.peekToken()
+        if token is None:
+            raise ValueError("filter expression ends, %s expected" % (expected,))
+        self.position += 1
+        return token
+
+    def parseExpression(self) -> Predicate:
+        """
+        Parses terms joined by "and" and "or".
+
+        As in tcpdump, "and" and "or" have the same priority and group from the left,
+        so "host a or host b and port 80" is "(host a or host b) and port 80".
+        """
+        predicate = self.parseNot()
+        while self.peekToken() in AND_OPERATORS + OR_OPERATORS:
+            operators = AND_OPERATORS if self.nextToken("operator") in AND_OPERATORS else OR_OPERATORS
+            # a run of the same operator is evaluated at once
+            predicates = [predicate, self.parseNot()]
+            while self.peekToken() in operators:
+                self.position += 1
+                predicates.append(self.parseNot())
+            predicate = self.allOf(predicates) if operators is AND_OPERATORS else self.anyOf(predicates)
+        return predicate
+
+    @staticmethod
+    def allOf(predicates: List[Predicate]) -> Predicate:
+        """
+        Returns the predicate matching the packets matched by all the predicates.
+        """
+        return lambda headers: all(predicate(headers) for predicate in predicates)
+
+    @staticmethod
+    def anyOf(predicates: List[Predicate]) -> Predicate:
+        """
+        Returns the predicate matching the packets matched by any of the predicates.
+        """
+        return lambda headers: any(predicate(headers) for predicate in predicates)
+
+    def parseNot(self) -> Predicate:
+        """
+        Parses a negated term, an expression in parentheses or a primitive.
+        """
+        token = self.peekToken()
+        if token in ("not", "!"):
+            self.position += 1
+            predicate = self.parseNot()
+            return lambda headers: not predicate(headers)
+        if token == "(":
+            self.position += 1
+            predicate = self.parseExpression()
+            if self.nextToken("\")\"") != ")":
+                raise ValueError("missing \")\" in filter expression")
+            return predicate
+        return self.parsePrimitive()
+
+    def parsePrimitive(self) -> Predicate:
+        """
+        Parses one primitive, with its protocol and direction qualifiers.
+
+        Returns:
+            The predicate of the primitive.
+
+        Raises:
+            ValueError: If the primitive is not known or its value is invalid.
+        """
+        token = self.nextToken("primitive")
+
+        protocol = None
+        if token in ("tcp", "udp") and self.peekToken() in ("port", "src", "dst"):
+            protocol = PROTOCOLS[token]
+            token = self.nextToken("port")
+
+        direction = None
+        if token in ("src", "dst"):
+            direction = token
+            token = self.nextToken("host, net or port")
+            if token not in ("host", "net", "port"):
+                raise ValueError("\"%s\" cannot follow \"%s\" in filter expression" % (token, direction,))
+
+        if protocol is not None and token != "port":
+            raise ValueError("\"%s\" cannot follow \"%s\" in filter expression" % (token, "tcp" if protocol == 6 else "udp",))
+
+        if token == "host":
+            value = self.nextToken("address")
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                raise ValueError("invalid host address \"%s\" in filter expression" % (value,))
+            return self.addressPredicate(address.version, int(address), (1 << address.max_prefixlen) - 1, direction)
+
+        if token == "net":
+            value = self.nextToken("network")
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise ValueError("invalid network \"%s\" in filter expression" % (value,))
+            return self.addressPredicate(network.version, int(network.network_address), int(network.netmask), direction)
+
+        if token == "port":
+            value = self.nextToken("port number")
+            if not value.isdigit() or int(value) > 0xFFFF:
+                raise ValueError("invalid port \"%s\" in filter expression" % (value,))
+            return self.portPredicate(int(value), direction, protocol)
+
+        if token == "proto":
+            value = self.nextToken("protocol")
+            if value in PROTOCOLS:
+                number = PROTOCOLS[value]
+            elif value.isdigit() and int(value) <= 0xFF:
+                number = int(value)
+            else:
+                raise ValueError("unknown protocol \"%s\" in filter expression" % (value,))
+            return lambda headers: headers[1] == number
+
+        if token in ("tcp", "udp", "sctp"):
+            number = PROTOCOLS[token]
+            return lambda headers: headers[1] == number
+        if token == "icmp":
+            return lambda headers: headers[0] == ETHERTYPE_IPV4 and headers[1] == 1
+        if token == "icmp6":
+            return lambda headers: headers[0] == ETHERTYPE_IPV6 and headers[1] == 58
+        if token == "ip":
+            return lambda headers: headers[0] == ETHERTYPE_IPV4
+        if token == "ip6":
+            return lambda headers: headers[0] == ETHERTYPE_IPV6
+        if token == "arp":
+            return lambda headers: headers[0] == ETHERTYPE_ARP
+
+        raise ValueError("unknown primitive \"%s\" in filter expression" % (token,))
+
+    def addressPredicate(self, version: int, value: int, mask: int, direction: Optional[str]) -> Predicate:
+        """
+        Builds the predicate of "host" and "net".
+
+        Args:
+            version: IP version of the address.
+            value: The address (network address for "net") as an integer.
+            mask: The netmask as an integer, all ones for "host".
+            direction: "src", "dst" or None for any of them.
+
+        Returns:
+            The predicate.
+        """
+        ethertypes = (ETHERTYPE_IPV4, ETHERTYPE_ARP) if version == 4 else (ETHERTYPE_IPV6,)
+        if direction == "src":
+            return lambda headers: headers[0] in ethertypes and headers[2] is not None and (headers[2] & mask) == value
+        if direction == "dst":
+            return lambda headers: headers[0] in ethertypes and headers[3] is not None and (headers[3] & mask) == value
+        return lambda headers: headers[0] in ethertypes and headers[2] is not None and ((headers[2] & mask) == value or (headers[3] & mask) == value)
+
+    def portPredicate(self, port: int, direction: Optional[str], protocol: Optional[int]) -> Predicate:
+        """
+        Builds the predicate of "port".
+
+        Args:
+            port: The port number.
+            direction: "src", "dst" or None for any of them.
+            protocol: The IP protocol number if it was given ("tcp port"), None for any protocol with ports.
+
+        Returns:
+            The predicate.
+        """
+        if direction == "src":
+            match = lambda headers: headers[4] == port
+        elif direction == "dst":
+            match = lambda headers: headers[5] == port
+        else:
+            match = lambda headers: headers[4] == port or headers[5] == port
+        if protocol is None:
+            return match
+        return lambda headers: headers[1] == protocol and match(headers)
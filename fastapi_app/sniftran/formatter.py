@@ -0,0 +1,169 @@
+import binascii
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from .filter import PacketFilter
+from .integrity import expected_packet_size, find_truncated
+from .packets import Packet
+from .writer import PcapNGBlocks
+
+# (interface name, linktype, Enhanced Packet Block or None when the packet was dropped)
+FormattedPacket = Tuple[str, int, Optional[bytearray]]
+
+class PacketFormatter:
+    """
+    Prepares assembled packets for the pcapng writer.
+
+    This class applies the interface include/exclude lists, the packet filter, the point-to-point
+    and no-link interface handling and the packet integrity checks, and encodes
+    each packet as an Enhanced Packet Block. It keeps no state between packets,
+    so the same formatter can be sent to the worker processes of the parallel engine.
+    """
+    def __init__(self, interfaces_include: Optional[Set[str]] = None, interfaces_exclude: Optional[Set[str]] = None,
+                 interfaces_ptp: Optional[Set[str]] = None, interfaces_nolink: Optional[Set[str]] = None,
+                 check_packet_size: bool = True, include_packet_line: bool = False,
+                 show_packets: bool = False, packet_filter: Optional[PacketFilter] = None, debug: int = 0):
+        """
+        Initialize the PacketFormatter.
+
+        Args:
+            interfaces_include: Save only packets from/to these interfaces.
+            interfaces_exclude: Ignore packets from/to these interfaces.
+            interfaces_ptp: Point-to-point interfaces, their artificial ethernet header is removed.
+            interfaces_nolink: Interfaces without any link layer information.
+            check_packet_size: Whether to drop packets shorter than their IPv4/IPv6 header says.
+            include_packet_line: Whether to add the line in the original file to the comment.
+            show_packets: Whether to print the binary content of each packet.
+            packet_filter: Optional filter expression, packets not matching it are dropped.
+            debug: Debug level.
+        """
+        self.interfaces_include = interfaces_include or set()
+        self.interfaces_exclude = interfaces_exclude or set()
+        self.interfaces_ptp = interfaces_ptp or set()
+        self.interfaces_nolink = interfaces_nolink or set()
+        self.check_packet_size = check_packet_size
+        self.include_packet_line = include_packet_line
+        self.show_packets = show_packets
+        self.packet_filter = packet_filter
+        self.debug = debug
+        self.blocks = PcapNGBlocks()
+
+    def accepts(self, iface: str) -> bool:
+        """
+        Checks the interface against the include and exclude lists.
+
+        Args:
+            iface: Interface name.
+
+        Returns:
+            True if packets of this interface should be saved.
+        """
+        if (len(self.interfaces_include) > 0) and (iface not in self.interfaces_include):
+            return False
+        if (len(self.interfaces_exclude) > 0) and (iface in self.interfaces_exclude):
+            return False
+        return True
+
+    def linktype(self, iface: str) -> int:
+        """
+        Returns the pcap link type of the interface.
+
+        Args:
+            iface: Interface name.
+
+        Returns:
+            LINKTYPE_NULL for point-to-point, LINKTYPE_RAW for no-link interfaces, LINKTYPE_ETHERNET otherwise.
+        """
+        # if this interface is marked as nolink, do not modify the packet, but mark as RAW (layer 3)
+        if iface in self.interfaces_nolink:
+            return PcapNGBlocks.LINKTYPE_RAW
+        # if this interface is marked as point-to-point, make it also in pcap interface description
+        if iface in self.interfaces_ptp:
+            return PcapNGBlocks.LINKTYPE_NULL
+        return PcapNGBlocks.LINKTYPE_ETHERNET
+
+    def formatPacket(self, packet: Packet, truncated: Optional[bool] = None) -> Optional[FormattedPacket]:
+        """
+        Formats one packet.
+
+        Args:
+            packet: The assembled packet.
+            truncated: Whether the packet failed the integrity checks, when they were done for a whole batch (see formatBatch).
+
+        Returns:
+            None if the packet is filtered out by the interface lists or the packet filter, otherwise a tuple
+            of the interface name, its link type and the EPB (with interface id 0),
+            which is None if the packet failed the integrity checks.
+        """
+        iface = packet.iface
+        if not self.accepts(iface):
+            return None
+
+        # the filter sees the packet as assembled, with the artificial ethernet header of point-to-point interfaces
+        if self.packet_filter is not None and not self.packet_filter.matches(packet.data, raw=iface in self.interfaces_nolink):
+            return None
+
+        packetBytes = packet.data
+        comment = packet.comment(self.include_packet_line)
+        if self.show_packets:
+            print("DEBUG: packet: iface=\"%s\", timestamp=\"%s\", comment=\"%s\", binary: \"%s\"" % (
+                                   iface, packet.ts_us, comment, binascii.hexlify(packetBytes)))
+
+        # if allowed, check whether the packet has the right size, on the packet as assembled
+        # (IPv4 and IPv6, behind any VLAN tags; the caller counts the packets without a block)
+        if self.check_packet_size:
+            if truncated is None:
+                expected = expected_packet_size(packetBytes, raw=iface in self.interfaces_nolink)
+                truncated = expected is not None and expected > len(packetBytes)
+            if truncated:
+                if self.debug >= 3:
+                    print("DEBUG: packet from line %i is not complete, size from IP header %s, total packet size %i" % (
+                                           packet.line, expected_packet_size(packetBytes, raw=iface in self.interfaces_nolink), len(packetBytes),))
+                return (iface, self.linktype(iface), None)
+
+        # if this interface is marked as point-to-point, remove artificial ethernet header
+        # (for packets in the reused assembler buffer this is just a narrower view, not a copy)
+        if iface in self.interfaces_ptp:
+            packetBytes = packetBytes[10:]  # remove 6 bytes for src and 6 byte for dst MAC, keep 2 byte protocol ("ethertype")
+            packetBytes[0] = 0              # however,  because LINKTYPE_NULL is used as L2 and it needs first 4 bytes for protocl
+            packetBytes[1] = 0              # we need to prepend another 2 bytes (0x0) to ethertype
+
+        block = self.blocks.blockEnhancedPacket(packetBytes, timestamp=packet.ts_us, ifaceIndex=0, comment=comment)
+        return (iface, self.linktype(iface), block)
+
+    def formatBatch(self, packets: List[Packet]) -> List[FormattedPacket]:
+        """
+        Formats a batch of packets, e.g. a shard of the parallel engine, with the integrity checks done at once.
+
+        Args:
+            packets: The assembled packets, each with its own data (not in a reused buffer).
+
+        Returns:
+            The formatted packets, without those filtered out, see formatPacket.
+        """
+        packets = [packet for packet in packets if self.accepts(packet.iface)]
+        truncated = set()
+        if self.check_packet_size:
+            truncated = set(find_truncated([packet.data for packet in packets],
+                                           raw=[packet.iface in self.interfaces_nolink for packet in packets]))
+
+        formatted = []
+        for (index, packet) in enumerate(packets):
+            result = self.formatPacket(packet, truncated=index in truncated)
+            if result is not None:
+                formatted.append(result)
+        return formatted
+
+    def iterFormatted(self, packets: Iterable[Packet]) -> Iterator[FormattedPacket]:
+        """
+        Formats all packets, skipping those filtered out by the interface lists.
+
+        Args:
+            packets: The assembled packets, e.g. from iter_packets.
+
+        Yields:
+            The formatted packets, see formatPacket.
+        """
+        for packet in packets:
+            formatted = self.formatPacket(packet)
+            if formatted is not None:
+                yield formatted
@@ -0,0 +1,92 @@
+import struct
+from typing import List, Optional, Sequence, Union
+
+from .filter import ETHERTYPE_IPV4, ETHERTYPE_IPV6, VLAN_ETHERTYPES
+
+# big endian 16 bit field, the ethertype and the IP length fields
+UINT16 = struct.Struct(">H")
+# fixed IPv6 header, not included in its payload length
+IPV6_HEADER_SIZE = 40
+
+PacketData = Union[bytes, bytearray, memoryview]
+
+# the ethertype of IPv4 as it is in the untagged ethernet frames, most of the packets
+ETHERTYPE_IPV4_BYTES = UINT16.pack(ETHERTYPE_IPV4)
+
+
+def expected_packet_size(data: PacketData, raw: bool = False) -> Optional[int]:
+    """
+    Computes the size of the packet announced by its IP header.
+
+    VLAN (802.1Q) and QinQ (802.1ad) tags are skipped to the IP header,
+    the size includes the ethernet header and the tags.
+
+    Args:
+        data: The packet, starting with the ethernet header (or the IP header when raw).
+        raw: Whether the packet has no link layer header (LINKTYPE_RAW).
+
+    Returns:
+        The size in bytes, or None for packets that are not IPv4 or IPv6 and for IPv6 jumbograms.
+        Packets too short to contain the length field return a size just past their end.
+    """
+    length = len(data)
+    if raw:
+        if length < 1:
+            return None
+        version = data[0] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else 0
+        offset = 0
+    else:
+        if length < 14:
+            return None
+        (ethertype,) = UINT16.unpack_from(data, 12)
+        offset = 14
+        while ethertype in VLAN_ETHERTYPES:
+            if length < offset + 4:
+                return length + 1
+            (ethertype,) = UINT16.unpack_from(data, offset + 2)
+            offset += 4
+
+    if ethertype == ETHERTYPE_IPV4:
+        if length < offset + 4:
+            return length + 1
+        (totalLength,) = UINT16.unpack_from(data, offset + 2)
+        return offset + totalLength
+    if ethertype == ETHERTYPE_IPV6:
+        if length < offset + 6:
+            return length + 1
+        (payloadLength,) = UINT16.unpack_from(data, offset + 4)
+        if payloadLength == 0:
+            # jumbogram, the real length is in the hop-by-hop options
+            return None
+        return offset + IPV6_HEADER_SIZE + payloadLength
+    return None
+
+
+
+def find_truncated(packets: Sequence[PacketData], raw: Union[bool, Sequence[bool]] = False) -> List[int]:
+    """
+    Validates a batch of packets at once, e.g. all packets of one shard or pcapng section.
+
+    Untagged IPv4 ethernet frames are checked inline, the other packets by expected_packet_size.
+    Longer packets are fine, ethernet frames are padded to 60 bytes.
+
+    Args:
+        packets: The packets, starting with the ethernet header (or the IP header when raw).
+        raw: Whether the packets have no link layer header (LINKTYPE_RAW), for all of them or one flag per packet.
+
+    Returns:
+        The indexes of the packets shorter than their IP header says.
+    """
+    rawFlags = [raw] * len(packets) if isinstance(raw, bool) else raw
+    unpack = UINT16.unpack_from
+    truncated = []
+    for (index, data) in enumerate(packets):
+        length = len(data)
+        if not rawFlags[index] and length >= 18 and data[12:14] == ETHERTYPE_IPV4_BYTES:
+            expected = 14 + unpack(data, 16)[0]
+        else:
+            expected = expected_packet_size(data, rawFlags[index])
+        if expected is not None and expected > length:
+            truncated.append(index)
+    return truncated
@@ -1,7 +1,9 @@
 import os
 import sys
 import random
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
+
+from .parser import open_datasource
 
 class IPSec:
     """
@@ -10,12 +12,18 @@ class IPSec:
     This class parses the input file for IPSec tunnel information (SPI, keys, algorithms)
     and updates the Wireshark `esp_sa` configuration file to enable decryption.
     """
-    def __init__(self, sourcefile: str, debug: int = 0, show_progress: bool = False):
+    # lines that can start the description of a tunnel or of its SA
+    SA_LINE_PREFIXES = {
+        str: ("name=", "enc:", "dec:"),
+        bytes: (b"name=", b"enc:", b"dec:"),
+    }
+    def __init__(self, sourcefile: Optional[str] = None, debug: int = 0, show_progress: bool = False):
         """
         Initialize the IPSec analyzer.
 
         Args:
-            sourcefile: The path to the source file containing packet capture and tunnel info.
+            sourcefile: The path to the source file containing packet capture and tunnel info,
+                        not needed when the lines are fed by the packet parser (see feedLine).
             debug: Debug level.
             show_progress: Whether to show progress during analysis.
         """
@@ -24,12 +32,35 @@ class IPSec:
         self.show_progress = show_progress
         self.tunnels: Dict[str, Dict] = {}
 
+        # state of the line parser
+        self.current: Optional[str] = None
+        self.pending: Optional[Tuple[str, Dict[str, Optional[str]]]] = None
+        # amount of SAs found so far, to recognize that new ones were found
+        self.sa_count = 0
+
+        # (esp=, key=) from the tunnel list to the encryption algorithm names of Wireshark
+        # - the key length of GCM and ChaCha20 includes the 4 bytes of salt
         self.cipher_map = { 
+                            ("null", "0") : "NULL",
+                            ("des", "8") : "DES-CBC [RFC2405]",
+                            ("3des", "24") : "TripleDES-CBC [RFC2451]",
                             ("aes", "16") : "AES-CBC [RFC3602]",
+                            ("aes", "24") : "AES-CBC [RFC3602]",
+                            ("aes", "32") : "AES-CBC [RFC3602]",
+                            ("aes-gcm", "20") : "AES-GCM with 16 octet ICV [RFC4106]",
+                            ("aes-gcm", "28") : "AES-GCM with 16 octet ICV [RFC4106]",
+                            ("aes-gcm", "36") : "AES-GCM with 16 octet ICV [RFC4106]",
+                            ("chacha20poly1305", "36") : "ChaCha20 with Poly1305 [RFC7634]",
                         }
 
+        # (ah=, key=) from the tunnel list to the authentication algorithm names of Wireshark
         self.hash_map = {
+                            ("null", "0") : "NULL",
+                            ("md5", "16") : "HMAC-MD5-96 [RFC2403]",
                             ("sha1", "20") : "HMAC-SHA-1-96 [RFC2404]",
+                            ("sha256", "32") : "HMAC-SHA-256-128 [RFC4868]",
+                            ("sha384", "48") : "HMAC-SHA-384-192 [RFC4868]",
+                            ("sha512", "64") : "HMAC-SHA-512-256 [RFC4868]",
                         }
 
         if 'HOME' in os.environ:
@@ -45,110 +76,29 @@ class IPSec:
         """
         Finds IPSec tunnels in the source file.
 
-        This method reads the source file line by line, looking for specific patterns
-        that indicate IPSec tunnel configuration (SPI, ESP, keys). It populates
-        the `self.tunnels` dictionary with the found information.
+        This method reads the source file line by line and feeds the lines to feedLine.
+        It is only needed when the tunnels were not collected while parsing the packets
+        (see the line_observer parameter of PacketParser). The source file can be
+        compressed, it is opened the same way as for the packet parsing.
         """
-        if not self.wireshark_config:
-            return
+        fd = open_datasource(self.sourcefile)
 
-        fd = open(self.sourcefile, "r")
-        current = None
-        
+        # for fifo etc. the size is unknown (0)
+        # but in that case this whole part would not work anyway
+        fd_size = fd.getSize()
         fd_readBytes = 0
-        # save the size
-        try:
-            fd.seek(0, os.SEEK_END)
-            fd_size = fd.tell()
-            fd.seek(0, os.SEEK_SET)
-        except IOError:
-            # can happen for fifo etc.
-            # but in that case this whole part would not work anyway
-            fd_size = 0
-
 
+        progress_last = None
         while True:
             line = fd.readline()
             if len(line) == 0:
                 break
             fd_readBytes += len(line)
-            line = line.strip()
-            ls = line.split()
-        
-            if len(ls) >= 1 and  "name=" in ls[0][:5] and ls[1] == "ver=1":
-                current = ls[0][5:]
-                while current in self.tunnels:
-                    # different phase1s can have the phase2s with the same name
-                    # - if it happens, just rename it
-                    newcurrent = "%s_%i" % (current, random.random()*1000,)
-                    current = newcurrent
-        
-                self.tunnels[current] = {}
-                self.tunnels[current]['src'] = ls[3].split("->")[0].split(":")[0]
-                self.tunnels[current]['dst'] = ls[3].split("->")[1].split(":")[0]
-            
-            if len(ls) >= 1 and ls[0] in ("dec:", "enc:"):
-                direction = ls[0][:3]
-        
-                # first line is encryption
-                if "spi=" != ls[1][:4]:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (spi)" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-                else:
-                    spi = ls[1][4:]
-        
-                if "esp=" != ls[2][:4]:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (esp)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-                else:
-                    esp = ls[2][4:]
-        
-                if "key=" != ls[3][:4]:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (keylength)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-                else:
-                    keylength = ls[3][4:]
-        
-                try:
-                    key = ls[4]
-                except:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (key)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-        
-                # next line should be authentication
-                auth = fd.readline().strip().split()
-                if "ah=" != auth[0][:3]:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (ah)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-                else:
-                    authalg = auth[0][3:]
-        
-                if "key=" != auth[1][:4]:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (authkeylength)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-                else:
-                    authkeylength = auth[1][4:]
-            
-                try:
-                    authkey = auth[2]
-                except:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (authkey)\n" % (direction, current,))
-                    self.tunnels[current]['ignore'] = True
-        
-                self.tunnels[current][direction] = {}
-                self.tunnels[current][direction]["spi"] = spi
-                self.tunnels[current][direction]["alg"] = esp
-                self.tunnels[current][direction]["keylength"] = keylength
-                self.tunnels[current][direction]["key"] = key
-                self.tunnels[current][direction]["authalg"] = authalg
-                self.tunnels[current][direction]["authkeylength"] = authkeylength
-                self.tunnels[current][direction]["authkey"] = authkey
-
-
-            if self.show_progress:
-                progress_current = fd_readBytes * 100 / fd_size
-                if 'progress_last' not in vars():
-                    progress_last = None
+            self.feedLine(line)
+
+            if self.show_progress and fd_size > 0:
+                position = fd.getPosition() if getattr(fd, "compressed", False) else fd_readBytes
+                progress_current = int(position * 100 / fd_size)
                 if progress_current != progress_last:
                     sys.stdout.write("PROGRESS: ipsec: %3i %%\r" % (progress_current,))
                     sys.stdout.flush()
@@ -156,27 +106,144 @@ class IPSec:
 
         fd.close()
 
-    def configure_wireshark(self) -> None:
+    def feedLine(self, line: Union[str, bytes]) -> None:
         """
-        Updates the Wireshark configuration file with found tunnels.
+        Processes one line of the sniffer output.
 
-        This method iterates through the found tunnels and appends their configuration
-        to the Wireshark `esp_sa` file, enabling Wireshark to decrypt the ESP packets.
+        Looks for the "name=... ver=1 ..." line of a tunnel followed by its "enc:" and "dec:"
+        lines, each of them followed by the "ah=" line, and populates the `self.tunnels`
+        dictionary with the found information. Any other line is ignored quickly, so this
+        can be called for every non-packet line during the packet parsing.
+
+        Args:
+            line: The line, str or bytes (from binary data sources).
         """
-        outfile = self.wireshark_config
-        if not outfile:
+        if self.pending is None and not line.lstrip().startswith(self.SA_LINE_PREFIXES[type(line)]):
+            return
+
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        ls = line.strip().split()
+
+        if self.pending is not None:
+            # the line right after "enc:" or "dec:" should be authentication
+            (direction, sa) = self.pending
+            self.pending = None
+            self.parseAuthLine(direction, sa, ls)
+            return
+
+        if len(ls) >= 4 and "name=" in ls[0][:5] and ls[1] == "ver=1":
+            current = ls[0][5:]
+            while current in self.tunnels:
+                # different phase1s can have the phase2s with the same name
+                # - if it happens, just rename it
+                newcurrent = "%s_%i" % (current, random.random()*1000,)
+                current = newcurrent
+            self.current = current
+
+            self.tunnels[current] = {}
+            self.tunnels[current]['src'] = ls[3].split("->")[0].split(":")[0]
+            self.tunnels[current]['dst'] = ls[3].split("->")[1].split(":")[0]
             return
 
+        if len(ls) >= 1 and ls[0] in ("dec:", "enc:"):
+            direction = ls[0][:3]
+            if self.current is None:
+                print("WARNING: ignoring \"%s\" direction found before any tunnel name" % (direction,))
+                return
+
+            sa: Dict[str, Optional[str]] = {}
+
+            # first line is encryption
+            if len(ls) < 2 or "spi=" != ls[1][:4]:
+                print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (spi)" % (direction, self.current,))
+                self.tunnels[self.current]['ignore'] = True
+            else:
+                sa["spi"] = ls[1][4:]
+
+            if len(ls) < 3 or "esp=" != ls[2][:4]:
+                print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (esp)\n" % (direction, self.current,))
+                self.tunnels[self.current]['ignore'] = True
+            else:
+                sa["alg"] = ls[2][4:]
+
+            if len(ls) < 4 or "key=" != ls[3][:4]:
+                print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (keylength)\n" % (direction, self.current,))
+                self.tunnels[self.current]['ignore'] = True
+            else:
+                sa["keylength"] = ls[3][4:]
+
+            if len(ls) < 5 and sa.get("keylength") == "0":
+                sa["key"] = ""
+            elif len(ls) < 5:
+                print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (key)\n" % (direction, self.current,))
+                self.tunnels[self.current]['ignore'] = True
+            else:
+                sa["key"] = ls[4]
+
+            self.pending = (direction, sa)
+
+    def parseAuthLine(self, direction: str, sa: Dict[str, Optional[str]], auth: list) -> None:
+        """
+        Processes the authentication line following the "enc:" or "dec:" line and stores the SA.
+
+        Args:
+            direction: "enc" or "dec".
+            sa: The values parsed from the encryption line.
+            auth: The split authentication line.
+        """
+        if len(auth) < 1 or "ah=" != auth[0][:3]:
+            print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (ah)\n" % (direction, self.current,))
+            self.tunnels[self.current]['ignore'] = True
+        else:
+            sa["authalg"] = auth[0][3:]
+
+        if len(auth) < 2 or "key=" != auth[1][:4]:
+            print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (authkeylength)\n" % (direction, self.current,))
+            self.tunnels[self.current]['ignore'] = True
+        else:
+            sa["authkeylength"] = auth[1][4:]
+
+        if len(auth) < 3 and sa.get("authkeylength") == "0":
+            sa["authkey"] = ""
+        elif len(auth) < 3:
+            print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown line format (authkey)\n" % (direction, self.current,))
+            self.tunnels[self.current]['ignore'] = True
+        else:
+            sa["authkey"] = auth[2]
+
+        self.tunnels[self.current][direction] = {}
+        for field in ("spi", "alg", "keylength", "key", "authalg", "authkeylength", "authkey"):
+            self.tunnels[self.current][direction][field] = sa.get(field)
+        self.sa_count += 1
+
+    def esp_sa_rows(self, warn: bool = True) -> List[str]:
+        """
+        Creates the Wireshark `esp_sa` rows of all usable tunnels.
+
+        Args:
+            warn: Whether to print warnings about the tunnels that cannot be used.
+
+        Returns:
+            One row per tunnel direction, in the format of the `esp_sa` file (without newline).
+        """
+        rows = []
         for tunnel in list(self.tunnels.keys()):
             if 'ignore' in self.tunnels[tunnel] and self.tunnels[tunnel]['ignore']:
                 # there was something wrong with this tunnel...
                 continue
 
             for direction in ("enc", "dec",):
+                if direction not in self.tunnels[tunnel]:
+                    if warn:
+                        print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because it was not found\n" % (direction, tunnel,))
+                    continue
+
                 # cyphers
                 cipher = (self.tunnels[tunnel][direction]['alg'], self.tunnels[tunnel][direction]['keylength'])
                 if cipher not in self.cipher_map:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown cipher (%s, %s)\n" % (direction, tunnel, cipher[0], cipher[1],))
+                    if warn:
+                        print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown cipher (%s, %s)\n" % (direction, tunnel, cipher[0], cipher[1],))
                     continue
                 else:
                     ws_alg = self.cipher_map[cipher]
@@ -184,7 +251,8 @@ class IPSec:
                 # hashes
                 hashish = (self.tunnels[tunnel][direction]['authalg'], self.tunnels[tunnel][direction]['authkeylength'])
                 if hashish not in self.hash_map:
-                    print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown hash (%s, %s)\n" % (direction, tunnel, hashish[0], hashish[1],))
+                    if warn:
+                        print("WARNING: ignoring \"%s\" direction for tunnel \"%s\" because of unknown hash (%s, %s)\n" % (direction, tunnel, hashish[0], hashish[1],))
                     continue
                 else:
                     ws_authalg = self.hash_map[hashish]
@@ -192,18 +260,53 @@ class IPSec:
                 # we need to use the right direction, otherwise wireshark would not recognize it	
                 if direction == 'enc':
                     dirpart = '"%s","%s"' % (self.tunnels[tunnel]['src'], self.tunnels[tunnel]['dst'],)
-                elif direction == 'dec':
-                    dirpart = '"%s","%s"' % (self.tunnels[tunnel]['dst'], self.tunnels[tunnel]['src'],)
                 else:
-                    dirpart = "error_that_never_happens"
-                    
-                outfd = open(outfile, "a")
-                outfd.write('"IPv4",%s,"0x%s","%s","0x%s","%s","0x%s"\n' % (
+                    dirpart = '"%s","%s"' % (self.tunnels[tunnel]['dst'], self.tunnels[tunnel]['src'],)
+
+                rows.append('"IPv4",%s,"0x%s","%s","%s","%s","%s"' % (
                     dirpart,
                     self.tunnels[tunnel][direction]['spi'],
                     ws_alg,
-                    self.tunnels[tunnel][direction]['key'],
+                    self.hexKey(self.tunnels[tunnel][direction]['key']),
                     ws_authalg,
-                    self.tunnels[tunnel][direction]['authkey'],
+                    self.hexKey(self.tunnels[tunnel][direction]['authkey']),
                     ))
-                outfd.close()
+        return rows
+
+    def hexKey(self, key: str) -> str:
+        """
+        Formats the key for Wireshark, NULL algorithms have no key at all.
+
+        Args:
+            key: The key in hex, possibly empty.
+
+        Returns:
+            The key with the 0x prefix, or an empty string.
+        """
+        if not key:
+            return ""
+        return "0x%s" % (key,)
+
+    def configure_wireshark(self) -> None:
+        """
+        Updates the Wireshark configuration file with found tunnels.
+
+        This method appends the configuration of the tunnels which are not there yet
+        to the Wireshark `esp_sa` file, enabling Wireshark to decrypt the ESP packets.
+        """
+        outfile = self.wireshark_config
+        if not outfile:
+            return
+
+        existing = set()
+        if os.path.exists(outfile):
+            with open(outfile, "r") as infd:
+                existing = set(line.strip() for line in infd)
+
+        rows = [row for row in self.esp_sa_rows() if row not in existing]
+        if len(rows) == 0:
+            return
+
+        with open(outfile, "a") as outfd:
+            for row in dict.fromkeys(rows):
+                outfd.write(row + "\n")
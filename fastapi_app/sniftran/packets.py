@@ -0,0 +1,105 @@
+import datetime
+import os
+from typing import Callable, Iterator, NamedTuple, Optional, Union
+
+from .parser import PacketParser, open_datasource
+from .assembler import PacketAssembler
+
+class Packet(NamedTuple):
+    """
+    One assembled packet together with the information from its header line.
+
+    The data is a memoryview only valid until the next packet when the packets
+    are iterated with reuse_buffer, otherwise a bytearray owned by the caller.
+    """
+    data: Union[bytearray, memoryview]
+    ts_us: int       # timestamp in microseconds
+    iface: str
+    direction: str
+    line: int        # line in the source where the packet data starts
+
+    def comment(self, include_line: bool = False) -> str:
+        """
+        Builds the pcapng comment of the packet.
+
+        Args:
+            include_line: Whether to append the line number in the original file.
+
+        Returns:
+            The direction of the packet followed by the interface name.
+        """
+        comment = "(%s)%s%s" % (self.direction, " "*(4-len(self.direction)), self.iface,)
+        if include_line:
+            comment += "  %5i" % (self.line,)
+        return comment
+
+
+def iter_packets(source, compatible: bool = True, normalize_lines: bool = True, stop_on_error: bool = False,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 timezone: Optional[datetime.tzinfo] = None, engine: str = "scalar",
+                 reuse_buffer: bool = False,
+                 line_observer: Optional[Callable[[Union[str, bytes]], None]] = None,
+                 skip: int = 0, limit: Optional[int] = None,
+                 interface_filter: Optional[Callable[[str], bool]] = None) -> Iterator[Packet]:
+    """
+    Yields all packets found in the source, in the order they were captured.
+
+    Args:
+        source: A file name (of a plain or compressed file) or an already opened data source (e.g. DataSource_MMap).
+        compatible: Whether to use compatibility mode for FE and FAC formats.
+        normalize_lines: Whether to normalize packet lines before parsing them.
+        stop_on_error: Whether to raise an exception when a parsing error occurs.
+        progress: Optional callback called every 1000 packets with the amount of
+                  bytes read so far and the total size of the source (both compressed
+                  for compressed sources).
+        timezone: Timezone of absolute timestamps, None for the local timezone.
+        engine: Hex decoding engine of the parser, "scalar", "batch" or "numpy".
+        reuse_buffer: Whether to assemble all packets in one buffer, the data of each packet
+                      is then only valid until the next packet is requested.
+        line_observer: Optional callback for all non-packet lines, e.g. IPSec.feedLine.
+        skip: Amount of packets to skip, they are only scanned for their boundaries and never decoded.
+        limit: Stop parsing after this amount of packets (after the skipped ones), None for all packets.
+        interface_filter: Optional check of the interface name (e.g. PacketFormatter.accepts), the packets
+                          it rejects are passed over by the parser without decoding them and do not count
+                          for skip and limit.
+
+    Yields:
+        Packet records.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        ds = open_datasource(os.fspath(source))
+        owns_source = True
+    else:
+        ds = source
+        owns_source = False
+
+    try:
+        pp = PacketParser(datasource=ds, compatible=compatible, normalize_lines=normalize_lines, timezone=timezone, engine=engine,
+                          line_observer=line_observer, interface_filter=interface_filter)
+        pc = PacketAssembler(packetparser=pp, stop_on_error=stop_on_error, reuse_buffer=reuse_buffer)
+
+        packets_assembled = 0
+        packets_yielded = 0
+        for (packetBytes, additionalInfo) in pc.iterPackets(skip=skip):
+            packets_assembled += 1
+            if progress is not None and packets_assembled % 1000 == 0:
+                progress(pp.progressPosition(), pp.sourcefile_size)
+
+            if len(additionalInfo) == 0:
+                # packet lines without the header line in front of them
+                print("WARNING: invalid data for packet %i, ignoring" % (packets_assembled,))
+                continue
+
+            if packetBytes is None:
+                # skipped, only its header line was parsed
+                continue
+
+            (ts, us, iface, direction, line) = additionalInfo
+            yield Packet(packetBytes, ts * 1000000 + us, iface, direction, line)
+
+            packets_yielded += 1
+            if limit is not None and packets_yielded >= limit:
+                break
+    finally:
+        if owns_source:
+            ds.close()
@@ -0,0 +1,254 @@
+import collections
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Deque, Iterator, List, Optional, Tuple, Union
+
+from .parser import DataSource_Bytes, PacketParser
+from .packets import iter_packets
+from .formatter import FormattedPacket, PacketFormatter
+from .ipsec import IPSec
+
+# default amount of input bytes parsed by one task
+SHARD_SIZE = 8 * 1024 * 1024
+
+class IPSecLines:
+    """
+    Collects the lines of a shard the IPSec parser needs, in order.
+
+    The description of a tunnel can be interleaved with packets and so split
+    between shards, so the lines are parsed by one IPSec instance in the order
+    of the shards instead of in the workers. The first line of the shard is
+    kept as well, it can complete an SA started in the previous shard.
+    """
+    # lines followed by their authentication line
+    SA_DIRECTION_PREFIXES = {
+        str: ("enc:", "dec:"),
+        bytes: (b"enc:", b"dec:"),
+    }
+    def __init__(self):
+        self.lines: List[Union[str, bytes]] = []
+        # whether the next line is needed, whatever it is
+        self.follows = True
+
+    def feedLine(self, line: Union[str, bytes]) -> None:
+        """
+        Keeps the line if the IPSec parser can use it, see IPSec.feedLine.
+
+        Args:
+            line: The line, str or bytes (from binary data sources).
+        """
+        start = line.lstrip()
+        if self.follows or start.startswith(IPSec.SA_LINE_PREFIXES[type(line)]):
+            self.lines.append(line)
+        self.follows = start.startswith(self.SA_DIRECTION_PREFIXES[type(line)])
+
+
+class ShardFinder:
+    """
+    Splits sniffer output into byte ranges that can be parsed independently.
+
+    Every shard (except the first one) starts at the header line of a packet,
+    that is the line right before a packet line with offset 0, so no packet is
+    ever split between two shards.
+    """
+    def __init__(self, buffer: Union[bytes, mmap.mmap], compatible: bool = True, normalize_lines: bool = True):
+        """
+        Initialize the ShardFinder.
+
+        Args:
+            buffer: The whole input, as bytes or memory-mapped file.
+            compatible: Whether to use compatibility mode for FE and FAC formats.
+            normalize_lines: Whether to normalize packet lines before parsing them.
+        """
+        self.buffer = buffer
+        self.size = len(buffer)
+        # the parser is used only for its line classification
+        self.pp = PacketParser(datasource=DataSource_Bytes(b""), compatible=compatible, normalize_lines=normalize_lines)
+
+    def isPacketStart(self, line: bytes) -> bool:
+        """
+        Checks whether the line is the first (offset 0) line of a packet.
+
+        Args:
+            line: Stripped line.
+
+        Returns:
+            True for the first packet line.
+        """
+        if not self.pp.packetLine.search(line):
+            return False
+        try:
+            (linePosition, binBytes) = self.pp.parsePacketLine(line)
+        except Exception:
+            return False
+        return linePosition == 0 and len(binBytes) > 0
+
+    def alignToPacket(self, offset: int) -> int:
+        """
+        Finds the start of the first packet header line at or after the offset.
+
+        Args:
+            offset: Any byte offset in the input.
+
+        Returns:
+            The offset of the header line, or the size of the input if there is no further packet.
+        """
+        if offset <= 0:
+            return 0
+
+        # continue from the beginning of the next complete line
+        position = self.buffer.find(b"\n", offset - 1) + 1
+        if position == 0:
+            return self.size
+
+        previous = None
+        while position < self.size:
+            end = self.buffer.find(b"\n", position)
+            if end < 0:
+                end = self.size
+            line = self.buffer[position:end].strip()
+            if len(line) > 0:
+                if previous is not None and self.isPacketStart(line):
+                    return previous
+                previous = position
+            position = end + 1
+
+        return self.size
+
+    def findShards(self, shard_size: int = SHARD_SIZE) -> List[Tuple[int, int]]:
+        """
+        Splits the whole input into shards of roughly shard_size bytes.
+
+        Args:
+            shard_size: Wanted size of one shard in bytes.
+
+        Returns:
+            List of (start, end) byte ranges covering the whole input in order.
+        """
+        boundaries = [0]
+        offset = shard_size
+        while offset < self.size:
+            boundary = self.alignToPacket(max(offset, boundaries[-1] + 1))
+            if boundary >= self.size:
+                break
+            boundaries.append(boundary)
+            offset = boundary + shard_size
+        boundaries.append(self.size)
+
+        return [(boundaries[i], boundaries[i+1]) for i in range(len(boundaries)-1)]
+
+
+def convert_shard(source: Union[str, bytes], start: int, end: int, line_offset: int,
+                  formatter: PacketFormatter, parser_options: dict,
+                  find_tunnels: bool = False) -> Tuple[List[FormattedPacket], List[Union[str, bytes]]]:
+    """
+    Parses and formats one shard, this runs in the worker processes.
+
+    Args:
+        source: The input file name, or the content of the shard itself.
+        start: Offset of the shard in the input file (ignored for content).
+        end: End of the shard in the input file (ignored for content).
+        line_offset: Amount of lines in the input before the shard.
+        formatter: The formatter to apply to the packets.
+        parser_options: Options for iter_packets.
+        find_tunnels: Whether to collect the lines describing IPSec tunnels.
+
+    Returns:
+        The formatted packets of the shard, in order, and its lines for the IPSec parser (see IPSecLines).
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = mm[start:end]
+    else:
+        data = source
+
+    ipsec = IPSecLines() if find_tunnels else None
+    packets = []
+    # the whole shard is formatted as one batch, so every packet keeps its own buffer
+    for packet in iter_packets(DataSource_Bytes(data), line_observer=ipsec.feedLine if ipsec else None,
+                               interface_filter=formatter.accepts, **parser_options):
+        if line_offset:
+            packet = packet._replace(line=packet.line + line_offset)
+        packets.append(packet)
+    return (formatter.formatBatch(packets), ipsec.lines if ipsec else [])
+
+
+def iter_formatted_parallel(source: Union[str, os.PathLike, bytes], jobs: int, formatter: PacketFormatter,
+                            shard_size: int = SHARD_SIZE, progress: Optional[Callable[[int, int], None]] = None,
+                            debug: int = 0, ipsec: Optional[IPSec] = None, **parser_options) -> Iterator[FormattedPacket]:
+    """
+    Parses the input in parallel and yields the formatted packets in the original order.
+
+    The input is split into shards aligned to packet boundaries, the shards are
+    parsed and formatted in a pool of worker processes and their results are
+    stitched back together in order. Only a few shards per worker are in flight
+    at any time, so memory does not depend on the size of the input.
+
+    Args:
+        source: The input file name (workers map it themselves) or its content.
+        jobs: Number of worker processes.
+        formatter: The formatter to apply to the packets.
+        shard_size: Wanted size of one shard in bytes.
+        progress: Optional callback called after each shard with the amount of
+                  bytes processed so far and the total size of the input.
+        debug: Debug level.
+        ipsec: Optional IPSec instance, fed the tunnel lines of the shards in order.
+        **parser_options: Options for iter_packets (compatible, normalize_lines, stop_on_error, timezone, engine).
+
+    Yields:
+        The formatted packets, see PacketFormatter.formatPacket.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        filename = os.fspath(source)
+        f = open(filename, "rb")
+        if os.fstat(f.fileno()).st_size == 0:
+            f.close()
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        filename = None
+        f = None
+        buffer = source
+
+    try:
+        finder = ShardFinder(buffer, compatible=parser_options.get("compatible", True),
+                             normalize_lines=parser_options.get("normalize_lines", True))
+        shards = finder.findShards(shard_size)
+        if debug >= 2:
+            print("DEBUG: input split into %i shards for %i workers" % (len(shards), jobs,))
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending: Deque = collections.deque()
+            lines_before = 0
+            try:
+                for (start, end) in shards:
+                    # line numbers are needed only when they are written to the packet comments
+                    line_offset = 0
+                    if formatter.include_packet_line:
+                        line_offset = lines_before
+                        lines_before += buffer[start:end].count(b"\n")
+
+                    shard = buffer[start:end] if filename is None else filename
+                    task = executor.submit(convert_shard, shard, start, end, line_offset, formatter, parser_options, ipsec is not None)
+                    pending.append((task, end))
+
+                    # keep just enough shards in flight to feed all workers, after the last shard collect them all
+                    while len(pending) >= jobs * 2 or (end == finder.size and pending):
+                        (task, shard_end) = pending.popleft()
+                        (formatted, ipsec_lines) = task.result()
+                        if ipsec is not None:
+                            for line in ipsec_lines:
+                                ipsec.feedLine(line)
+                        yield from formatted
+                        if progress is not None:
+                            progress(shard_end, finder.size)
+            finally:
+                # when the consumer stops early, do not parse the rest of the input
+                for (task, shard_end) in pending:
+                    task.cancel()
+    finally:
+        if f is not None:
+            buffer.close()
+            f.close()
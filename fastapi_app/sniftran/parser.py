@@ -3,8 +3,27 @@ import collections
 import binascii
 import datetime
 import time
+import io
 import os
-from typing import Tuple, Deque, Optional, BinaryIO
+import mmap
+from typing import Callable, Dict, List, Tuple, Deque, Optional, BinaryIO, Union
+
+from .compression import detect_compression, detect_file_compression, open_compressed_input
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# hex decoding engines of the PacketParser
+ENGINES = ("scalar", "batch", "numpy")
+
+if numpy is not None:
+    # value of each hex digit, 0xff for anything else
+    HEX_DIGITS = numpy.full(256, 0xff, dtype=numpy.uint8)
+    HEX_DIGITS[numpy.frombuffer(b"0123456789", dtype=numpy.uint8)] = numpy.arange(10)
+    HEX_DIGITS[numpy.frombuffer(b"abcdef", dtype=numpy.uint8)] = numpy.arange(10, 16)
+    HEX_DIGITS[numpy.frombuffer(b"ABCDEF", dtype=numpy.uint8)] = numpy.arange(10, 16)
 
 class DataSource_File:
     """
@@ -13,6 +32,8 @@ class DataSource_File:
     This class provides a wrapper around file reading operations, keeping track
     of the file size and providing methods to read lines.
     """
+    binary = False  # lines are returned as str
+
     def __init__(self, filename: str):
         """
         Initialize the DataSource_File.
@@ -59,6 +80,194 @@ class DataSource_File:
             self.sourcefile.close()
 
 
+class DataSource_Bytes:
+    """
+    Handles reading from a source already held in memory.
+
+    Lines are returned as bytes, the same way as DataSource_MMap does, so
+    the parser never decodes packet lines.
+    """
+    binary = True  # lines are returned as bytes
+
+    def __init__(self, data: bytes):
+        """
+        Initialize the DataSource_Bytes.
+
+        Args:
+            data: The whole content of the source.
+        """
+        self.buffer = io.BytesIO(data)  # shares the memory with data, no copy is made
+        self.sourcefile_size: int = len(data)
+
+    def getSize(self) -> int:
+        """
+        Returns the size of the source data.
+
+        Returns:
+            The size of the data in bytes.
+        """
+        return self.sourcefile_size
+
+    def readline(self) -> bytes:
+        """
+        Reads a line from the source data.
+
+        Returns:
+            The next line including its newline, or empty bytes at the end of data.
+        """
+        return self.buffer.readline()
+
+    def close(self) -> None:
+        """
+        Releases the source data.
+        """
+        self.buffer.close()
+
+
+class DataSource_MMap(DataSource_Bytes):
+    """
+    Handles reading from a memory-mapped source file.
+
+    The file is never decoded, lines are returned as bytes cut directly out of
+    the mapping by mmap.readline, which finds the line boundaries by searching
+    for the newline byte in C. Only regular files can be mapped, pipes and fifos
+    need DataSource_File.
+    """
+    def __init__(self, filename: str):
+        """
+        Initialize the DataSource_MMap.
+
+        Args:
+            filename: The path to the file to read.
+
+        Raises:
+            OSError, ValueError: If the file cannot be memory-mapped.
+        """
+        self.sourcefile: BinaryIO = open(filename, "rb")
+        self.sourcefile_size: int = os.fstat(self.sourcefile.fileno()).st_size
+
+        try:
+            if self.sourcefile_size > 0:
+                self.buffer = mmap.mmap(self.sourcefile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = io.BytesIO()  # empty files cannot be mapped
+        except (OSError, ValueError):
+            self.sourcefile.close()
+            raise
+
+    def close(self) -> None:
+        """
+        Unmaps and closes the source file.
+        """
+        self.buffer.close()
+        if self.sourcefile:
+            self.sourcefile.close()
+
+
+class DataSource_Compressed(DataSource_Bytes):
+    """
+    Handles reading from a compressed source file (gzip, bzip2, xz, zip or zstd).
+
+    The file is decompressed in a streaming fashion while the parser reads it, no
+    uncompressed copy is ever made. Lines are returned as bytes, the same way as
+    DataSource_MMap does. The size and the position are those of the compressed
+    file, so the progress is reported on compressed bytes.
+    """
+    compressed = True  # the position is reported by getPosition
+
+    def __init__(self, filename: str, compression: Optional[str] = None):
+        """
+        Initialize the DataSource_Compressed.
+
+        Args:
+            filename: The path to the file to read.
+            compression: "gzip", "bzip2", "xz", "zip" or "zstd", by default recognized by the first bytes of the file.
+
+        Raises:
+            ValueError: If the file is not compressed in a way that can be read.
+        """
+        self.sourcefile: BinaryIO = open(filename, "rb")
+        self.sourcefile_size: int = os.fstat(self.sourcefile.fileno()).st_size
+
+        try:
+            if compression is None:
+                compression = detect_compression(self.sourcefile.read(6))
+                self.sourcefile.seek(0)
+            self.compression = compression
+            self.buffer = open_compressed_input(self.sourcefile, compression)
+        except Exception:
+            self.sourcefile.close()
+            raise
+
+    def getPosition(self) -> int:
+        """
+        Returns how much of the compressed file was read.
+
+        Returns:
+            The position in the compressed file.
+        """
+        return self.sourcefile.tell()
+
+    def close(self) -> None:
+        """
+        Closes the decompressor and the source file.
+        """
+        self.buffer.close()
+        if self.sourcefile:
+            self.sourcefile.close()
+
+
+def open_datasource(filename: str) -> Union[DataSource_MMap, DataSource_Compressed, DataSource_File]:
+    """
+    Opens the file with the fastest data source available for it.
+
+    Args:
+        filename: The path to the file to read.
+
+    Returns:
+        DataSource_Compressed for compressed files, DataSource_MMap for other regular files,
+        DataSource_File when the file cannot be mapped.
+    """
+    compression = detect_file_compression(filename)
+    if compression is not None:
+        return DataSource_Compressed(filename, compression)
+
+    try:
+        return DataSource_MMap(filename)
+    except (OSError, ValueError):
+        # can happen when reading from stdin or fifo, etc.
+        return DataSource_File(filename)
+
+
+def parse_timezone(name: Optional[str]) -> Optional[datetime.tzinfo]:
+    """
+    Parses the timezone of absolute sniffer timestamps.
+
+    Args:
+        name: "local" (or None), "utc", a fixed offset like "+02:00" or an IANA name like "Europe/Prague".
+
+    Returns:
+        The timezone, or None for the local timezone of this machine.
+
+    Raises:
+        ValueError: If the timezone is not recognized.
+    """
+    if name is None or name.lower() == "local":
+        return None
+    if name.lower() == "utc":
+        return datetime.timezone.utc
+
+    g = re.match(r"^([+-])(\d\d):?(\d\d)$", name)
+    if g:
+        offset = datetime.timedelta(hours=int(g.group(2)), minutes=int(g.group(3)))
+        return datetime.timezone(-offset if g.group(1) == "-" else offset)
+
+    try:
+        import zoneinfo
+        return zoneinfo.ZoneInfo(name)
+    except Exception:
+        raise ValueError("unknown timezone: %s" % (name,))
+
 class PacketParser:
     """
     Parses packets from a data source.
@@ -66,8 +275,14 @@ class PacketParser:
     This class reads lines from a data source, identifies packet data,
     and parses it into binary format. It handles different output formats
     and normalizes lines if necessary.
+
+    Lines are processed in the type the data source returns them, str or bytes
+    (for binary sources), only header lines are ever decoded.
     """
-    def __init__(self, datasource: DataSource_File, compatible: bool = True, normalize_lines: bool = True):
+    def __init__(self, datasource: Union[DataSource_File, DataSource_Bytes], compatible: bool = True, normalize_lines: bool = True,
+                 timezone: Optional[datetime.tzinfo] = None, engine: str = "scalar",
+                 line_observer: Optional[Callable[[Union[str, bytes]], None]] = None,
+                 interface_filter: Optional[Callable[[str], bool]] = None):
         """
         Initialize the PacketParser.
 
@@ -75,45 +290,113 @@ class PacketParser:
             datasource: The data source to read from.
             compatible: Whether to use compatibility mode for older formats.
             normalize_lines: Whether to normalize packet lines (remove long trailing segments).
+            timezone: Timezone of absolute timestamps, None for the local timezone (see parse_timezone).
+            engine: How the hex data is decoded, "scalar" line by line, "batch" many lines
+                    at once with bytes.fromhex, or "numpy" many lines at once with NumPy
+                    (falls back to "batch" when NumPy is not installed).
+            line_observer: Optional callback called with every non-empty line that is not
+                           a packet line, e.g. IPSec.feedLine to find the tunnels in the same pass.
+            interface_filter: Optional check of the interface in the header lines, e.g. PacketFormatter.accepts.
+                              The packets it rejects are passed over without decoding their lines.
+
+        Raises:
+            ValueError: If the engine is not known.
         """
         self.normalize_lines = normalize_lines
-        
+        self.timezone = timezone
+        self.line_observer = line_observer
+        self.interface_filter = interface_filter
+        # the current packet was rejected by the interface filter, its lines are passed over
+        self.skippingPacket = False
+
+        if engine not in ENGINES:
+            raise ValueError("unknown engine: %s" % (engine,))
+        if engine == "numpy" and numpy is None:
+            print("WARNING: numpy is not installed, using the batch engine instead")
+            engine = "batch"
+        self.engine = engine
+
+        # epoch of the "YYYY-MM-DD HH:MM:SS" part of absolute timestamps, most packets share it with their neighbours
+        self.epochCache: Dict[Tuple[str, ...], int] = {}
+
+        # binary data sources return bytes, packet lines are then parsed without decoding
+        self.binary = getattr(datasource, "binary", False)
+        if self.binary:
+            self.emptyLine: Union[str, bytes] = b""
+            self.space: Union[str, bytes] = b" "
+            self.tab: Union[str, bytes] = b"\t"
+            self.canonicalPrefix: Union[str, bytes] = b"0x"
+            self.canonicalSeparator: Union[str, bytes] = b"\t "
+        else:
+            self.emptyLine = ""
+            self.space = " "
+            self.tab = "\t"
+            self.canonicalPrefix = "0x"
+            self.canonicalSeparator = "\t "
+
         # compile regular expressions
         if compatible:
             # with FAC with "tcpdump -XXe -tt -s0 -ni port1 port not 22"
-            self.packetLine = re.compile(r"(^[0-9a-f]*\t)|(^0x[0-9a-f]*[ \t:])")
-            self.packetLineParser = re.compile(r"^(0x)?([0-9a-f]*)[\t :]*([0-9a-f ]*)[ \t][ \t]*")
+            self.packetLine = self.compileLinePattern(r"(^[0-9a-f]*\t)|(^0x[0-9a-f]*[ \t:])")
+            self.packetLineParser = self.compileLinePattern(r"^(0x)?([0-9a-f]*)[\t :]*([0-9a-f ]*)[ \t][ \t]*")
         else:
-            self.packetLine = re.compile(r"^0x[0-9a-f]{4}[ \t]")
-            self.packetLineParser = re.compile(r"^(0x)([0-9a-f]{4})[ \t]*([0-9a-f ]*)[ \t][ \t]*")
+            self.packetLine = self.compileLinePattern(r"^0x[0-9a-f]{4}[ \t]")
+            self.packetLineParser = self.compileLinePattern(r"^(0x)([0-9a-f]{4})[ \t]*([0-9a-f ]*)[ \t][ \t]*")
 
         # 20220823: recognize 6k7k prefix
         self.headerLineTimeAbsolute = re.compile(r"^(?:\[(.*)\s*\]\s+)?([0-9]{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\.([0-9]*) ")
         self.headerLineTimeRelative = re.compile(r"^(?:\[(.*)\s*\]\s+)?([0-9]*)\.([0-9]*)[ \t]")
         self.headerLineIface = re.compile(r"^([^ ]*) ([^ ]*) ")
 
+        # the 4 digit offsets of canonical lines and their values, None if they are not hex digits (see splitCanonicalLine)
+        self.hexOffset = self.compileLinePattern(r"^[0-9a-f]{4}$")
+        self.canonicalOffsets: Dict[Union[str, bytes], Optional[int]] = {}
+
         self.ds = datasource
         self.sourcefile_size = self.ds.getSize()
 
-        self.wholefile: Deque[str] = collections.deque(maxlen=500)
+        self.wholefile: Deque[Union[str, bytes]] = collections.deque(maxlen=500)
 
         self.debug_linesRead = 0
         self.debug_bytesRead = 0
 
-    def getNextLine(self) -> str:
+    def progressPosition(self) -> int:
         """
-        Reads the next non-empty line from the data source.
+        Returns how far the data source was read, comparable with its size.
 
         Returns:
-            The next non-empty line stripped of whitespace.
+            The position in the compressed file for compressed data sources,
+            otherwise the amount of bytes of the lines read so far.
+        """
+        if getattr(self.ds, "compressed", False):
+            return self.ds.getPosition()
+        return self.debug_bytesRead
 
-        Raises:
-            Exception: If end of file is reached.
+    def compileLinePattern(self, pattern: str) -> "re.Pattern":
+        """
+        Compiles a packet line pattern for the type of lines the data source returns.
+
+        Args:
+            pattern: The regular expression as str.
+
+        Returns:
+            The compiled expression, matching bytes for binary data sources.
+        """
+        if self.binary:
+            return re.compile(pattern.encode("ascii"))
+        return re.compile(pattern)
+
+    def readNextLine(self) -> Optional[Union[str, bytes]]:
+        """
+        Reads the next non-empty line from the data source.
+
+        Returns:
+            The next non-empty line stripped of whitespace, or None at the end of file.
         """
         while True:
             line = self.ds.readline()
             if len(line) == 0:
-                raise Exception("end of file")
+                return None
             self.debug_linesRead += 1
             self.debug_bytesRead += len(line)
             line = line.strip()
@@ -121,11 +404,24 @@ class PacketParser:
                 continue  # ignore empty lines
 
             self.wholefile.append(line)
-            break
-    
+            return line
+
+    def getNextLine(self) -> Union[str, bytes]:
+        """
+        Reads the next non-empty line from the data source.
+
+        Returns:
+            The next non-empty line stripped of whitespace.
+
+        Raises:
+            Exception: If end of file is reached.
+        """
+        line = self.readNextLine()
+        if line is None:
+            raise Exception("end of file")
         return line
 
-    def getLine(self, history: int = 0) -> str:
+    def getLine(self, history: int = 0) -> Union[str, bytes]:
         """
         Gets a line from the history.
         
@@ -138,14 +434,14 @@ class PacketParser:
         i = len(self.wholefile) - 1 - history
         while True:
             if i < 0:
-                return "" # Should probably handle this better, but maintaining logic for now
+                return self.emptyLine # Should probably handle this better, but maintaining logic for now
             line = self.wholefile[i]
             if len(line) != 0:
                 break
             i -= 1
         return line
 
-    def normalizePacketLine(self, line: str) -> str:
+    def normalizePacketLine(self, line: Union[str, bytes]) -> Union[str, bytes]:
         """
         Normalizes a packet line if it has a long trailing segment.
 
@@ -163,14 +459,75 @@ class PacketParser:
         if not x: return line
         last = x[-1]
         if len(last) > 16:
-            newline = line[:-len(last)] + last[:(len(last)-16)] + " " + last[(len(last)-16):]
+            newline = line[:-len(last)] + last[:(len(last)-16)] + self.space + last[(len(last)-16):]
 
         return newline
 
-    def parsePacketLine(self, line: str) -> Tuple[int, bytes]:
+    def splitCanonicalLine(self, line: Union[str, bytes]) -> Optional[Tuple[int, int]]:
+        """
+        Checks whether a packet line is in the canonical FortiGate layout.
+
+        The canonical line is "0xNNNN<tab> xxxx xxxx ... xxxx<tab>ascii", so the offset
+        and the hex column can be sliced from fixed columns without regular expressions.
+        All the fast paths recognize the canonical lines here, so they never disagree.
+
+        Args:
+            line: The stripped line.
+
+        Returns:
+            None if the line is not in the canonical layout (and must be parsed by the
+            regular expressions), otherwise a tuple of the offset and the end of the hex
+            column, which is line[8:hexEnd].
+        """
+        if line[6:8] != self.canonicalSeparator or not line.startswith(self.canonicalPrefix):
+            return None
+
+        # the offset digits are checked explicitly, int() would accept e.g. "+01f" or " 01f" too
+        digits = line[2:6]
+        try:
+            offset = self.canonicalOffsets[digits]
+        except KeyError:
+            offset = self.canonicalOffsets[digits] = int(digits, 16) if self.hexOffset.match(digits) else None
+        if offset is None:
+            return None
+
+        hexEnd = line.find(self.tab, 8)
+        # the ascii column has at most 16 characters, longer lines need normalization
+        if hexEnd < 0 or len(line) - hexEnd > 17:
+            return None
+        return (offset, hexEnd)
+
+    def parseCanonicalLine(self, line: Union[str, bytes]) -> Optional[Tuple[int, bytes]]:
+        """
+        Parses a packet line in the canonical FortiGate layout without regular expressions.
+
+        Args:
+            line: The stripped line.
+
+        Returns:
+            The same tuple as parsePacketLine, or None if the line is not in the
+            canonical layout (see splitCanonicalLine) or its hex column cannot be decoded.
+        """
+        canonical = self.splitCanonicalLine(line)
+        if canonical is None:
+            return None
+
+        (offset, hexEnd) = canonical
+        hexBytes = line[8:hexEnd]
+        try:
+            if self.binary:
+                hexBytes = hexBytes.decode("ascii")
+            return (offset, bytes.fromhex(hexBytes))
+        except ValueError:
+            return None
+
+    def parsePacketLine(self, line: Union[str, bytes]) -> Tuple[int, bytes]:
         """
         Parses a single line of packet data.
 
+        Lines in the canonical FortiGate layout take the fast path (parseCanonicalLine),
+        everything else (e.g. FE and FAC tcpdump outputs) is parsed by the regular expressions.
+
         Args:
             line: The line containing packet hex data.
 
@@ -182,6 +539,10 @@ class PacketParser:
         Raises:
             Exception: If the line cannot be parsed.
         """
+        parsed = self.parseCanonicalLine(line)
+        if parsed is not None:
+            return parsed
+
         if self.normalize_lines:
             line = self.normalizePacketLine(line)
         g = self.packetLineParser.search(line)
@@ -189,46 +550,291 @@ class PacketParser:
             raise Exception("unparsable line: %s" % (line,))
 
         linePosition = int(g.group(2), 16)
-        hexBytes = g.group(3).replace(" ", "")
+        hexBytes = g.group(3).replace(self.space, self.emptyLine)
         binBytes = binascii.unhexlify(hexBytes)
 
         return (linePosition, binBytes)
         
-    def getPacketLine(self) -> Tuple[int, bytes, tuple]:
+    def readPacketLine(self) -> Optional[Tuple[int, bytes, tuple]]:
         """
         Finds and parses the next packet line.
 
+        The lines of packets rejected by the interface filter are passed over, the continuation
+        lines in the canonical layout without even being parsed.
+
         Returns:
-            A tuple containing:
+            None at the end of file, otherwise a tuple containing:
                 - linePosition (int): The offset of the data.
                 - binBytes (bytes): The parsed binary data.
                 - additionalInfo (tuple): Additional info (timestamp, interface, direction) if this is the first line.
+
+        Raises:
+            Exception: If the packet line cannot be parsed.
         """
         while True:
-            line = self.getNextLine()
+            line = self.readNextLine()
+            if line is None:
+                return None
+            if self.skippingPacket and self.isContinuationLine(line):
+                continue
             #print line, (self.packetLine.search(line))
-            if not (self.packetLine.search(line)):
+            parsed = self.parseCanonicalLine(line)
+            if parsed is None:
+                if not (self.packetLine.search(line)):
+                    if self.line_observer is not None:
+                        self.line_observer(line)
+                    continue
+                parsed = self.parsePacketLine(line)
+
+            (linePosition, binBytes) = parsed
+            if len(binBytes) == 0:
                 continue
 
-            (linePosition, binBytes) = self.parsePacketLine(line)
-            if len(binBytes) == 0:
+            if linePosition == 0:
+                additional = self.parseHeaderLine(self.getLine(history=1)) + (self.debug_linesRead,)
+                if self.interface_filter is not None:
+                    self.skippingPacket = not self.interface_filter(additional[2])
+            else:
+                additional = ()
+
+            if not self.skippingPacket:
+                break
+
+        return (linePosition, binBytes, additional)
+
+    def splitPacketLine(self, line: Union[str, bytes]) -> Optional[Tuple[int, Union[str, bytes]]]:
+        """
+        Splits a packet line into its offset and the hex column, without decoding it.
+
+        Args:
+            line: The stripped line.
+
+        Returns:
+            None if this is not a packet line, otherwise a tuple of the offset and the
+            hex digits (possibly separated by spaces).
+
+        Raises:
+            Exception: If the line cannot be parsed.
+        """
+        canonical = self.splitCanonicalLine(line)
+        if canonical is not None:
+            (offset, hexEnd) = canonical
+            return (offset, line[8:hexEnd])
+
+        if not (self.packetLine.search(line)):
+            return None
+
+        if self.normalize_lines:
+            line = self.normalizePacketLine(line)
+        g = self.packetLineParser.search(line)
+        if not g:
+            raise Exception("unparsable line: %s" % (line,))
+
+        return (int(g.group(2), 16), g.group(3))
+
+    def readPacketHex(self) -> Optional[Tuple[int, Union[str, bytes], int, Union[str, bytes], tuple]]:
+        """
+        Finds the next packet line and returns its hex data undecoded, for the batch engines.
+
+        Returns:
+            None at the end of file, otherwise a tuple containing:
+                - linePosition (int): The offset of the data.
+                - hexBytes (str or bytes): The hex digits, possibly separated by spaces.
+                - length (int): The amount of bytes the hex digits encode.
+                - line (str or bytes): The whole line, to parse it again if the batch cannot be decoded.
+                - additionalInfo (tuple): Additional info (timestamp, interface, direction) if this is the first line.
+
+        Raises:
+            Exception: If the packet line cannot be parsed.
+        """
+        while True:
+            line = self.readNextLine()
+            if line is None:
+                return None
+            if self.skippingPacket and self.isContinuationLine(line):
                 continue
 
-            break
+            packetHex = self.splitPacketHex(line)
+            if packetHex is not None:
+                return packetHex
 
-        if linePosition == 0: 
+    def readPacketStart(self) -> Optional[Tuple[int, Union[str, bytes], int, Union[str, bytes], tuple]]:
+        """
+        Finds the next packet line like readPacketHex, but passes over the canonical lines with a non-zero offset.
+
+        Such lines never start a packet, so they are not even split. This is used to
+        skip packets quickly, when only the packet boundaries and headers matter.
+
+        Returns:
+            The same tuple as readPacketHex, for all other packet lines.
+
+        Raises:
+            Exception: If the packet line cannot be parsed.
+        """
+        # the same as readNextLine, inlined into the loop over the lines
+        readline = self.ds.readline
+        wholefile = self.wholefile
+        isContinuationLine = self.isContinuationLine
+        while True:
+            line = readline()
+            if len(line) == 0:
+                return None
+            self.debug_linesRead += 1
+            self.debug_bytesRead += len(line)
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            wholefile.append(line)
+
+            if isContinuationLine(line):
+                continue
+
+            packetHex = self.splitPacketHex(line)
+            if packetHex is not None:
+                return packetHex
+
+    def isContinuationLine(self, line: Union[str, bytes]) -> bool:
+        """
+        Recognizes canonical packet lines with a non-zero offset, without splitting them.
+
+        Such lines are always packet lines (never passed to the line observer) and never
+        start a packet, so they can be passed over when the packet is not needed.
+
+        Args:
+            line: The stripped line.
+
+        Returns:
+            True for canonical lines (see splitCanonicalLine) with a non-zero offset.
+        """
+        canonical = self.splitCanonicalLine(line)
+        return canonical is not None and canonical[0] != 0
+
+    def splitPacketHex(self, line: Union[str, bytes]) -> Optional[Tuple[int, Union[str, bytes], int, Union[str, bytes], tuple]]:
+        """
+        Splits one line read by readPacketHex, passing the non-packet lines to the line observer.
+
+        The first line of a packet is checked by the interface filter, the lines of rejected packets are dropped.
+
+        Args:
+            line: The stripped line, the last one read.
+
+        Returns:
+            The same tuple as readPacketHex, or None if this line does not contain any (wanted) packet data.
+
+        Raises:
+            Exception: If the packet line cannot be parsed.
+        """
+        parsed = self.splitPacketLine(line)
+        if parsed is None:
+            if self.line_observer is not None:
+                self.line_observer(line)
+            return None
+
+        (linePosition, hexBytes) = parsed
+        digits = len(hexBytes) - hexBytes.count(self.space)
+        if linePosition == 0 or digits % 2 != 0:
+            # the first lines of packets (which split the packets) and suspicious lines
+            # are decoded right away, exactly as by the scalar engine
+            (linePosition, binBytes) = self.parsePacketLine(line)
+            hexBytes = binBytes.hex()
+            if self.binary:
+                hexBytes = hexBytes.encode("ascii")
+            digits = len(hexBytes)
+        if digits == 0:
+            return None
+
+        if linePosition == 0:
             additional = self.parseHeaderLine(self.getLine(history=1)) + (self.debug_linesRead,)
+            if self.interface_filter is not None:
+                self.skippingPacket = not self.interface_filter(additional[2])
         else:
             additional = ()
 
-        return (linePosition, binBytes, additional)
+        if self.skippingPacket:
+            return None
+        return (linePosition, hexBytes, digits // 2, line, additional)
 
-    def parseHeaderLine(self, line: str) -> Tuple[int, int, str, str]:
+    def decodeHex(self, hexColumns: List[Union[str, bytes]]) -> bytes:
+        """
+        Decodes the hex columns of many packet lines in a single call.
+
+        Args:
+            hexColumns: The hex data of the lines, as returned by readPacketHex.
+
+        Returns:
+            The decoded bytes of all the lines, concatenated.
+
+        Raises:
+            ValueError: If any of the columns contains something else than hex digits and spaces.
+        """
+        hexData = self.emptyLine.join(hexColumns)
+
+        if self.engine == "numpy":
+            if not self.binary:
+                hexData = hexData.encode("ascii")
+            digits = HEX_DIGITS[numpy.frombuffer(hexData.replace(b" ", b""), dtype=numpy.uint8)]
+            if len(digits) % 2 != 0 or (digits > 0x0f).any():
+                raise ValueError("invalid hex data")
+            return ((digits[0::2] << 4) | digits[1::2]).tobytes()
+
+        if self.binary:
+            hexData = hexData.decode("ascii")
+        return bytes.fromhex(hexData)
+
+    def getPacketLine(self) -> Tuple[int, bytes, tuple]:
+        """
+        Finds and parses the next packet line, see readPacketLine.
+
+        Returns:
+            A tuple containing:
+                - linePosition (int): The offset of the data.
+                - binBytes (bytes): The parsed binary data.
+                - additionalInfo (tuple): Additional info (timestamp, interface, direction) if this is the first line.
+
+        Raises:
+            Exception: If end of file is reached or the line cannot be parsed.
+        """
+        packetLine = self.readPacketLine()
+        if packetLine is None:
+            raise Exception("end of file")
+        return packetLine
+
+    def epochSeconds(self, fields: Tuple[str, ...]) -> int:
+        """
+        Converts the date and time of an absolute timestamp to seconds since the epoch.
+
+        The result is cached, so the (expensive) timezone conversion runs only once
+        for all packets captured in the same second.
+
+        Args:
+            fields: Year, month, day, hour, minute and second as strings.
+
+        Returns:
+            The timestamp in seconds.
+        """
+        ts = self.epochCache.get(fields)
+        if ts is not None:
+            return ts
+
+        dt = datetime.datetime(*[int(field) for field in fields])
+        if self.timezone is None:
+            #ts = int(dt.strftime("%s"))
+            # the above expression does not work on Windows :(
+            ts = int(time.mktime(dt.timetuple()))
+        else:
+            ts = int(dt.replace(tzinfo=self.timezone).timestamp())
+
+        if len(self.epochCache) >= 4096:
+            self.epochCache.clear()
+        self.epochCache[fields] = ts
+        return ts
+
+    def parseHeaderLine(self, line: Union[str, bytes]) -> Tuple[int, int, str, str]:
         """
         Parses the header line containing timestamp and interface info.
 
         Args:
-            line: The header line to parse.
+            line: The header line to parse, bytes are decoded first.
 
         Returns:
             A tuple containing:
@@ -237,6 +843,9 @@ class PacketParser:
                 - iface (str): Interface name.
                 - direction (str): Traffic direction (in/out).
         """
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+
         ts = 0
         us = 0
         slot = None # for chassis 6k7k
@@ -248,21 +857,12 @@ class PacketParser:
             g = self.headerLineTimeAbsolute.search(line)
             if g:
                 slot = g.group(1)
-                year = int(g.group(2))
-                month = int(g.group(3))
-                day = int(g.group(4))
-                hour = int(g.group(5))
-                minute = int(g.group(6))
-                second = int(g.group(7))
-                msec = int(g.group(8))
-
                 line = line[len(g.group(0)):]
-    
-                dt = datetime.datetime(year, month, day, hour, minute, second, msec)
-                #ts = int(dt.strftime("%s"))
-                # the above expression does not work on Windows :(
-                ts = int(time.mktime(dt.timetuple()))        
-                us = int(dt.strftime("%f")) # is this right? or us = float(dt.strftime("0.%f")) ?
+
+                ts = self.epochSeconds(g.group(2, 3, 4, 5, 6, 7))
+                us = int(g.group(8)) # is this right? or us = float("0." + g.group(8)) ?
+                if us > 999999:
+                    raise ValueError("microsecond must be in 0..999999")
                 break # to prevent the next check
 
             g = self.headerLineTimeRelative.search(line)
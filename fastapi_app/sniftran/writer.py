@@ -1,45 +1,272 @@
 import struct
 import os
-from typing import List, Optional
+from typing import BinaryIO, Dict, List, Optional, Union
 
-class PcapNGWriter:
+from .compression import compressed_writer, compression_available, open_compressed_output, split_compression_suffix
+
+# default amount of encoded blocks collected by the writer before they are written to the output
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class PcapNGBlocks:
     """
-    Writes packets to a PcapNG file.
+    Builds PcapNG blocks.
 
-    This class handles the creation of PcapNG blocks (Section Header, Interface Description,
-    Enhanced Packet) and writes them to the output file. It also supports splitting
-    output into multiple files if a maximum packet count is specified.
+    The block builders do not need any output, so they are kept separate from
+    the writer and can be used wherever packets are encoded (e.g. in the worker
+    processes of the parallel engine).
     """
     LINKTYPE_ETHERNET = 1
     LINKTYPE_PPP = 9
     LINKTYPE_RAW = 101
     LINKTYPE_NULL = 0
 
-    def __init__(self, outfile: str, max_in_file: Optional[int] = None, debug: int = 0):
+    # offset of the interface id inside of the Enhanced Packet Block
+    EPB_IFACE_OFFSET = 8
+
+    # precompiled layouts of the fixed parts of the blocks
+    EPB_HEADER = struct.Struct(">IIIQII")  # block type, length, interface id, timestamp, captured and original length
+    OPTION_HEADER = struct.Struct(">HH")   # option code, value length
+    BLOCK_TRAILER = struct.Struct(">I")    # block length repeated at the end of each block
+
+    # amount of distinct packet comments whose encoded options are remembered
+    OPTIONS_CACHE_SIZE = 4096
+
+    # zeros to pad the data of blocks to 32 bits
+    PADDING = bytes(3)
+
+    def __init__(self):
+        """
+        Initialize the PcapNGBlocks.
+        """
+        # encoded EPB options by comment, there are only a few distinct comments (direction and interface)
+        self.optionsCache: Dict[str, bytes] = {}
+
+    def blockSectionHeader(self) -> bytes:
+        """
+        Creates a Section Header Block (SHB) with unspecified section length.
+
+        Returns:
+            The binary representation of the SHB.
+        """
+        options = self.blockOption(4, "SnifTran ($Revision: 33 $) by Ondrej Holecek")   # application name
+        options += self.blockEndOfOptions()
+
+        block = struct.pack(">I", 0x0A0D0D0A)
+        block += struct.pack(">I", 28+len(options))
+        block += struct.pack(">I", 0x1A2B3C4D)
+        block += struct.pack(">HH", 1, 0)
+        block += struct.pack(">q", -1)  # section length
+        block += options
+        block += struct.pack(">I", 28+len(options))
+        return block
+
+    def blockInterfaceDescription(self, iface: str, linktype: int, tsresol: int = 6) -> bytes:
+        """
+        Creates an Interface Description Block (IDB).
+
+        Args:
+            iface: Interface name.
+            linktype: Link type (e.g., LINKTYPE_ETHERNET).
+            tsresol: Timestamp resolution (default 6 for microseconds).
+
+        Returns:
+            The binary representation of the IDB.
+        """
+        options = self.blockOption(2, iface)   # interface name
+        options += self.blockOption(9, chr(tsresol) ) # timestamp resolution, default 6 means microseconds
+        options += self.blockEndOfOptions()
+
+        block = struct.pack(">I", 0x00000001)
+        block += struct.pack(">I", 20+len(options))
+        block += struct.pack(">H", linktype)  # linktype
+        block += struct.pack(">H", 0)  # reserved
+        block += struct.pack(">i", -1) # snaplen (max possible lenght of captured packet)
+        block += options
+        block += struct.pack(">I", 20+len(options))
+
+        #print "interface block length:", len(block), ", reported length:", 20+len(options)
+        return block
+    
+    def blockEnhancedPacket(self, packet: bytes, timestamp: int, ifaceIndex: int, comment: str = "") -> bytearray:
+        """
+        Creates an Enhanced Packet Block (EPB).
+
+        Args:
+            packet: Packet data (binary).
+            timestamp: Timestamp in the resolution specified in IDB.
+            ifaceIndex: Interface index (0-based index of IDB).
+            comment: Comment string to attach to the packet.
+
+        Returns:
+            The binary representation of the EPB, mutable so that the interface id
+            can be patched at EPB_IFACE_OFFSET.
+        """
+        options = self.enhancedPacketOptions(comment)
+        block = bytearray(32 + len(packet) + (-len(packet) % 4) + len(options))
+        self.packEnhancedPacket(block, 0, packet, timestamp, ifaceIndex, options)
+        return block
+
+    def packEnhancedPacket(self, buffer: bytearray, offset: int, packet: bytes, timestamp: int, ifaceIndex: int, options: bytes) -> int:
+        """
+        Encodes an Enhanced Packet Block (EPB) into an existing buffer.
+
+        Args:
+            buffer: The buffer to encode the block into, big enough for the whole block.
+            offset: Offset of the block in the buffer.
+            packet: Packet data (binary).
+            timestamp: Timestamp in the resolution specified in IDB.
+            ifaceIndex: Interface index (0-based index of IDB).
+            options: Encoded options of the block, see enhancedPacketOptions.
+
+        Returns:
+            The offset right after the block.
+        """
+        packetLength = len(packet)
+        dataEnd = offset + 28 + packetLength
+        optionsStart = dataEnd + (-packetLength % 4)
+        blockEnd = optionsStart + len(options) + 4
+        blockLength = blockEnd - offset
+
+        # timestamp is 64bit (in format docs this is shown as two 32bit numbers)
+        self.EPB_HEADER.pack_into(buffer, offset, 0x00000006, blockLength, ifaceIndex, timestamp, packetLength, packetLength)
+        buffer[offset+28:dataEnd] = packet
+        if optionsStart > dataEnd:
+            buffer[dataEnd:optionsStart] = self.PADDING[:optionsStart-dataEnd]
+        buffer[optionsStart:blockEnd-4] = options
+        self.BLOCK_TRAILER.pack_into(buffer, blockEnd-4, blockLength)
+        return blockEnd
+
+    def enhancedPacketOptions(self, comment: str) -> bytes:
+        """
+        Encodes the options of an Enhanced Packet Block.
+
+        Args:
+            comment: Comment string to attach to the packet.
+
+        Returns:
+            The comment option followed by the end of options.
+        """
+        options = self.optionsCache.get(comment)
+        if options is None:
+            if len(self.optionsCache) >= self.OPTIONS_CACHE_SIZE:
+                self.optionsCache.clear()
+            options = self.blockOption(1, comment) + self.blockEndOfOptions()
+            self.optionsCache[comment] = options
+        return options
+    
+    def blockOption(self, code: int, value: str) -> bytes:
+        """
+        Creates an option block.
+
+        Args:
+            code: Option code.
+            value: Option value (string).
+
+        Returns:
+            The binary representation of the option block, including padding.
+        """
+        encoded = str.encode(value)
+        return self.OPTION_HEADER.pack(code, len(encoded)) + encoded + bytes(-len(encoded) % 4)
+
+    def blockEndOfOptions(self) -> bytes:
+        """
+        Creates an end of options block.
+
+        Returns:
+            The binary representation of the end of options block.
+        """
+        return self.OPTION_HEADER.pack(0, 0)
+
+
+class PcapNGWriter(PcapNGBlocks):
+    """
+    Writes packets to a PcapNG file.
+
+    This class handles the creation of PcapNG blocks (Section Header, Interface Description,
+    Enhanced Packet) and writes them to the output file. It also supports splitting
+    output into multiple files if a maximum packet count is specified.
+
+    Packets can be written either in whole sections (writePackets) or one at a time
+    (writePacket), in which case the Interface Description Blocks are emitted lazily
+    the first time each interface appears in the current section.
+
+    The output can be a file name or any writable binary file object (e.g. io.BytesIO),
+    which is then written to but never closed by the writer.
+
+    The output can be compressed while it is written, with gzip or zstd chosen by
+    the suffix of the output file name (".pcapng.gz", ".pcapng.zst") or explicitly
+    by the compression argument.
+
+    All blocks go through a buffer which is written to the output whenever it would
+    grow over buffer_size bytes, so the memory used by the writer does not depend on
+    the size of the sections.
+    """
+
+    def __init__(self, outfile: Union[str, BinaryIO], max_in_file: Optional[int] = None, section_size: Optional[int] = None,
+                 buffer_size: int = WRITE_BUFFER_SIZE, compression: Optional[str] = None, debug: int = 0):
         """
         Initialize the PcapNGWriter.
 
         Args:
-            outfile: The path to the output file.
+            outfile: The path to the output file, or a writable binary file object.
             max_in_file: Maximum number of packets per file (for splitting).
+            section_size: Maximum number of packets in one section written by writePacket.
+            buffer_size: Maximum amount of bytes kept before writing them to the output, 0 to write every block right away.
+            compression: "gzip" or "zstd" to compress the output, by default taken from the suffix of the output file name.
             debug: Debug level.
+
+        Raises:
+            ValueError: If the compression is not available.
         """
+        super().__init__()
         self.max_in_file = max_in_file
+        self.section_size = section_size
+        self.buffer_size = buffer_size
         self.debug = debug
 
+        # encoded blocks not written to the output yet
+        self.outputBuffer = bytearray()
+
+        # blocks written by writePacket are encoded here, so no memory is allocated per packet
+        self.packetBuffer = bytearray(2048)
+
+        self.f_packet_count = 0
+        self.f_file_count = 1
+
+        # state of the section used by writePacket
+        self.section_open = False
+        self.section_ifaces: Dict[str, int] = {}
+        self.section_packet_count = 0
+
+        if not isinstance(outfile, (str, os.PathLike)):
+            # pluggable sink: the caller owns it, so it cannot be renamed or split
+            if max_in_file is not None:
+                raise ValueError("max_in_file requires the output to be a file name")
+            self.output_file_base = None
+            self.output_file_suffix = ''
+            self.compression = compression
+            self.f_current = None
+            self.f_sink = outfile
+            self.f = compressed_writer(outfile, compression)
+            self.f_owned = False
+            return
+
+        outfile = os.fspath(outfile)
+        (outfile, compression_suffix, suffix_compression) = split_compression_suffix(outfile)
+        self.compression = compression or suffix_compression
+
         # split file name, in case we need to have more than one files
         if outfile[-7:] == '.pcapng': 
             self.output_file_base = outfile[:-7]
-            self.output_file_suffix = '.pcapng'
+            self.output_file_suffix = '.pcapng' + compression_suffix
         else:
             self.output_file_base = outfile
-            self.output_file_suffix = ''
+            self.output_file_suffix = compression_suffix
 
         # open the file with the original filename, it can be renamed in the future
         self.f_current = "%s%s" % (self.output_file_base, self.output_file_suffix)
-        self.f = open(self.f_current, "wb")
-        self.f_packet_count = 0
-        self.f_file_count = 1
+        self.f = open_compressed_output(self.f_current, self.compression)
+        self.f_owned = True
 
     def writePackets(self, blockIfaces: bytes, blockPackets: List[bytes]) -> None:
         """
@@ -52,164 +279,395 @@ class PcapNGWriter:
             blockIfaces: The interface block bytes (concatenated Interface Description Blocks).
             blockPackets: A list of packet bytes (Enhanced Packet Blocks).
         """
-        options = self.blockOption(4, "SnifTran ($Revision: 33 $) by Ondrej Holecek")   # application name
-        options += self.blockEndOfOptions()
+        # the section written here is complete, packets written later by writePacket need a new one
+        self.section_open = False
 
+        packet_count = len(blockPackets)
         packet_index = 0
-        while len(blockPackets[packet_index:]) > 0:  # when we still have packets to save...
+        while packet_index < packet_count:  # when we still have packets to save...
+            packets_left = packet_count - packet_index
             if self.max_in_file is None:
                 # when amount of packets in file is unlimited, we have as many slots as we need
-                slots_free = len(blockPackets[packet_index:])
+                slots_free = packets_left
                 if self.debug >= 2:
                     print("DEBUG: amount of packets in file is unlimited, packets to save: %i, file already contains: %i, free slots: %i" % (
-                                         len(blockPackets[packet_index:]), self.f_packet_count, slots_free,))
+                                         packets_left, self.f_packet_count, slots_free,))
             else:
                 # otherwise we need to be more cautious
                 slots_free = self.max_in_file - self.f_packet_count
                 if self.debug >= 2:
                     print("DEBUG: amount of packets in file is limited to %i, packets to save: %i, file already contains: %i, free slots current cycle: %i" % (
-                                         self.max_in_file, len(blockPackets[packet_index:]), self.f_packet_count, slots_free,))
+                                         self.max_in_file, packets_left, self.f_packet_count, slots_free,))
 
             if slots_free == 0:
                 # we need to write packets, but there are not slots in the file
                 # so we need to open another file
-                self.f.close()
+                self.openNextFile()
+                slots_free = self.max_in_file - self.f_packet_count
 
-                if self.f_file_count == 1: # if this was the first, original, file, rename it to the split format
-                    newname = "%s.part%03i%s" % (self.output_file_base, 1, self.output_file_suffix)
-                    if self.debug >= 1:
-                        print("DEBUG: renaming original output file '%s' to '%s'" % (self.f_current, newname,))
-                    os.rename(self.f_current, newname)
+            # write packets to available slots, block by block through the output buffer
+            section_end = min(packet_count, packet_index + slots_free)
+            self.writeBlock(self.blockSectionHeader())
+            self.writeBlock(blockIfaces)
+            section_bytes = 0
+            for index in range(packet_index, section_end):
+                self.writeBlock(blockPackets[index])
+                section_bytes += len(blockPackets[index])
 
-                self.f_file_count += 1
-                self.f_current = "%s.part%03i%s" % (self.output_file_base, self.f_file_count, self.output_file_suffix)
-                if self.debug >= 1:
-                    print("DEBUG: opening new output file '%s'" % (self.f_current,))
-                self.f = open(self.f_current, "wb")
+            self.f_packet_count += section_end - packet_index
+            if self.debug >= 3:
+                print("DEBUG: written %i packets, %i bytes to the current output file, now the file contains: %i" % (section_end - packet_index, section_bytes, self.f_packet_count))
 
-                # reset the packet count as we have a new file
-                self.f_packet_count = 0
-                slots_free = self.max_in_file - self.f_packet_count
+            packet_index = section_end
 
-            # write packets to available slots
-            data = blockIfaces + bytearray().join(blockPackets[packet_index:packet_index+slots_free])
+    def writePacket(self, packet: bytes, timestamp: int, iface: str, linktype: int = PcapNGBlocks.LINKTYPE_ETHERNET, comment: str = "") -> None:
+        """
+        Writes a single packet directly to the file.
 
-            block = struct.pack(">I", 0x0A0D0D0A)
-            block += struct.pack(">I", 28+len(options))
-            block += struct.pack(">I", 0x1A2B3C4D)
-            block += struct.pack(">HH", 1, 0)
-            block += struct.pack(">q", -1)  # section length
-            block += options
-            block += struct.pack(">I", 28+len(options))
-            block += data
+        The Section Header Block is written before the first packet of each file (and
+        after every section_size packets) and the Interface Description Block of an
+        interface right before its first packet in the section, so nothing but the
+        current packet is ever kept in memory.
 
-            self.f.write(block)
-            self.f_packet_count += len(blockPackets[packet_index:packet_index+slots_free])
-            if self.debug >= 3:
-                print("DEBUG: written %i packets, %i bytes to the current output file, now the file contains: %i" % (len(blockPackets[packet_index:packet_index+slots_free]), len(block), self.f_packet_count))
+        Args:
+            packet: Packet data (binary).
+            timestamp: Timestamp in microseconds.
+            iface: Interface name.
+            linktype: Link type of the interface, used only when its IDB is emitted.
+            comment: Comment string to attach to the packet.
+        """
+        ifaceIndex = self.prepareInterface(iface, linktype)
+
+        options = self.enhancedPacketOptions(comment)
+        blockLength = 32 + len(packet) + (-len(packet) % 4) + len(options)
+        if blockLength > len(self.packetBuffer):
+            self.packetBuffer = bytearray(blockLength)
+        self.packEnhancedPacket(self.packetBuffer, 0, packet, timestamp, ifaceIndex, options)
+        self.writeBlock(memoryview(self.packetBuffer)[:blockLength])
+        self.f_packet_count += 1
+        self.section_packet_count += 1
+
+    def writeEnhancedPacket(self, block: bytearray, iface: str, linktype: int = PcapNGBlocks.LINKTYPE_ETHERNET) -> None:
+        """
+        Writes an already encoded Enhanced Packet Block directly to the file.
 
-            packet_index += len(blockPackets[packet_index:packet_index+slots_free])
+        The block can be encoded anywhere (e.g. in another process) with any interface
+        id, the id of the interface in the current section is patched into it here.
 
-    
-    def blockInterfaceDescription(self, iface: str, linktype: int, tsresol: int = 6) -> bytes:
+        Args:
+            block: The EPB created by blockEnhancedPacket.
+            iface: Interface name.
+            linktype: Link type of the interface, used only when its IDB is emitted.
         """
-        Creates an Interface Description Block (IDB).
+        ifaceIndex = self.prepareInterface(iface, linktype)
+        struct.pack_into(">I", block, self.EPB_IFACE_OFFSET, ifaceIndex)
+        self.writeBlock(block)
+        self.f_packet_count += 1
+        self.section_packet_count += 1
+
+    def prepareInterface(self, iface: str, linktype: int) -> int:
+        """
+        Makes sure the next packet of the interface can be written.
+
+        Opens the next file and/or section if the current one is full and emits the
+        Interface Description Block if the interface was not used in the section yet.
 
         Args:
             iface: Interface name.
-            linktype: Link type (e.g., LINKTYPE_ETHERNET).
-            tsresol: Timestamp resolution (default 6 for microseconds).
+            linktype: Link type of the interface, used only when its IDB is emitted.
 
         Returns:
-            The binary representation of the IDB.
+            The index of the interface in the current section.
         """
-        options = self.blockOption(2, iface)   # interface name
-        options += self.blockOption(9, chr(tsresol) ) # timestamp resolution, default 6 means microseconds
-        options += self.blockEndOfOptions()
+        if self.max_in_file is not None and self.f_packet_count >= self.max_in_file:
+            self.openNextFile()
+
+        if self.section_size is not None and self.section_packet_count >= self.section_size:
+            self.section_open = False
+
+        if not self.section_open:
+            self.writeBlock(self.blockSectionHeader())
+            self.section_open = True
+            self.section_ifaces = {}
+            self.section_packet_count = 0
+
+        ifaceIndex = self.section_ifaces.get(iface)
+        if ifaceIndex is None:
+            ifaceIndex = len(self.section_ifaces)
+            self.section_ifaces[iface] = ifaceIndex
+            self.writeBlock(self.blockInterfaceDescription(iface, linktype))
+            if self.debug >= 3:
+                print("DEBUG: new iface found: \"%s\", assigning index %i" % (iface, ifaceIndex,))
 
-        block = struct.pack(">I", 0x00000001)
-        block += struct.pack(">I", 20+len(options))
-        block += struct.pack(">H", linktype)  # linktype
-        block += struct.pack(">H", 0)  # reserved
-        block += struct.pack(">i", -1) # snaplen (max possible lenght of captured packet)
-        block += options
-        block += struct.pack(">I", 20+len(options))
+        return ifaceIndex
 
-        #print "interface block length:", len(block), ", reported length:", 20+len(options)
-        return block
-    
-    def blockEnhancedPacket(self, packet: bytes, timestamp: int, ifaceIndex: int, comment: str = "") -> bytes:
+    def writeBlock(self, block: Union[bytes, bytearray, memoryview]) -> None:
         """
-        Creates an Enhanced Packet Block (EPB).
+        Writes encoded blocks to the output through the output buffer.
 
         Args:
-            packet: Packet data (binary).
-            timestamp: Timestamp in the resolution specified in IDB.
-            ifaceIndex: Interface index (0-based index of IDB).
-            comment: Comment string to attach to the packet.
+            block: One or more encoded blocks, copied before this method returns.
+        """
+        if len(self.outputBuffer) + len(block) > self.buffer_size:
+            self.flush()
+            if len(block) >= self.buffer_size:
+                # too big to be buffered, it would be copied just to be written right away
+                self.f.write(block)
+                return
+        self.outputBuffer += block
+
+    def flush(self) -> None:
+        """
+        Writes the buffered blocks to the output.
+        """
+        if len(self.outputBuffer) > 0:
+            self.f.write(self.outputBuffer)
+            self.outputBuffer.clear()
 
-        Returns:
-            The binary representation of the EPB.
+    def openNextFile(self) -> None:
         """
-        options = self.blockOption(1, comment)
-        options += self.blockEndOfOptions()
+        Closes the current output file and opens the next part.
 
-        packetPad = 0
-        if (len(packet) % 4) > 0:
-            packetPad = 4-(len(packet) % 4)
-
-        block = struct.pack(">I", 0x00000006)        # block type
-        block += struct.pack(">I", 32+len(packet)+packetPad+len(options))
-        block += struct.pack(">I", ifaceIndex)  # interface id
-        block += struct.pack(">Q", timestamp)  # timestamp 64bit (in format docs this is shown as two 32bit numbers)
-        block += struct.pack(">I", len(packet))  # capture length
-        block += struct.pack(">I", len(packet))  # packet length
-        block += packet
-        for i in range(packetPad):
-            block += struct.pack(">b", 0)
-        block += options
-        block += struct.pack(">I", 32+len(packet)+packetPad+len(options))
+        When the first, original, file is closed it is renamed to the split format.
+        """
+        self.flush()
+        self.f.close()
+
+        if self.f_file_count == 1: # if this was the first, original, file, rename it to the split format
+            newname = "%s.part%03i%s" % (self.output_file_base, 1, self.output_file_suffix)
+            if self.debug >= 1:
+                print("DEBUG: renaming original output file '%s' to '%s'" % (self.f_current, newname,))
+            os.rename(self.f_current, newname)
+
+        self.f_file_count += 1
+        self.f_current = "%s.part%03i%s" % (self.output_file_base, self.f_file_count, self.output_file_suffix)
+        if self.debug >= 1:
+            print("DEBUG: opening new output file '%s'" % (self.f_current,))
+        self.f = open_compressed_output(self.f_current, self.compression)
+
+        # reset the packet count as we have a new file, which also needs a new section
+        self.f_packet_count = 0
+        self.section_open = False
 
-        #print "packet length:", len(packet), "padding:", packetPad, "reported:", 32+len(packet)+packetPad+len(options), "real:", len(block)
+    def close(self) -> None:
+        """
+        Closes the writer file, a caller provided file object is only flushed.
+        """
+        if self.f:
+            self.flush()
+            if self.f_owned:
+                self.f.close()
+            else:
+                if self.f is not self.f_sink:
+                    # finish the compressed stream, the sink itself stays open
+                    self.f.close()
+                self.f_sink.flush()
+            self.f = None
 
-        return block
-    
-    def blockOption(self, code: int, value: str) -> bytes:
+
+class PcapWriter:
+    """
+    Writes packets to legacy libpcap files with nanosecond timestamps.
+
+    The libpcap format has one link type per file and no interfaces or comments,
+    but it is smaller and faster to read than pcapng. Packets of the first link
+    type are written to the output file itself, packets of any
+    other link type to a file with the name of the link type added to the output
+    file name (e.g. "out.null.pcap" next to "out.pcap"). A file object given as the
+    output holds only the first link type, the packets of the others are skipped
+    and counted in skippedPackets.
+
+    It accepts the same packets as PcapNGWriter, including Enhanced Packet Blocks
+    prepared by PacketFormatter, so both writers can be used by the same loop.
+    Like PcapNGWriter it can compress the output (".pcap.gz", ".pcap.zst").
+    """
+    MAGIC_NANOSECONDS = 0xA1B23C4D
+    SNAPLEN = 262144
+
+    FILE_HEADER = struct.Struct(">IHHiIII")  # magic, version major and minor, timezone, sigfigs, snaplen, link type
+    RECORD_HEADER = struct.Struct(">IIII")   # seconds, nanoseconds, captured and original length
+
+    LINKTYPE_NAMES = {
+        PcapNGBlocks.LINKTYPE_ETHERNET: "ethernet",
+        PcapNGBlocks.LINKTYPE_PPP: "ppp",
+        PcapNGBlocks.LINKTYPE_RAW: "raw",
+        PcapNGBlocks.LINKTYPE_NULL: "null",
+    }
+
+    def __init__(self, outfile: Union[str, BinaryIO], max_in_file: Optional[int] = None,
+                 buffer_size: int = WRITE_BUFFER_SIZE, compression: Optional[str] = None, debug: int = 0):
         """
-        Creates an option block.
+        Initialize the PcapWriter.
 
         Args:
-            code: Option code.
-            value: Option value (string).
+            outfile: The path to the output file, or a writable binary file object (for the first link type only).
+            max_in_file: Maximum number of packets per file (for splitting).
+            buffer_size: Maximum amount of bytes kept for each file before writing them to it.
+            compression: "gzip" or "zstd" to compress the output, by default taken from the suffix of the output file name.
+            debug: Debug level.
 
-        Returns:
-            The binary representation of the option block, including padding.
+        Raises:
+            ValueError: If the compression is not available.
         """
-        valuePad = 0
-        if len(value) % 4 > 0:
-            valuePad = 4-(len(value) % 4)
+        self.max_in_file = max_in_file
+        self.buffer_size = buffer_size
+        self.debug = debug
 
-        block = struct.pack(">H", code)
-        block += struct.pack(">H", len(value))
-        block += str.encode(value)
-        for i in range(valuePad):
-            block += struct.pack(">b", 0)
-        return block
+        # state of the output file of each link type
+        self.files: Dict[int, BinaryIO] = {}
+        self.fileNames: Dict[int, str] = {}
+        self.fileCounts: Dict[int, int] = {}
+        self.packetCounts: Dict[int, int] = {}
+        self.outputBuffers: Dict[int, bytearray] = {}
+        # packets not written because a file object holds only one link type, by their link type
+        self.skippedPackets: Dict[int, int] = {}
+
+        if not isinstance(outfile, (str, os.PathLike)):
+            # pluggable sink: the caller owns it, so it cannot be renamed or split
+            if max_in_file is not None:
+                raise ValueError("max_in_file requires the output to be a file name")
+            self.output_file_base = None
+            self.output_file_suffix = ''
+            self.compression = compression
+            self.sink: Optional[BinaryIO] = outfile
+            self.sinkWriter = compressed_writer(outfile, compression)
+            return
+
+        outfile = os.fspath(outfile)
+        (outfile, compression_suffix, suffix_compression) = split_compression_suffix(outfile)
+        self.compression = compression or suffix_compression
+        self.sink = None
+        # the files are opened with the first packets, but fail right away when the compression is not available
+        if not compression_available(self.compression):
+            raise ValueError("compression \"%s\" is not available" % (self.compression,))
+
+        # split file name, the link type and part number are inserted before the suffix
+        if outfile[-5:] == '.pcap':
+            self.output_file_base = outfile[:-5]
+            self.output_file_suffix = '.pcap' + compression_suffix
+        else:
+            self.output_file_base = outfile
+            self.output_file_suffix = compression_suffix
 
-    def blockEndOfOptions(self) -> bytes:
+    def fileName(self, linktype: int, part: Optional[int] = None) -> str:
         """
-        Creates an end of options block.
+        Returns the name of the output file for packets of the link type.
+
+        Args:
+            linktype: Link type of the packets.
+            part: Number of the part when the output is split.
 
         Returns:
-            The binary representation of the end of options block.
+            The file name.
         """
-        block = struct.pack(">H", 0)
-        block += struct.pack(">H", 0)
-        return block
+        name = self.output_file_base
+        if len(self.files) > 0 and linktype != next(iter(self.files)):
+            name += ".%s" % (self.LINKTYPE_NAMES.get(linktype, "linktype%i" % (linktype,)),)
+        if part is not None:
+            name += ".part%03i" % (part,)
+        return name + self.output_file_suffix
+
+    def openFile(self, linktype: int) -> None:
+        """
+        Opens the output file of the link type and writes its file header.
+
+        When the first file of a link type is split, it is renamed to the split format.
+
+        Args:
+            linktype: Link type of the packets written to the file.
+        """
+        if self.sink is not None:
+            self.files[linktype] = self.sinkWriter
+        elif linktype not in self.files:
+            self.fileCounts[linktype] = 1
+            self.fileNames[linktype] = self.fileName(linktype)
+            self.files[linktype] = open_compressed_output(self.fileNames[linktype], self.compression)
+        else:
+            self.flush(linktype)
+            self.files[linktype].close()
+            if self.fileCounts[linktype] == 1:  # if this was the first, original, file, rename it to the split format
+                newname = self.fileName(linktype, 1)
+                if self.debug >= 1:
+                    print("DEBUG: renaming original output file '%s' to '%s'" % (self.fileNames[linktype], newname,))
+                os.rename(self.fileNames[linktype], newname)
+            self.fileCounts[linktype] += 1
+            self.fileNames[linktype] = self.fileName(linktype, self.fileCounts[linktype])
+            self.files[linktype] = open_compressed_output(self.fileNames[linktype], self.compression)
+
+        if self.debug >= 1 and self.sink is None:
+            print("DEBUG: opening new output file '%s' for link type %i" % (self.fileNames[linktype], linktype,))
+
+        self.packetCounts[linktype] = 0
+        self.outputBuffers[linktype] = bytearray(self.FILE_HEADER.pack(self.MAGIC_NANOSECONDS, 2, 4, 0, 0, self.SNAPLEN, linktype))
+
+    def writePacket(self, packet: bytes, timestamp: int, iface: str, linktype: int = PcapNGBlocks.LINKTYPE_ETHERNET, comment: str = "") -> None:
+        """
+        Writes a single packet to the file of its link type.
+
+        With a file object as the output, packets of another link type than the first one are skipped.
+
+        Args:
+            packet: Packet data (binary).
+            timestamp: Timestamp in microseconds.
+            iface: Interface name, not stored in the libpcap format.
+            linktype: Link type of the interface.
+            comment: Comment string, not stored in the libpcap format.
+        """
+        if linktype not in self.files or (self.max_in_file is not None and self.packetCounts[linktype] >= self.max_in_file):
+            if self.sink is not None and len(self.files) > 0:
+                # another link type would need another file, the sink has the first one
+                self.skippedPackets[linktype] = self.skippedPackets.get(linktype, 0) + 1
+                return
+            self.openFile(linktype)
+
+        outputBuffer = self.outputBuffers[linktype]
+        outputBuffer += self.RECORD_HEADER.pack(timestamp // 1000000, (timestamp % 1000000) * 1000, len(packet), len(packet))
+        outputBuffer += packet
+        self.packetCounts[linktype] += 1
+
+        if len(outputBuffer) >= self.buffer_size:
+            self.flush(linktype)
+
+    def writeEnhancedPacket(self, block: bytearray, iface: str, linktype: int = PcapNGBlocks.LINKTYPE_ETHERNET) -> None:
+        """
+        Writes the packet of an already encoded Enhanced Packet Block to the file of its link type.
+
+        Args:
+            block: The EPB created by blockEnhancedPacket, with a timestamp in microseconds.
+            iface: Interface name, not stored in the libpcap format.
+            linktype: Link type of the interface.
+        """
+        (blockType, blockLength, ifaceIndex, timestamp, capturedLength, packetLength) = PcapNGBlocks.EPB_HEADER.unpack_from(block, 0)
+        self.writePacket(memoryview(block)[28:28+capturedLength], timestamp, iface, linktype)
+
+    def flush(self, linktype: int) -> None:
+        """
+        Writes the buffered packets of the link type to its file.
+
+        Args:
+            linktype: Link type of the packets.
+        """
+        outputBuffer = self.outputBuffers[linktype]
+        if len(outputBuffer) > 0:
+            self.files[linktype].write(outputBuffer)
+            outputBuffer.clear()
 
     def close(self) -> None:
         """
-        Closes the writer file.
+        Closes all output files, a caller provided file object is only flushed.
         """
-        if self.f:
-            self.f.close()
+        for (linktype, f) in self.files.items():
+            self.flush(linktype)
+            if self.sink is None:
+                f.close()
+        self.files = {}
+
+        if self.sink is not None:
+            if self.sinkWriter is not self.sink:
+                # finish the compressed stream, the caller provided file object itself stays open
+                self.sinkWriter.close()
+            self.sink.flush()
+
+        # like PcapNGWriter, leave an empty output file when there were no packets at all
+        if self.sink is None and len(self.fileNames) == 0:
+            open_compressed_output(self.fileName(PcapNGBlocks.LINKTYPE_ETHERNET), self.compression).close()
@@ -31,6 +31,27 @@ function renameFileTaskId(id) {
 }
 
 
+//poll the running conversions, reload the page when they are finished
+function pollConversionJobs() {
+  const pending = document.querySelectorAll(".conversion-job");
+  if (pending.length === 0) {
+    return;
+  }
+  Promise.all(Array.from(pending).map((element) =>
+    fetch(`/api/jobs/${element.dataset.jobId}`, { credentials: "same-origin" })
+      .then((res) => (res.ok ? res.json() : { status: "failed" }))
+  )).then((jobs) => {
+    if (jobs.some((job) => job.status === "done" || job.status === "failed")) {
+      window.location.href = "/";
+    } else {
+      setTimeout(pollConversionJobs, 2000);
+    }
+  }).catch(() => setTimeout(pollConversionJobs, 5000));
+}
+
+document.addEventListener("DOMContentLoaded", () => setTimeout(pollConversionJobs, 1000));
+
+
 //prevent enter key in textbox
 $("textarea").keydown(function(e){
   // Enter pressed
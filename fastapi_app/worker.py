@@ -0,0 +1,127 @@
+"""
+Standalone conversion worker.
+
+Converts the jobs queued by the server, so the conversions can be scaled apart from
+the API: run any number of these processes (or containers) on the same database,
+and EXTERNAL_WORKERS=true for the server to leave the conversions to them.
+
+Run with: python -m fastapi_app.worker
+"""
+import argparse
+import logging
+import signal
+import threading
+from typing import Callable, ContextManager, Optional
+
+from sqlmodel import Session
+
+from .core.config import settings
+from .core.database import create_db_and_tables, engine
+from .core.logging import log_conversion_error
+from .models.conversion import JOB_FAILED
+from .services.cache import ConversionCache
+from .services.converter import Convert2Pcap
+from .services.jobs import (JOB_ERROR, JOB_POLL_SECONDS, claim_job, conversion_arguments, finish_job,
+                            release_jobs, renew_lease, store_conversion, worker_name)
+
+logger = logging.getLogger("worker")
+
+
+class Worker:
+    '''Claims the queued jobs one after another and converts them in this process'''
+
+    def __init__(self, lease_seconds: int, poll_seconds: float = JOB_POLL_SECONDS,
+                 cache: Optional[ConversionCache] = None,
+                 session_factory: Callable[[], ContextManager[Session]] = lambda: Session(engine)):
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.cache = cache
+        self.session_factory = session_factory
+        self.name = worker_name("worker")
+        self.stopping = threading.Event()
+
+    def stop(self, *args) -> None:
+        '''Stops the worker after the job it is converting'''
+        self.stopping.set()
+
+    def run(self, exit_when_idle: bool = False) -> int:
+        '''Converts the jobs until stopped (or until there is none, with exit_when_idle), returns how many'''
+        logger.info(f"Conversion worker {self.name} started")
+        processed = 0
+        while not self.stopping.is_set():
+            if self.process_one():
+                processed += 1
+            elif exit_when_idle:
+                break
+            else:
+                self.stopping.wait(self.poll_seconds)
+        with self.session_factory() as session:
+            release_jobs(session, self.name)
+        logger.info(f"Conversion worker {self.name} stopped after {processed} jobs")
+        if self.cache is not None and self.cache.enabled:
+            logger.info(f"Conversion cache: {self.cache.evictions} evictions")
+        return processed
+
+    def process_one(self) -> bool:
+        '''Claims and converts one job, returns False if there was none'''
+        with self.session_factory() as session:
+            job = claim_job(session, self.name, self.lease_seconds)
+            if job is None:
+                return False
+            job_id = job.id
+            arguments = conversion_arguments(session, job)
+        if arguments is None:
+            with self.session_factory() as session:
+                finish_job(session, job_id, self.name, JOB_FAILED, error="Conversion task was deleted")
+            return True
+
+        logger.info(f"Converting job {job_id} ({arguments['fname']})")
+        converted = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job_id, converted), daemon=True)
+        heartbeat.start()
+        try:
+            result = Convert2Pcap.convert_blob(**arguments)
+        except Exception as e:
+            log_conversion_error(arguments["tid"], arguments["cid"], e)
+            with self.session_factory() as session:
+                finish_job(session, job_id, self.name, JOB_FAILED, error=JOB_ERROR)
+            return True
+        finally:
+            converted.set()
+            heartbeat.join()
+
+        with self.session_factory() as session:
+            if not store_conversion(session, job_id, self.name, self.cache, arguments, result):
+                logger.warning(f"Conversion job {job_id} was taken over or deleted, its result is dropped")
+        return True
+
+    def heartbeat(self, job_id: int, converted: threading.Event) -> None:
+        '''Renews the lease of the job until it is converted'''
+        while not converted.wait(self.lease_seconds / 3):
+            with self.session_factory() as session:
+                if not renew_lease(session, job_id, self.name, self.lease_seconds):
+                    logger.warning(f"Lost the lease of conversion job {job_id}")
+                    return
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Converts the queued conversion jobs.")
+    parser.add_argument("--lease", type=int, default=settings.JOB_LEASE_SECONDS,
+                        help="seconds a job stays claimed without a heartbeat (default %(default)s)")
+    parser.add_argument("--poll", type=float, default=JOB_POLL_SECONDS,
+                        help="seconds between looking for new jobs when idle (default %(default)s)")
+    parser.add_argument("--exit-when-idle", action="store_true",
+                        help="exit when there is no job to convert instead of waiting for more")
+    args = parser.parse_args(argv)
+
+    create_db_and_tables()
+    worker = Worker(lease_seconds=args.lease, poll_seconds=args.poll,
+                    cache=ConversionCache(max_bytes=settings.CONVERSION_CACHE_MB * 1024 * 1024))
+    # the job being converted is finished before exiting
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run(exit_when_idle=args.exit_when_idle)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,10 @@ export function FileList({ files, onConvert, onDelete, onRename }) {
     }
   };
 
+  // Converting from this page, or by a job queued/running since before the page was loaded
+  const isConverting = (file) =>
+    converting === file.id || file.job_status === 'queued' || file.job_status === 'running';
+
   const handleDelete = async (file) => {
     setMenuOpen(null);
     if (!confirm(`Delete "${file.content}"?`)) return;
@@ -91,6 +95,11 @@ export function FileList({ files, onConvert, onDelete, onRename }) {
                     <CheckCircle2 size={14} />
                     Converted
                   </span>
+                ) : isConverting(file) ? (
+                  <span style={styles.statusPending}>
+                    <Loader2 size={14} className="animate-spin" />
+                    Converting
+                  </span>
                 ) : (
                   <span style={styles.statusPending}>
                     <Clock size={14} />
@@ -120,10 +129,10 @@ export function FileList({ files, onConvert, onDelete, onRename }) {
                   <button
                     style={styles.actionBtn}
                     onClick={() => handleConvert(file)}
-                    disabled={converting === file.id}
-                    title="Convert to PCAP"
+                    disabled={isConverting(file)}
+                    title={file.job_status === 'failed' ? 'Conversion failed, convert again' : 'Convert to PCAP'}
                   >
-                    {converting === file.id ? (
+                    {isConverting(file) ? (
                       <Loader2 size={16} className="animate-spin" />
                     ) : (
                       <RefreshCw size={16} />
@@ -1,11 +1,27 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { Layout } from '../components/Layout';
 import { FileUpload } from '../components/FileUpload';
 import { FileList } from '../components/FileList';
 
+const JOB_POLL_INTERVAL_MS = 2000;
+
+const isJobActive = (status) => status === 'queued' || status === 'running';
+
+// Poll a conversion job until it is done or failed
+const waitForJob = async (jobId) => {
+  for (;;) {
+    const response = await fetch(`/api/jobs/${jobId}`, { credentials: 'same-origin' });
+    if (!response.ok) return null;
+    const job = await response.json();
+    if (!isJobActive(job.status)) return job;
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+  }
+};
+
 export function Dashboard() {
   const [files, setFiles] = useState([]);
   const [loading, setLoading] = useState(true);
+  const polledJobs = useRef(new Set());
 
   const fetchFiles = async () => {
     try {
@@ -25,6 +41,16 @@ export function Dashboard() {
     fetchFiles();
   }, []);
 
+  // Conversions started before the page was loaded are polled too
+  useEffect(() => {
+    files
+      .filter((file) => isJobActive(file.job_status) && !polledJobs.current.has(file.job_id))
+      .forEach((file) => {
+        polledJobs.current.add(file.job_id);
+        waitForJob(file.job_id).finally(fetchFiles);
+      });
+  }, [files]);
+
   const handleUpload = async (uploadFiles) => {
     const formData = new FormData();
     uploadFiles.forEach((file) => formData.append('files', file));
@@ -46,8 +72,14 @@ export function Dashboard() {
 
   const handleConvert = async (id) => {
     try {
-      const response = await fetch(`/convert/${id}`, { credentials: 'same-origin' });
-      if (response.ok || response.redirected) {
+      const response = await fetch(`/api/convert/${id}`, { method: 'POST', credentials: 'same-origin' });
+      if (response.ok) {
+        const job = await response.json();
+        polledJobs.current.add(job.id);
+        const finished = await waitForJob(job.id);
+        if (finished?.status === 'failed') {
+          console.error('Conversion failed:', finished.error);
+        }
         await fetchFiles();
       }
     } catch (error) {
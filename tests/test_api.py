@@ -3,24 +3,46 @@ API Tests for FortiGate Sniffer to PCAP Converter
 
 Run with: pytest tests/test_api.py -v
 """
+import gzip
+import hashlib
+import io
 import os
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
 import pytest
 from pathlib import Path
 from unittest.mock import patch
+from contextlib import nullcontext
+from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
-from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel import SQLModel, Session, create_engine, select
 from sqlmodel.pool import StaticPool
+from sqlalchemy import inspect
 
 # Set test environment before importing app
 os.environ["SECRET_KEY"] = "test-secret-key-for-testing-purposes-only-32chars"
 os.environ["ENVIRONMENT"] = "development"
 os.environ["DEBUG"] = "false"
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ["BLOB_DIR"] = tempfile.mkdtemp(prefix="blobs")
 
 from fastapi_app.main import app
-from fastapi_app.core.database import get_session
+from fastapi_app.core import database
+from fastapi_app.core.database import add_missing_columns, files_in_database, get_session
 from fastapi_app.models.user import User
-from fastapi_app.models.conversion import Conversion
+from fastapi_app.models.conversion import Conversion, ConversionJob
 from fastapi_app.routers import auth
+from fastapi_app.models.blob import Blob
+from fastapi_app.migrate import migrate_blobs
+from fastapi_app.services.blobs import FileBlobStore, add_blob, get_blob_store, read_blob, release_blobs
+from fastapi_app.services.cache import ConversionCache, options_digest
+from fastapi_app.services.converter import Convert2Pcap
+from fastapi_app.services.jobs import MAX_JOB_ATTEMPTS, claim_job, finish_job, renew_lease
+from fastapi_app.services.pool import ConversionPool
+from tests.test_sniftran import TUNNEL_LIST
 
 
 # Test database setup
@@ -48,8 +70,10 @@ def client_fixture(session: Session):
     # Disable rate limiting for tests
     auth.limiter.enabled = False
 
-    client = TestClient(app)
-    yield client
+    # entering the client runs the lifespan, which starts the conversion workers
+    with TestClient(app) as client:
+        app.state.job_queue.session_factory = lambda: nullcontext(session)
+        yield client
 
     # Re-enable rate limiting and clean up
     auth.limiter.enabled = True
@@ -75,6 +99,19 @@ filters=[port not 22]
 """
 
 
+def wait_for_job(client: TestClient, headers: dict, job_id: int, timeout: float = 30) -> dict:
+    """Poll a conversion job until it is done or failed."""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(f"/jobs/{job_id}", headers=headers)
+        assert response.status_code == 200
+        job = response.json()
+        if job["status"] in ("done", "failed"):
+            return job
+        assert time.monotonic() < deadline, f"job {job_id} still {job['status']}"
+        time.sleep(0.05)
+
+
 class TestAuth:
     """Test authentication endpoints."""
 
@@ -305,10 +342,56 @@ class TestConversion:
         )
         conversion_id = upload_response.json()[0]["id"]
 
-        # Convert the file
+        # Convert the file, the conversion is queued
         response = client.post(f"/convert/{conversion_id}", headers=headers)
-        assert response.status_code == 200
-        assert "packets" in response.json()["message"]
+        assert response.status_code == 202
+        job = response.json()
+        assert job["conversion_id"] == conversion_id
+        assert job["status"] in ("queued", "running", "done")
+        assert response.headers["location"] == f"/jobs/{job['id']}"
+
+        job = wait_for_job(client, headers, job["id"])
+        assert job["status"] == "done"
+        assert job["packets"] == 1
+        assert job["date_started"] is not None
+        assert job["date_finished"] is not None
+        assert job["error"] is None
+
+        conversions = client.get("/conversions", headers=headers).json()
+        assert conversions[0]["has_converted_data"] is True
+        assert conversions[0]["job_status"] == "done"
+
+    def test_convert_failure(self, client: TestClient):
+        """Test that a failing conversion is reported by its job."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", b"not a sniffer output", "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        # the worker processes do not see patches, the pool itself fails
+        with patch.object(ConversionPool, "run", side_effect=Exception("boom")):
+            response = client.post(f"/convert/{conversion_id}", headers=headers)
+            job = wait_for_job(client, headers, response.json()["id"])
+        assert job["status"] == "failed"
+        assert "boom" not in job["error"]
+        assert job["packets"] is None
+
+    def test_job_of_other_user(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that jobs of other users are not found."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        job = client.post(f"/convert/{upload_response.json()[0]['id']}", headers=headers).json()
+
+        other_headers = self._get_auth_headers(client, "other@example.com")
+        assert client.get(f"/jobs/{job['id']}", headers=other_headers).status_code == 404
+        assert client.get("/jobs/9999", headers=headers).status_code == 404
 
     def test_convert_nonexistent(self, client: TestClient):
         """Test converting nonexistent file."""
@@ -332,6 +415,56 @@ class TestConversion:
         assert response.status_code == 200
         assert response.content == sample_sniffer_file
 
+    def test_download_esp_sa(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test downloading the Wireshark esp_sa rows of the IPSec tunnels found by the conversion."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files=[("files", ("vpn.txt", TUNNEL_LIST + sample_sniffer_file, "text/plain")),
+                   ("files", ("test.txt", sample_sniffer_file, "text/plain"))]
+        )
+        (with_tunnels, without_tunnels) = [conversion["id"] for conversion in upload_response.json()]
+        assert client.get(f"/conversions/{with_tunnels}/download/esp_sa", headers=headers).status_code == 400
+        for conversion_id in (with_tunnels, without_tunnels):
+            job = client.post(f"/convert/{conversion_id}", headers=headers).json()
+            assert wait_for_job(client, headers, job["id"])["status"] == "done"
+
+        response = client.get(f"/conversions/{with_tunnels}/download/esp_sa", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "esp_sa" in response.headers["content-disposition"]
+        rows = response.text.splitlines()
+        assert len(rows) == 2
+        assert any('"0xa1b2c3d4"' in row for row in rows)
+        assert any('"0x4d3c2b1a"' in row for row in rows)
+
+        response = client.get(f"/conversions/{without_tunnels}/download/esp_sa", headers=headers)
+        assert response.status_code == 404
+        assert "No IPSec tunnels" in response.json()["detail"]
+
+    def test_download_bundle(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test downloading the converted file and its esp_sa rows in one ZIP archive."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("vpn.txt", TUNNEL_LIST + sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+        assert client.get(f"/conversions/{conversion_id}/download/bundle", headers=headers).status_code == 400
+        job = client.post(f"/convert/{conversion_id}", headers=headers).json()
+        wait_for_job(client, headers, job["id"])
+
+        response = client.get(f"/conversions/{conversion_id}/download/bundle", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        assert "vpn.txt.zip" in response.headers["content-disposition"]
+        with zipfile.ZipFile(io.BytesIO(response.content)) as bundle:
+            assert bundle.namelist() == ["vpn.txt.pcapng", "esp_sa"]
+            assert bundle.read("vpn.txt.pcapng") == client.get(f"/conversions/{conversion_id}/download/pcap", headers=headers).content
+            assert bundle.read("esp_sa").decode() == client.get(f"/conversions/{conversion_id}/download/esp_sa", headers=headers).text
+
     def test_download_pcap_not_converted(self, client: TestClient, sample_sniffer_file: bytes):
         """Test downloading PCAP before conversion."""
         headers = self._get_auth_headers(client)
@@ -358,7 +491,8 @@ class TestConversion:
             files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
         )
         conversion_id = upload_response.json()[0]["id"]
-        client.post(f"/convert/{conversion_id}", headers=headers)
+        job = client.post(f"/convert/{conversion_id}", headers=headers).json()
+        wait_for_job(client, headers, job["id"])
 
         # Download PCAP
         response = client.get(f"/conversions/{conversion_id}/download/pcap", headers=headers)
@@ -366,6 +500,107 @@ class TestConversion:
         # PCAPNG files start with magic bytes
         assert len(response.content) > 0
 
+    def test_download_legacy_pcap(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test converting to the legacy PCAP format and downloading it."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        response = client.post(f"/convert/{conversion_id}?format=pcap", headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["status"] == "done"
+
+        response = client.get(f"/conversions/{conversion_id}/download/pcap", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/vnd.tcpdump.pcap"
+        assert ".pcap" in response.headers["content-disposition"]
+        # nanosecond libpcap magic
+        assert response.content[:4] == b"\xa1\xb2\x3c\x4d"
+
+    def test_download_compressed_pcap(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that a conversion compressed with gzip is stored and downloaded compressed."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        response = client.post(f"/convert/{conversion_id}?compression=gzip", headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["status"] == "done"
+
+        response = client.get(f"/conversions/{conversion_id}/download/pcap", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/gzip"
+        assert ".pcapng.gz" in response.headers["content-disposition"]
+        assert gzip.decompress(response.content)[:4] == b"\x0a\x0d\x0d\x0a"
+
+    def test_convert_with_interface_filters(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that only packets from/to the included and not excluded interfaces are converted."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        response = client.post(f"/convert/{conversion_id}?include=wan1&include=port1", headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["packets"] == 1
+
+        response = client.post(f"/convert/{conversion_id}?exclude=wan1", headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["packets"] == 0
+
+    def test_convert_with_packet_filter(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that only packets matching the filter expression are converted."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        response = client.post(f"/convert/{conversion_id}", params={"filter": "arp and host 10.108.18.77"}, headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["packets"] == 1
+
+        response = client.post(f"/convert/{conversion_id}", params={"filter": "tcp port 443"}, headers=headers)
+        assert response.status_code == 202
+        assert wait_for_job(client, headers, response.json()["id"])["packets"] == 0
+
+        response = client.post(f"/convert/{conversion_id}", params={"filter": "tcp port"}, headers=headers)
+        assert response.status_code == 400
+
+    def test_convert_drops_truncated_packets(self):
+        """Test that packets shorter than their IP header are counted and not converted."""
+        sample = (Path(__file__).parent / "samples" / "test2.txt").read_bytes()
+        converter = Convert2Pcap(1, 1, 1, "test2.txt", sample)
+        (_, packets) = converter.convert_to_pcap()
+        assert packets == "1403"
+        assert converter.packets_truncated == 1
+
+    def test_convert_unknown_format(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that unknown output formats are rejected."""
+        headers = self._get_auth_headers(client)
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("test.txt", sample_sniffer_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        response = client.post(f"/convert/{conversion_id}?format=erf", headers=headers)
+        assert response.status_code == 422
+
     def test_delete_conversion(self, client: TestClient, sample_sniffer_file: bytes):
         """Test deleting a conversion."""
         headers = self._get_auth_headers(client)
@@ -518,3 +753,390 @@ class TestFilenameSanitization:
         assert "|" not in filename
         assert "?" not in filename
         assert "*" not in filename
+
+
+class TestConversionPool:
+    """Test that conversions do not block the other requests."""
+
+    def test_listing_latency_during_conversion(self, client: TestClient):
+        """Test that /conversions answers as fast while a large file converts in the worker processes."""
+        client.post(
+            "/signup",
+            json={"email": "pool@example.com", "password": "SecurePassword123", "first_name": "Pool"}
+        )
+        token = client.post(
+            "/token",
+            data={"username": "pool@example.com", "password": "SecurePassword123"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        large_file = (Path(__file__).parent / "samples" / "test3.txt").read_bytes() * 40
+        upload_response = client.post(
+            "/upload",
+            headers=headers,
+            files={"files": ("large.txt", large_file, "text/plain")}
+        )
+        conversion_id = upload_response.json()[0]["id"]
+
+        def list_latency() -> float:
+            start = time.perf_counter()
+            assert client.get("/conversions", headers=headers).status_code == 200
+            return time.perf_counter() - start
+
+        idle = max(list_latency() for _ in range(5))
+
+        conversion_start = time.perf_counter()
+        job = client.post(f"/convert/{conversion_id}", headers=headers).json()
+        busy = []
+        while client.get(f"/jobs/{job['id']}", headers=headers).json()["status"] in ("queued", "running"):
+            busy.append(list_latency())
+            time.sleep(0.01)
+        conversion_time = time.perf_counter() - conversion_start
+
+        assert client.get(f"/jobs/{job['id']}", headers=headers).json()["status"] == "done"
+        assert client.get(f"/conversions/{conversion_id}/download/pcap", headers=headers).status_code == 200
+
+        # a blocked event loop would answer only after the whole conversion
+        assert len(busy) >= 5
+        assert max(busy) < max(10 * idle, 0.2)
+        assert max(busy) < conversion_time / 3
+
+
+class TestBlobStore:
+    """Test that the files are stored once in the blob store, by their content."""
+
+    def test_file_store(self, tmp_path: Path):
+        """Test that the files are written whole to sharded directories, and only once."""
+        store = FileBlobStore(str(tmp_path))
+        key = store.put(b"sniffer output")
+        assert key == hashlib.sha256(b"sniffer output").hexdigest()
+        assert Path(store.path(key)) == tmp_path / key[:2] / key[2:4] / key
+        assert store.put(b"sniffer output") == key
+        assert store.read(key) == b"sniffer output"
+        assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == [key]
+
+        store.delete(key)
+        assert not store.exists(key)
+        with pytest.raises(KeyError):
+            store.read(key)
+        with pytest.raises(KeyError):
+            store.path("../../etc/passwd")
+
+    def test_encrypted_store(self, tmp_path: Path):
+        """Test that with a secret the files are encrypted and their keys tell nothing of their content."""
+        store = FileBlobStore(str(tmp_path), secret="database-key-of-at-least-32-chars")
+        key = store.put(b"sniffer output")
+        assert key != hashlib.sha256(b"sniffer output").hexdigest()
+        assert b"sniffer output" not in Path(store.path(key)).read_bytes()
+        assert store.read(key) == b"sniffer output"
+        assert FileBlobStore(str(tmp_path), secret="another-key-of-at-least-32-chars!").key(b"sniffer output") != key
+
+    def test_references(self, session: Session, tmp_path: Path):
+        """Test that a file is deleted with its last reference."""
+        store = FileBlobStore(str(tmp_path))
+        (key, size) = add_blob(session, b"converted", store)
+        assert add_blob(session, b"converted", store) == (key, size)
+        assert session.get(Blob, key).refs == 2 and size == 9
+
+        release_blobs(session, key, None, store=store)
+        assert store.exists(key)
+        release_blobs(session, key, store=store)
+        assert not store.exists(key)
+        assert session.get(Blob, key) is None
+
+    def test_failed_write_releases_reference(self, session: Session, tmp_path: Path):
+        """Test that a file which cannot be written leaves no reference to it."""
+        class FailingStore(FileBlobStore):
+            def write(self, key: str, data: bytes) -> None:
+                raise OSError("No space left on device")
+
+        store = FailingStore(str(tmp_path))
+        with pytest.raises(OSError):
+            add_blob(session, b"converted", store)
+        assert session.get(Blob, store.key(b"converted")) is None
+
+        # another reference to a stored file is kept
+        (key, _) = add_blob(session, b"converted", FileBlobStore(str(tmp_path)))
+        with pytest.raises(OSError):
+            add_blob(session, b"converted", store)
+        session.expire_all()
+        assert session.get(Blob, key).refs == 1
+        assert store.exists(key)
+
+    def test_identical_uploads_stored_once(self, client: TestClient, session: Session, sample_sniffer_file: bytes):
+        """Test that the same file uploaded twice is stored once and deleted with the last task."""
+        client.post(
+            "/signup",
+            json={"email": "blobs@example.com", "password": "SecurePassword123", "first_name": "Blobs"}
+        )
+        token = client.post(
+            "/token",
+            data={"username": "blobs@example.com", "password": "SecurePassword123"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        ids = [
+            client.post("/upload", headers=headers, files={"files": (name, sample_sniffer_file, "text/plain")}).json()[0]["id"]
+            for name in ("first.txt", "second.txt")
+        ]
+        (key,) = {session.get(Conversion, id).data_key for id in ids}
+        assert session.get(Conversion, ids[0]).data_size == len(sample_sniffer_file)
+        assert session.get(Blob, key).refs == 2
+
+        assert client.delete(f"/conversions/{ids[0]}", headers=headers).status_code == 200
+        assert client.get(f"/conversions/{ids[1]}/download/original", headers=headers).content == sample_sniffer_file
+        assert client.delete(f"/conversions/{ids[1]}", headers=headers).status_code == 200
+        assert not get_blob_store().exists(key)
+
+    def test_migration(self, tmp_path: Path, sample_sniffer_file: bytes):
+        """Test that the files stored in the database by the older versions are moved to the blob store."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(User(id=1, email="old@example.com", hashed_password="x"))
+            session.commit()
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DROP TABLE conversion")
+            connection.exec_driver_sql("DROP TABLE conversioncacheentry")
+            connection.exec_driver_sql(
+                "CREATE TABLE conversion (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, data BLOB NOT NULL, "
+                "date_created DATETIME NOT NULL, data_converted BLOB, user_id INTEGER REFERENCES user (id))"
+            )
+            for (id, converted) in ((1, b"pcapng"), (2, None), (3, b"pcapng")):
+                connection.exec_driver_sql(
+                    "INSERT INTO conversion VALUES (?, ?, ?, '2024-05-01 12:00:00.000000', ?, 1)",
+                    (id, f"capture{id}.txt", sample_sniffer_file, converted),
+                )
+            connection.exec_driver_sql("INSERT INTO conversionjob (id, conversion_id, user_id, status, options, "
+                                       "date_created, attempts) VALUES (1, 1, 1, 'done', '{}', '2024-05-01 12:00:00', 1)")
+        assert files_in_database(engine)
+
+        store = FileBlobStore(str(tmp_path / "blobs"))
+        assert migrate_blobs(engine, store) == 3
+        assert not files_in_database(engine)
+        assert migrate_blobs(engine, store) == 0
+
+        with Session(engine) as session:
+            conversions = session.exec(select(Conversion).order_by(Conversion.id)).all()
+            assert [conversion.content for conversion in conversions] == ["capture1.txt", "capture2.txt", "capture3.txt"]
+            assert conversions[0].date_created == datetime(2024, 5, 1, 12)
+            assert all(store.read(conversion.data_key) == sample_sniffer_file for conversion in conversions)
+            assert [conversion.converted_size for conversion in conversions] == [6, None, 6]
+            assert store.read(conversions[2].converted_key) == b"pcapng"
+            assert conversions[0].data_hash == hashlib.sha256(sample_sniffer_file).hexdigest()
+            assert session.get(Blob, conversions[0].data_key).refs == 3
+            assert session.get(Blob, conversions[0].converted_key).refs == 2
+            assert session.get(ConversionJob, 1).conversion_id == 1
+        assert "ix_conversion_data_hash" in {index["name"] for index in inspect(engine).get_indexes("conversion")}
+
+
+class TestConversionCache:
+    """Test that repeated conversions of the same file are copied from the cache."""
+
+    def test_repeated_upload_copied_from_cache(self, client: TestClient, sample_sniffer_file: bytes):
+        """Test that the same file uploaded again is converted without any worker."""
+        client.post(
+            "/signup",
+            json={"email": "cache@example.com", "password": "SecurePassword123", "first_name": "Cache"}
+        )
+        token = client.post(
+            "/token",
+            data={"username": "cache@example.com", "password": "SecurePassword123"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        (first, second) = [
+            client.post("/upload", headers=headers, files={"files": (name, sample_sniffer_file, "text/plain")}).json()[0]["id"]
+            for name in ("first.txt", "second.txt")
+        ]
+
+        job = client.post(f"/convert/{first}", headers=headers).json()
+        assert job["status"] == "queued"
+        assert wait_for_job(client, headers, job["id"])["status"] == "done"
+
+        # converted the same way, the result is there right away
+        job = client.post(f"/convert/{second}", headers=headers, params={"format": "pcapng", "include": []}).json()
+        assert job["status"] == "done" and job["packets"] == 1
+        downloads = [client.get(f"/conversions/{id}/download/pcap", headers=headers).content for id in (first, second)]
+        assert downloads[0] == downloads[1]
+
+        # converted another way, it is converted again
+        job = client.post(f"/convert/{second}", headers=headers, params={"format": "pcap"}).json()
+        assert job["status"] == "queued"
+        wait_for_job(client, headers, job["id"])
+        assert client.get(f"/conversions/{second}/download/pcap", headers=headers).content != downloads[0]
+
+        assert app.state.conversion_cache.stats() == dict(hits=1, misses=2, evictions=0)
+
+    def test_options_digest(self):
+        """Test that the options converting the same way have the same digest."""
+        default = options_digest({})
+        assert options_digest(dict(output_format="pcapng", compression=None, interfaces_include=[])) == default
+        assert options_digest(dict(tid=1, fname="other.txt", file_to_convert=b"")) == default
+        assert options_digest(dict(output_format="pcap")) != default
+        assert (options_digest(dict(interfaces_include=["port1", "port2"]))
+                == options_digest(dict(interfaces_include=["port2", "port1"])))
+        assert options_digest(dict(interfaces_include=["port1"])) != options_digest(dict(interfaces_exclude=["port1"]))
+
+    def test_least_recently_used_evicted(self, session: Session):
+        """Test that the cache keeps within its size by evicting the least recently used conversions."""
+        cache = ConversionCache(max_bytes=10)
+        keys = {name: add_blob(session, name.encode() * 4)[0] for name in "abc"}
+        assert cache.store(session, "a", "options", keys["a"], 4, 1)
+        assert cache.store(session, "b", "options", keys["b"], 4, 2)
+        assert not cache.store(session, "a", "options", keys["a"], 4, 1)
+        assert not cache.store(session, "large", "options", keys["a"], 11, 1)
+        assert cache.lookup(session, "a", "options").packets == 1
+
+        assert cache.store(session, "c", "options", keys["c"], 4, 3)
+        assert cache.lookup(session, "b", "options") is None
+        assert cache.lookup(session, "a", "options").hits == 2
+        assert read_blob(cache.lookup(session, "c", "options").converted_key) == b"cccc"
+        assert cache.stats() == dict(hits=3, misses=1, evictions=1)
+        # the evicted file is still referenced once, by the conversion it was added for
+        assert session.get(Blob, keys["b"]).refs == 1
+        assert session.get(Blob, keys["a"]).refs == 2
+
+        assert not ConversionCache(max_bytes=0).store(session, "a", "other", keys["a"], 4, 1)
+
+    def test_columns_added_to_older_database(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+        """Test that the server refuses a database lacking columns and the migration adds them, required ones too."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE conversion (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, data_key VARCHAR NOT NULL, "
+                "data_size INTEGER NOT NULL, date_created DATETIME NOT NULL, converted_key VARCHAR, converted_size INTEGER, "
+                "user_id INTEGER)"
+            )
+            connection.exec_driver_sql(
+                "CREATE TABLE conversionjob (id INTEGER PRIMARY KEY, conversion_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+                "status VARCHAR NOT NULL, options VARCHAR NOT NULL, date_created DATETIME NOT NULL, date_started DATETIME, "
+                "date_finished DATETIME, packets INTEGER, error VARCHAR)"
+            )
+            connection.exec_driver_sql("INSERT INTO conversionjob VALUES (1, 1, 1, 'done', '{}', '2024-05-01 12:00:00', NULL, NULL, 5, NULL)")
+        store = FileBlobStore(str(tmp_path / "blobs"))
+        data_key = store.put(b"uploaded")
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"INSERT INTO conversion VALUES (1, 'a.txt', '{data_key}', 8, '2024-05-01 12:00:00', NULL, NULL, 1)")
+        monkeypatch.setattr(database, "engine", engine)
+        with pytest.raises(RuntimeError, match="conversionjob.attempts"):
+            database.create_db_and_tables()
+
+        assert migrate_blobs(engine, store) == 0
+        assert add_missing_columns(engine) == []
+        database.create_db_and_tables()
+
+        inspector = inspect(engine)
+        columns = {column["name"] for column in inspector.get_columns("conversion")}
+        assert {"data_hash", "options_hash"} <= columns
+        assert "ix_conversion_data_hash" in {index["name"] for index in inspector.get_indexes("conversion")}
+        with Session(engine) as session:
+            job = session.get(ConversionJob, 1)
+            assert (job.attempts, job.worker, job.packets) == (0, None, 5)
+            # the digest of the upload is computed by the migration, not by the server
+            assert session.get(Conversion, 1).data_hash == hashlib.sha256(b"uploaded").hexdigest()
+
+    def test_required_column_without_default(self, tmp_path: Path):
+        """Test that a required column without a server default is reported instead of skipped."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE blob (key VARCHAR PRIMARY KEY, refs INTEGER NOT NULL, date_created DATETIME NOT NULL)")
+        with pytest.raises(RuntimeError, match="blob.size"):
+            add_missing_columns(engine)
+        assert "size" not in {column["name"] for column in inspect(engine).get_columns("blob")}
+
+
+class TestWorker:
+    """Test the leased job queue shared by the conversion workers."""
+
+    @staticmethod
+    def _add_jobs(session: Session, sample: bytes, count: int) -> list:
+        """Create a user with count uploaded files, each with a queued job."""
+        user = User(email="worker@example.com", hashed_password="x")
+        session.add(user)
+        session.commit()
+        jobs = []
+        for i in range(count):
+            (data_key, data_size) = add_blob(session, sample)
+            conversion = Conversion(content=f"capture{i}.txt", data_key=data_key, data_size=data_size, user_id=user.id)
+            session.add(conversion)
+            session.commit()
+            job = ConversionJob(conversion_id=conversion.id, user_id=user.id)
+            session.add(job)
+            session.commit()
+            jobs.append(job.id)
+        return jobs
+
+    def test_lease(self, session: Session, sample_sniffer_file: bytes):
+        """Test that a job is claimed by one worker at a time and reclaimed when its lease expires."""
+        (job_id,) = self._add_jobs(session, sample_sniffer_file, 1)
+
+        job = claim_job(session, "first", lease_seconds=60)
+        assert job.id == job_id and job.status == "running" and job.worker == "first" and job.attempts == 1
+        assert claim_job(session, "second", lease_seconds=60) is None
+        assert renew_lease(session, job_id, "first", lease_seconds=60)
+        assert not renew_lease(session, job_id, "second", lease_seconds=60)
+
+        # the first worker stopped renewing its lease
+        job.lease_expires = datetime.utcnow() - timedelta(seconds=1)
+        session.add(job)
+        session.commit()
+        job = claim_job(session, "second", lease_seconds=60)
+        assert job.worker == "second" and job.attempts == 2
+
+        # only the worker holding the lease records the result
+        assert not finish_job(session, job_id, "first", "done", packets=1, converted_key="first", converted_size=1)
+        assert finish_job(session, job_id, "second", "done", packets=1, converted_key="second", converted_size=1)
+        session.refresh(job)
+        assert job.status == "done" and job.packets == 1
+        assert session.get(Conversion, job.conversion_id).converted_key == "second"
+
+    def test_job_given_up_after_attempts(self, session: Session, sample_sniffer_file: bytes):
+        """Test that a job whose workers keep dying is failed instead of claimed again."""
+        (job_id,) = self._add_jobs(session, sample_sniffer_file, 1)
+        for attempt in range(MAX_JOB_ATTEMPTS):
+            job = claim_job(session, f"worker{attempt}", lease_seconds=60)
+            job.lease_expires = datetime.utcnow() - timedelta(seconds=1)
+            session.add(job)
+            session.commit()
+
+        assert claim_job(session, "last", lease_seconds=60) is None
+        job = session.get(ConversionJob, job_id)
+        session.refresh(job)
+        assert job.status == "failed" and job.error
+
+    def test_worker_processes_share_database(self, tmp_path: Path, sample_sniffer_file: bytes):
+        """Test that worker processes on one SQLite database convert every job once, also those of a crashed worker."""
+        database_url = f"sqlite:///{tmp_path / 'jobs.db'}"
+        engine = create_engine(database_url)
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            jobs = self._add_jobs(session, sample_sniffer_file, 6)
+            # claimed by a worker which died without finishing it
+            crashed = session.get(ConversionJob, jobs[0])
+            crashed.status = "running"
+            crashed.worker = "crashed"
+            crashed.attempts = 1
+            crashed.lease_expires = datetime.utcnow() - timedelta(seconds=1)
+            session.add(crashed)
+            session.commit()
+
+        environment = dict(os.environ, DATABASE_URL=database_url)
+        workers = [
+            subprocess.Popen([sys.executable, "-m", "fastapi_app.worker", "--exit-when-idle", "--poll", "0.1"],
+                             cwd=Path(__file__).parent.parent, env=environment,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for _ in range(3)
+        ]
+        for worker in workers:
+            (_, errors) = worker.communicate(timeout=120)
+            assert worker.returncode == 0, errors.decode()
+
+        with Session(engine) as session:
+            finished = session.exec(select(ConversionJob).order_by(ConversionJob.id)).all()
+            assert [job.status for job in finished] == ["done"] * 6
+            assert [job.attempts for job in finished] == [2, 1, 1, 1, 1, 1]
+            assert all(job.packets == 1 and job.lease_expires is None for job in finished)
+            conversions = session.exec(select(Conversion)).all()
+            assert all(read_blob(conversion.converted_key).startswith(b"\x0a\x0d\x0d\x0a") for conversion in conversions)
+            # the same file converted the same way is stored once
+            assert len({conversion.converted_key for conversion in conversions}) == 1
+            assert session.get(Blob, conversions[0].converted_key).refs >= 6
@@ -0,0 +1,606 @@
+"""
+Tests for the sniftran conversion library
+
+Run with: pytest tests/test_sniftran.py -v
+"""
+import bz2
+import gzip
+import io
+import lzma
+import re
+import struct
+import sys
+import zipfile
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from fastapi_app.sniftran import (IPSec, PcapNGWriter, PcapWriter, DataSource_File, DataSource_Bytes, DataSource_MMap, Packet, PacketFilter, PacketFormatter,
+                                  PacketParser, expected_packet_size, find_truncated, iter_packets, open_datasource, iter_formatted_parallel, parse_timezone)
+from fastapi_app.sniftran import cli
+
+SAMPLES_DIR = Path(__file__).parent / "samples"
+
+# output of "diagnose vpn tunnel list" (shortened) with made up keys
+TUNNEL_LIST = b"""name=vpn-to-b ver=1 serial=1 192.0.2.1:0->198.51.100.7:0 tun_id=198.51.100.7 dst_mtu=1500
+  proxyid=vpn-to-b proto=0 sa=1 ref=2 serial=1
+  dec: spi=4d3c2b1a esp=aes key=16 00112233445566778899aabbccddeeff
+       ah=sha1 key=20 0102030405060708090a0b0c0d0e0f1011121314
+  enc: spi=a1b2c3d4 esp=aes key=16 ffeeddccbbaa99887766554433221100
+       ah=sha1 key=20 1413121110090807060504030201000f0e0d0c0b
+  dec:pkts/bytes=0/0, enc:pkts/bytes=0/0
+"""
+
+
+def read_blocks(data: bytes):
+    """Split pcapng data into a list of (block type, block body) tuples."""
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_type, block_length = struct.unpack_from(">II", data, offset)
+        trailer, = struct.unpack_from(">I", data, offset + block_length - 4)
+        assert trailer == block_length
+        blocks.append((block_type, data[offset + 8:offset + block_length - 4]))
+        offset += block_length
+    return blocks
+
+
+class TestIterPackets:
+    """Test the packet iterator."""
+
+    def test_iter_packets_from_file(self):
+        """Test that packets are assembled with their header information."""
+        packets = list(iter_packets(SAMPLES_DIR / "test3short.txt"))
+        assert len(packets) == 1
+        packet = packets[0]
+        assert len(packet.data) == 60
+        assert packet.data[:6] == b"\xff" * 6
+        assert packet.ts_us == 806164
+        assert packet.iface == "wan1"
+        assert packet.direction == "in"
+        assert packet.comment() == "(in)  wan1"
+
+    def test_iter_packets_from_data_source(self):
+        """Test iterating over an already opened data source."""
+        ds = DataSource_File(str(SAMPLES_DIR / "test3.txt"))
+        try:
+            packets = list(iter_packets(ds))
+        finally:
+            ds.close()
+        assert len(packets) == 218
+        assert [p.line for p in packets] == sorted(p.line for p in packets)
+
+    def test_reused_buffer_matches_new_bytearrays(self):
+        """Test that packets assembled in the reused buffer have the same content."""
+        for name in ("test3.txt", "fe.txt", "damaged.txt"):
+            expected = [bytes(packet.data) for packet in iter_packets(SAMPLES_DIR / name)]
+            reused = [bytes(packet.data) for packet in iter_packets(SAMPLES_DIR / name, reuse_buffer=True)]
+            assert reused == expected, name
+
+    def test_reused_buffer_zeroes_missing_lines(self):
+        """Test that a missing line is zeros even if the previous packet left data in the buffer."""
+        data = (b"1.000001 port1 in a\n"
+                b"0x0000\t ffff ffff ffff ffff ffff ffff ffff ffff\t................\n"
+                b"0x0010\t ffff ffff ffff ffff ffff ffff ffff ffff\t................\n"
+                b"0x0020\t ffff ffff\t....\n"
+                b"1.000002 port1 in b\n"
+                b"0x0000\t 0101 0101 0101 0101 0101 0101 0101 0101\t................\n"
+                b"0x0020\t 0202 0202\t....\n")
+        packets = [bytes(packet.data) for packet in iter_packets(DataSource_Bytes(data), reuse_buffer=True)]
+        assert packets[1] == b"\x01" * 16 + b"\x00" * 16 + b"\x02" * 4
+
+    def test_mmap_source_matches_text_source(self):
+        """Test that the bytes-mode source yields the same packets as the text-mode one."""
+        for sample in ("test3.txt", "fe.txt", "fac2.txt", "testha.txt"):
+            text_ds = DataSource_File(str(SAMPLES_DIR / sample))
+            mmap_ds = DataSource_MMap(str(SAMPLES_DIR / sample))
+            try:
+                text_packets = [(p.data, p.ts_us, p.iface, p.direction) for p in iter_packets(text_ds)]
+                mmap_packets = [(p.data, p.ts_us, p.iface, p.direction) for p in iter_packets(mmap_ds)]
+            finally:
+                text_ds.close()
+                mmap_ds.close()
+            assert text_packets == mmap_packets
+
+    def test_skip_and_limit_match_slicing(self):
+        """Test that skipped packets are scanned to the same boundaries as the assembled ones."""
+        for sample in ("test3.txt", "fe.txt", "fac2.txt", "damaged.txt"):
+            for engine in ("scalar", "batch"):
+                expected = [(bytes(p.data), p.ts_us, p.iface, p.line) for p in iter_packets(SAMPLES_DIR / sample, engine=engine)]
+                for (skip, limit) in ((1, None), (5, 3), (len(expected) - 1, 10), (len(expected), None)):
+                    packets = [(bytes(p.data), p.ts_us, p.iface, p.line)
+                               for p in iter_packets(SAMPLES_DIR / sample, engine=engine, skip=skip, limit=limit)]
+                    assert packets == expected[skip:None if limit is None else skip + limit], (sample, engine, skip, limit)
+
+    def test_interface_filter_before_skip_and_limit(self):
+        """Test that packets rejected by the interface filter are passed over and do not count for skip and limit."""
+        data = b"".join(b"1.%06i %s in a\n0x0000\t %02x00 0000 0000 0000\t........\n0x0010\t 0000\t..\n" % (i, iface, i)
+                        for (i, iface) in enumerate((b"port1", b"port2") * 5))
+        accepts = PacketFormatter(interfaces_include={"port2"}).accepts
+        packets = list(iter_packets(DataSource_Bytes(data), skip=2, limit=2, interface_filter=accepts))
+        assert [(p.data[0], p.iface) for p in packets] == [(5, "port2"), (7, "port2")]
+
+    def test_compressed_sources_match_plain_file(self, tmp_path: Path):
+        """Test that compressed input files are recognized and decompressed while parsing."""
+        data = (SAMPLES_DIR / "fe.txt").read_bytes()
+        expected = [(bytes(p.data), p.ts_us, p.iface, p.direction, p.line) for p in iter_packets(SAMPLES_DIR / "fe.txt")]
+
+        (tmp_path / "fe.txt.gz").write_bytes(gzip.compress(data))
+        (tmp_path / "fe.txt.bz2").write_bytes(bz2.compress(data))
+        (tmp_path / "fe.txt.xz").write_bytes(lzma.compress(data))
+        with zipfile.ZipFile(tmp_path / "fe.zip", "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("fe.txt", data)
+
+        for name in ("fe.txt.gz", "fe.txt.bz2", "fe.txt.xz", "fe.zip"):
+            path = tmp_path / name
+            packets = [(bytes(p.data), p.ts_us, p.iface, p.direction, p.line) for p in iter_packets(path)]
+            assert packets == expected, name
+
+            # the progress is reported on the compressed bytes
+            ds = open_datasource(str(path))
+            positions = []
+            try:
+                list(iter_packets(ds, progress=lambda read, total: positions.append((read, total))))
+                assert ds.getSize() == path.stat().st_size
+                assert ds.getPosition() <= ds.getSize()
+            finally:
+                ds.close()
+
+
+class TestPacketParser:
+    """Test the packet line parsing."""
+
+    def test_canonical_fast_path_matches_regex(self):
+        """Test that the regex-free decoder gives the same result as the regular expressions."""
+        lines = [
+            "0x0000\t ffff ffff ffff 94de 8061 a404 0806 0001\t.........a......",
+            "0x0030\t 3332 3000 b475\t320..u",
+            "0x0010\t 0800 0604 0001 94de 8061 a404 0a6c 116a\t..... ..a...l.j",
+        ]
+        for binary in (False, True):
+            source = DataSource_Bytes(b"") if binary else DataSource_File(str(SAMPLES_DIR / "test3short.txt"))
+            pp = PacketParser(datasource=source)
+            for line in lines:
+                if binary:
+                    line = line.encode("ascii")
+                fast = pp.parseCanonicalLine(line)
+                assert fast is not None
+                pp_regex = pp.packetLineParser.search(line)
+                assert fast[0] == int(pp_regex.group(2), 16)
+                assert fast[1] == bytes.fromhex(pp_regex.group(3).decode("ascii") if binary else pp_regex.group(3))
+            source.close()
+
+    def test_non_canonical_lines_fall_back(self):
+        """Test that FE/FAC layouts and other lines are left to the regular expressions."""
+        pp = PacketParser(datasource=DataSource_Bytes(b""))
+        assert pp.parseCanonicalLine(b"000000\t ff ff ff ff ff ff 00 0c 29 13 c0 cf 08 06 00 01\t........).......") is None
+        assert pp.parseCanonicalLine(b"0x0000:  ffff ffff ffff 0009 0f09 0001 0806 0001  ................") is None
+        assert pp.parseCanonicalLine(b"2016-05-04 10:00:00.123456 wan1 in arp who-has") is None
+        assert pp.parsePacketLine(b"000000\t ff ff ff ff ff ff 00 0c 29 13 c0 cf 08 06 00 01\t........).......") == (0, b"\xff" * 6 + bytes.fromhex("000c2913c0cf08060001"))
+
+    def test_canonical_offset_digits(self):
+        """Test that only four hex digits are a canonical offset, in all the fast paths."""
+        pp = PacketParser(datasource=DataSource_Bytes(b""))
+        assert pp.splitCanonicalLine(b"0x0010\t 0800 0604\t....") == (16, 17)
+        assert pp.isContinuationLine(b"0x0010\t 0800 0604\t....")
+        assert not pp.isContinuationLine(b"0x0000\t 0800 0604\t....")
+        for offset in (b"-010", b"+010", b"0_10", b" 010", b"001G"):
+            line = b"0x" + offset + b"\t 0800 0604\t...."
+            assert pp.splitCanonicalLine(line) is None, offset
+            assert pp.parseCanonicalLine(line) is None, offset
+            assert not pp.isContinuationLine(line), offset
+
+
+    def test_batch_engines_match_scalar(self):
+        """Test that the batch engines (numpy falls back to batch without NumPy) assemble the same packets."""
+        for name in ("test3.txt", "fe.txt", "fac2.txt", "damaged.txt", "testha.txt"):
+            scalar = list(iter_packets(SAMPLES_DIR / name))
+            for engine in ("batch", "numpy"):
+                assert list(iter_packets(SAMPLES_DIR / name, engine=engine)) == scalar, (name, engine)
+
+    def test_absolute_timestamps_with_timezone(self):
+        """Test that absolute timestamps are converted in the configured timezone."""
+        line = "2024-03-01 12:00:00.250000 port1 in 10.0.0.1.443 -> 10.0.0.2.51234"
+        utc = PacketParser(datasource=DataSource_Bytes(b""), timezone=parse_timezone("utc"))
+        assert utc.parseHeaderLine(line) == (1709294400, 250000, "port1", "in")
+        # served from the cache the second time
+        assert utc.parseHeaderLine(line.replace(".250000", ".750000")) == (1709294400, 750000, "port1", "in")
+        prague = PacketParser(datasource=DataSource_Bytes(b""), timezone=parse_timezone("+01:00"))
+        assert prague.parseHeaderLine(line)[0] == 1709294400 - 3600
+
+
+class TestPcapNGWriter:
+    """Test the pcapng writer."""
+
+    def test_write_packet_emits_interfaces_lazily(self, tmp_path: Path):
+        """Test that IDBs are written right before the first packet of each interface."""
+        outfile = tmp_path / "out.pcapng"
+        pcap = PcapNGWriter(outfile=str(outfile))
+        pcap.writePacket(b"\x00" * 60, timestamp=1, iface="port1", comment="(in)  port1")
+        pcap.writePacket(b"\x00" * 61, timestamp=2, iface="port2", comment="(out) port2")
+        pcap.writePacket(b"\x00" * 62, timestamp=3, iface="port1", comment="(out) port1")
+        pcap.close()
+
+        types = [block_type for block_type, _ in read_blocks(outfile.read_bytes())]
+        assert types == [0x0A0D0D0A, 1, 6, 1, 6, 6]
+
+    def test_write_packet_matches_enhanced_packet_blocks(self):
+        """Test that packets encoded in the reused buffer equal standalone EPBs, including the padding."""
+        output = io.BytesIO()
+        pcap = PcapNGWriter(outfile=output)
+        packets = [b"\xff" * 3000, b"\xff" * 61, b"\x01" * 5, b"", b"\xff" * 64]
+        for (index, packet) in enumerate(packets):
+            pcap.writePacket(packet, timestamp=index, iface="port1", comment="(in)  port1")
+        pcap.close()
+
+        blocks = read_blocks(output.getvalue())
+        expected = [pcap.blockEnhancedPacket(packet, timestamp=index, ifaceIndex=0, comment="(in)  port1")
+                    for (index, packet) in enumerate(packets)]
+        assert [body for (block_type, body) in blocks if block_type == 6] == [bytes(block[8:-4]) for block in expected]
+
+        block = expected[2]
+        assert struct.unpack_from(">IIIQII", block) == (6, len(block), 0, 2, 5, 5)
+        assert block[28:36] == b"\x01" * 5 + b"\x00" * 3
+        assert block[36:40] == struct.pack(">HH", 1, 11)
+
+    def test_write_packets_is_written_in_bounded_chunks(self):
+        """Test that a whole section is streamed through the output buffer, not joined in memory."""
+        class RecordingIO(io.BytesIO):
+            def __init__(self):
+                super().__init__()
+                self.sizes = []
+
+            def write(self, data):
+                self.sizes.append(len(data))
+                return super().write(data)
+
+        output = RecordingIO()
+        pcap = PcapNGWriter(outfile=output, buffer_size=4096)
+        blockIfaces = pcap.blockInterfaceDescription("port1", PcapNGWriter.LINKTYPE_ETHERNET)
+        blockPackets = [pcap.blockEnhancedPacket(b"\x00" * 100, timestamp=i, ifaceIndex=0) for i in range(1000)]
+        pcap.writePackets(blockIfaces, blockPackets)
+        pcap.close()
+
+        assert max(output.sizes) <= 4096
+        types = [block_type for block_type, _ in read_blocks(output.getvalue())]
+        assert types == [0x0A0D0D0A, 1] + [6] * 1000
+
+    def test_write_packet_splits_files(self, tmp_path: Path):
+        """Test that every split file gets its own section and interface blocks."""
+        outfile = tmp_path / "out.pcapng"
+        pcap = PcapNGWriter(outfile=str(outfile), max_in_file=2)
+        for i in range(3):
+            pcap.writePacket(b"\x00" * 60, timestamp=i, iface="port1")
+        pcap.close()
+
+        assert not outfile.exists()
+        first = read_blocks((tmp_path / "out.part001.pcapng").read_bytes())
+        second = read_blocks((tmp_path / "out.part002.pcapng").read_bytes())
+        assert [block_type for block_type, _ in first] == [0x0A0D0D0A, 1, 6, 6]
+        assert [block_type for block_type, _ in second] == [0x0A0D0D0A, 1, 6]
+
+    def test_in_memory_conversion(self, tmp_path: Path):
+        """Test converting from bytes to a file object gives the same output as file to file."""
+        data = (SAMPLES_DIR / "test3.txt").read_bytes()
+        output = io.BytesIO()
+        pcap = PcapNGWriter(outfile=output)
+        for packet in iter_packets(DataSource_Bytes(data)):
+            pcap.writePacket(packet.data, timestamp=packet.ts_us, iface=packet.iface, comment=packet.comment())
+        pcap.close()
+
+        outfile = tmp_path / "out.pcapng"
+        pcap = PcapNGWriter(outfile=str(outfile))
+        for packet in iter_packets(SAMPLES_DIR / "test3.txt"):
+            pcap.writePacket(packet.data, timestamp=packet.ts_us, iface=packet.iface, comment=packet.comment())
+        pcap.close()
+
+        assert output.getvalue() == outfile.read_bytes()
+
+
+    def test_compressed_output(self, tmp_path: Path):
+        """Test that the output is compressed by the suffix of the file name and for file objects on request."""
+        outfile = tmp_path / "out.pcapng"
+        pcap = PcapNGWriter(outfile=str(outfile), max_in_file=100)
+        compressed = PcapNGWriter(outfile=str(tmp_path / "out.pcapng.gz"), max_in_file=100)
+        single = PcapNGWriter(outfile=str(tmp_path / "single.pcapng"))
+        output = io.BytesIO()
+        in_memory = PcapNGWriter(outfile=output, compression="gzip")
+        writers = (pcap, compressed, single, in_memory)
+        for packet in iter_packets(SAMPLES_DIR / "test3.txt"):
+            for writer in writers:
+                writer.writePacket(packet.data, timestamp=packet.ts_us, iface=packet.iface, comment=packet.comment())
+        for writer in writers:
+            writer.close()
+
+        for part in ("part001", "part002", "part003"):
+            expected = (tmp_path / f"out.{part}.pcapng").read_bytes()
+            assert gzip.decompress((tmp_path / f"out.{part}.pcapng.gz").read_bytes()) == expected
+        assert gzip.decompress(output.getvalue()) == (tmp_path / "single.pcapng").read_bytes()
+        assert not output.closed
+
+    def test_zstd_output(self, tmp_path: Path):
+        """Test zstd compressed output when the zstandard module is installed."""
+        zstandard = pytest.importorskip("zstandard")
+        pcap = PcapNGWriter(outfile=str(tmp_path / "out.pcapng.zst"))
+        pcap.writePacket(b"\x00" * 60, timestamp=1, iface="port1")
+        pcap.close()
+
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO((tmp_path / "out.pcapng.zst").read_bytes())).read()
+        assert [block_type for block_type, _ in read_blocks(data)] == [0x0A0D0D0A, 1, 6]
+
+
+class TestPcapWriter:
+    """Test the legacy libpcap writer."""
+
+    def test_one_file_per_link_type(self, tmp_path: Path):
+        """Test that packets are split by link type and carry nanosecond timestamps."""
+        outfile = tmp_path / "out.pcap"
+        pcap = PcapWriter(outfile=str(outfile))
+        blocks = PcapNGWriter(outfile=io.BytesIO())
+        pcap.writePacket(b"\x01" * 60, timestamp=1500000123456, iface="port1")
+        pcap.writeEnhancedPacket(blocks.blockEnhancedPacket(b"\x02" * 41, timestamp=1500000123457, ifaceIndex=0),
+                                 iface="ppp0", linktype=PcapNGWriter.LINKTYPE_NULL)
+        pcap.writePacket(b"\x03" * 61, timestamp=1500000123458, iface="port1")
+        pcap.close()
+
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["out.null.pcap", "out.pcap"]
+
+        data = outfile.read_bytes()
+        assert struct.unpack_from(">IHHiIII", data) == (0xA1B23C4D, 2, 4, 0, 0, PcapWriter.SNAPLEN, PcapNGWriter.LINKTYPE_ETHERNET)
+        assert struct.unpack_from(">IIII", data, 24) == (1500000, 123456000, 60, 60)
+        assert data[40:100] == b"\x01" * 60
+        assert len(data) == 24 + 16 + 60 + 16 + 61
+
+        data = (tmp_path / "out.null.pcap").read_bytes()
+        assert struct.unpack_from(">I", data, 20) == (PcapNGWriter.LINKTYPE_NULL,)
+        assert struct.unpack_from(">IIII", data, 24) == (1500000, 123457000, 41, 41)
+        assert data[40:] == b"\x02" * 41
+
+    def test_sink_keeps_first_link_type(self):
+        """Test that a file object output gets the first link type only and the other packets are counted."""
+        output = io.BytesIO()
+        pcap = PcapWriter(outfile=output)
+        pcap.writePacket(b"\x01" * 60, timestamp=1500000123456, iface="port1")
+        pcap.writePacket(b"\x02" * 41, timestamp=1500000123457, iface="ppp0", linktype=PcapNGWriter.LINKTYPE_NULL)
+        pcap.writePacket(b"\x03" * 61, timestamp=1500000123458, iface="port1")
+        pcap.writePacket(b"\x04" * 20, timestamp=1500000123459, iface="tun0", linktype=PcapNGWriter.LINKTYPE_RAW)
+        pcap.close()
+
+        data = output.getvalue()
+        assert struct.unpack_from(">I", data, 20) == (PcapNGWriter.LINKTYPE_ETHERNET,)
+        assert len(data) == 24 + 16 + 60 + 16 + 61
+        assert pcap.skippedPackets == {PcapNGWriter.LINKTYPE_NULL: 1, PcapNGWriter.LINKTYPE_RAW: 1}
+
+
+class TestParallel:
+    """Test the sharded multi-process parser."""
+
+    def test_parallel_matches_serial(self):
+        """Test that small shards give the same packets, in the same order, as the serial parser."""
+        formatter = PacketFormatter(include_packet_line=True)
+        for name in ("test3.txt", "fe.txt", "fac2.txt", "damaged.txt"):
+            path = SAMPLES_DIR / name
+            serial = list(formatter.iterFormatted(iter_packets(path)))
+            from_file = list(iter_formatted_parallel(path, 2, formatter, shard_size=1000))
+            from_bytes = list(iter_formatted_parallel(path.read_bytes(), 2, formatter, shard_size=1000))
+            assert from_file == serial, name
+            assert from_bytes == serial, name
+
+    def test_parallel_early_stop(self):
+        """Test that the consumer can stop before all shards are parsed."""
+        formatter = PacketFormatter()
+        formatted = iter_formatted_parallel(SAMPLES_DIR / "test3.txt", 2, formatter, shard_size=1000)
+        first = [next(formatted) for _ in range(5)]
+        formatted.close()
+        assert first == list(formatter.iterFormatted(iter_packets(SAMPLES_DIR / "test3.txt")))[:5]
+
+
+class TestPacketFilter:
+    """Test the packet filter expressions."""
+
+    @staticmethod
+    def frame(ethertype: int, payload: bytes, vlans: int = 0) -> bytes:
+        """Build an ethernet frame, optionally with VLAN tags."""
+        return b"\x00" * 12 + b"\x81\x00\x00\x05" * vlans + struct.pack(">H", ethertype) + payload
+
+    @staticmethod
+    def ipv4(proto: int, src: bytes, dst: bytes, sport: int, dport: int, fragment: int = 0) -> bytes:
+        """Build an IPv4 header followed by the ports."""
+        return struct.pack(">BBHHHBBH4s4sHH", 0x45, 0, 24, 0, fragment, 64, proto, 0, src, dst, sport, dport)
+
+    def test_expressions(self):
+        """Test the primitives and operators on tagged, untagged and IPv6 frames."""
+        packets = {
+            "tcp": self.frame(0x0800, self.ipv4(6, bytes([10, 0, 0, 1]), bytes([192, 168, 1, 5]), 1234, 443)),
+            "dns": self.frame(0x0800, self.ipv4(17, bytes([10, 0, 0, 2]), bytes([8, 8, 8, 8]), 5353, 53), vlans=2),
+            "fragment": self.frame(0x0800, self.ipv4(17, bytes([10, 0, 0, 2]), bytes([8, 8, 8, 8]), 5353, 53, fragment=100)),
+            "ssh6": self.frame(0x86DD, struct.pack(">IHBB16s16sHH", 6 << 28, 4, 6, 64, b"\x20\x01\x0d\xb8" + bytes(11) + b"\x01",
+                                                   b"\x20\x01\x0d\xb8" + bytes(11) + b"\x02", 2222, 22)),
+            "arp": self.frame(0x0806, struct.pack(">HHBBH6s4s6s4s", 1, 0x0800, 6, 4, 1, bytes(6), bytes([10, 0, 0, 1]), bytes(6), bytes([10, 0, 0, 254]))),
+        }
+        expected = {
+            "tcp": ["tcp", "ssh6"],
+            "udp port 53": ["dns"],
+            "udp": ["dns", "fragment"],
+            "host 10.0.0.1": ["tcp", "arp"],
+            "dst host 10.0.0.1": [],
+            "net 10.0.0.0/24 and not arp": ["tcp", "dns", "fragment"],
+            "net 2001:db8::/32": ["ssh6"],
+            "dst port 22 or src port 1234": ["tcp", "ssh6"],
+            "ip6 || (arp && src host 10.0.0.1)": ["ssh6", "arp"],
+            "proto 17 and !port 53": ["fragment"],
+            # "and" and "or" have the same priority and group from the left, as in tcpdump
+            "host 10.0.0.1 or host 10.0.0.2 and udp": ["dns", "fragment"],
+            "udp and host 10.0.0.2 or arp": ["dns", "fragment", "arp"],
+            "arp or tcp and port 443 or port 22": ["tcp", "ssh6"],
+            "host 10.0.0.1 or (host 10.0.0.2 and udp)": ["tcp", "dns", "fragment", "arp"],
+        }
+        for (expression, names) in expected.items():
+            packet_filter = PacketFilter(expression)
+            assert [name for (name, data) in packets.items() if packet_filter.matches(memoryview(data))] == names, expression
+
+    def test_invalid_expressions(self):
+        """Test that invalid expressions are rejected when they are compiled."""
+        for expression in ("", "host", "host 10.0.0", "port 65536", "tcp host 10.0.0.1", "(tcp", "tcp )", "tcp & udp", "foo"):
+            with pytest.raises(ValueError):
+                PacketFilter(expression)
+
+    def test_filter_applied_by_parallel_workers(self):
+        """Test that the filter is sent to the worker processes with the formatter."""
+        formatter = PacketFormatter(packet_filter=PacketFilter("not arp"))
+        serial = list(formatter.iterFormatted(iter_packets(SAMPLES_DIR / "test3.txt")))
+        assert 0 < len(serial) < len(list(iter_packets(SAMPLES_DIR / "test3.txt")))
+        assert list(iter_formatted_parallel(SAMPLES_DIR / "test3.txt", 2, formatter, shard_size=1000)) == serial
+
+
+class TestIntegrity:
+    """Test the packet size integrity checks."""
+
+    def test_expected_packet_size(self):
+        """Test the sizes announced by IPv4 and IPv6 headers behind VLAN tags."""
+        ipv4 = TestPacketFilter.ipv4(6, bytes(4), bytes(4), 1, 2)
+        ipv6 = struct.pack(">IHBB32s", 6 << 28, 8, 17, 64, bytes(32)) + bytes(8)
+        assert expected_packet_size(TestPacketFilter.frame(0x0800, ipv4)) == 14 + 24
+        assert expected_packet_size(TestPacketFilter.frame(0x0800, ipv4, vlans=2)) == 22 + 24
+        assert expected_packet_size(TestPacketFilter.frame(0x86DD, ipv6, vlans=1)) == 18 + 48
+        assert expected_packet_size(ipv4, raw=True) == 24
+        assert expected_packet_size(TestPacketFilter.frame(0x0806, bytes(28))) is None
+        # not even the length field is there
+        assert expected_packet_size(TestPacketFilter.frame(0x8100, b"\x00")) == 16
+
+    def test_find_truncated(self):
+        """Test that the batch validation reports the same packets as the per-packet check, padding is fine."""
+        ipv4 = TestPacketFilter.ipv4(17, bytes(4), bytes(4), 1, 2)
+        ipv6 = struct.pack(">IHBB32s", 6 << 28, 8, 17, 64, bytes(32)) + bytes(8)
+        frames = [TestPacketFilter.frame(0x0800, ipv4), TestPacketFilter.frame(0x0800, ipv4)[:-1],
+                  TestPacketFilter.frame(0x0800, ipv4, vlans=1)[:-2], memoryview(TestPacketFilter.frame(0x86DD, ipv6) + bytes(10)),
+                  TestPacketFilter.frame(0x86DD, ipv6)[:-4], TestPacketFilter.frame(0x0806, bytes(28)), TestPacketFilter.frame(0x0800, b"\x45")]
+        packets = frames + [ipv4, ipv4[:-1], ipv6[:-1]]
+        raw = [False] * len(frames) + [True] * 3
+        per_packet = [index for (index, data) in enumerate(packets)
+                      if (expected_packet_size(data, raw[index]) or 0) > len(data)]
+        assert per_packet == [1, 2, 4, 6, 8, 9]
+        assert find_truncated(packets, raw=raw) == per_packet
+        assert find_truncated(frames) == [1, 2, 4, 6]
+
+    def test_formatter_batch_matches_packets(self):
+        """Test that a batch formatted at once gives the same packets as formatting them one by one."""
+        packets = list(iter_packets(SAMPLES_DIR / "damaged.txt")) + list(iter_packets(SAMPLES_DIR / "test3.txt"))
+        truncated = TestPacketFilter.frame(0x0800, TestPacketFilter.ipv4(6, bytes(4), bytes(4), 1, 2))[:-3]
+        packets.insert(5, Packet(bytearray(truncated), 0, "port1", "in", 10))
+        for formatter in (PacketFormatter(), PacketFormatter(interfaces_nolink={"port1"}), PacketFormatter(check_packet_size=False)):
+            one_by_one = list(formatter.iterFormatted(packets))
+            assert formatter.formatBatch(packets) == one_by_one
+        assert PacketFormatter().formatBatch(packets)[5][2] is None
+
+    def test_formatter_drops_truncated_packets(self):
+        """Test that truncated packets are returned without any block, unless the checks are disabled."""
+        ipv6 = TestPacketFilter.frame(0x86DD, struct.pack(">IHBB32s", 6 << 28, 8, 17, 64, bytes(32)) + bytes(4), vlans=2)
+        packet = Packet(bytearray(ipv6), 0, "port1", "in", 10)
+        assert PacketFormatter().formatPacket(packet) == ("port1", 1, None)
+        assert PacketFormatter(check_packet_size=False).formatPacket(packet)[2] is not None
+
+
+class TestIPSec:
+    """Test the IPSec tunnel discovery."""
+
+    def test_tunnels_found_while_parsing(self, tmp_path: Path):
+        """Test that the tunnels found in the packet pass equal those found by re-reading the file."""
+        capture = tmp_path / "capture.txt"
+        capture.write_bytes(TUNNEL_LIST + (SAMPLES_DIR / "test3.txt").read_bytes())
+
+        reread = IPSec(sourcefile=str(capture))
+        reread.wireshark_config = str(tmp_path / "esp_sa")
+        reread.find_tunnels()
+
+        fused = IPSec()
+        packets = list(iter_packets(capture, line_observer=fused.feedLine))
+        assert len(packets) == 218
+        assert fused.tunnels == reread.tunnels
+
+        parallel = IPSec()
+        list(iter_formatted_parallel(capture, 2, PacketFormatter(), shard_size=2000, ipsec=parallel))
+        assert parallel.tunnels == reread.tunnels
+
+        tunnel = fused.tunnels["vpn-to-b"]
+        assert (tunnel["src"], tunnel["dst"]) == ("192.0.2.1", "198.51.100.7")
+        assert tunnel["enc"]["spi"] == "a1b2c3d4"
+        assert tunnel["dec"]["authkey"] == "0102030405060708090a0b0c0d0e0f1011121314"
+
+    def test_tunnel_split_between_shards(self, tmp_path: Path):
+        """Test that a tunnel whose lines are interleaved with packets is found also when they are in different shards."""
+        sample = (SAMPLES_DIR / "test3.txt").read_bytes()
+        headers = [match.start() for match in re.finditer(rb"^\d+\.\d+ \S+ (?:in|out) ", sample, re.MULTILINE)]
+        # every line of the tunnel list is followed by 10 packets, the shards are a few packets long
+        lines = TUNNEL_LIST.splitlines(keepends=True)
+        pieces = [sample[:headers[0]]]
+        for (i, line) in enumerate(lines):
+            pieces.append(line)
+            pieces.append(sample[headers[i * 10]:headers[i * 10 + 10]])
+        pieces.append(sample[headers[len(lines) * 10]:])
+        capture = tmp_path / "capture.txt"
+        capture.write_bytes(b"".join(pieces))
+
+        serial = IPSec()
+        packets = list(iter_packets(capture, line_observer=serial.feedLine))
+        assert serial.sa_count == 2
+
+        parallel = IPSec()
+        formatted = list(iter_formatted_parallel(capture, 2, PacketFormatter(), shard_size=1000, ipsec=parallel))
+        assert len(formatted) == len(packets)
+        assert parallel.tunnels == serial.tunnels
+        assert parallel.sa_count == 2
+
+    def test_limit_reads_no_further(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+        """Test that --limit stops reading the input, the tunnels after it are read only with --ipsec-full-scan."""
+        sample = (SAMPLES_DIR / "test3.txt").read_bytes()
+        capture = tmp_path / "capture.txt"
+        capture.write_bytes(sample + TUNNEL_LIST)
+
+        lines_read = []
+
+        def counting_datasource(filename):
+            ds = open_datasource(filename)
+            readline = ds.readline
+
+            def counting_readline():
+                line = readline()
+                lines_read.append(line)
+                return line
+            ds.readline = counting_readline
+            return ds
+
+        monkeypatch.setattr(cli, "open_datasource", counting_datasource)
+        for full_scan in (False, True):
+            lines_read.clear()
+            output = tmp_path / ("full.pcapng" if full_scan else "limited.pcapng")
+            home = tmp_path / ("full" if full_scan else "limited")
+            (home / ".wireshark").mkdir(parents=True)
+            monkeypatch.setenv("HOME", str(home))
+            argv = ["sniftran", "--in", str(capture), "--out", str(output), "--limit", "3"]
+            monkeypatch.setattr(sys, "argv", argv + (["--ipsec-full-scan"] if full_scan else []))
+            with patch.object(IPSec, "find_tunnels", autospec=True, side_effect=IPSec.find_tunnels) as find_tunnels:
+                sniftran = cli.SnifTranCLI()
+                sniftran.readOptions()
+                sniftran.process()
+
+            assert len(b"".join(lines_read)) < len(sample) // 10
+            blocks = read_blocks(output.read_bytes())
+            assert sum(1 for (block_type, _) in blocks if block_type == 6) == 3
+            assert find_tunnels.called == full_scan
+            esp_sa = home / ".wireshark" / "esp_sa"
+            assert len(esp_sa.read_text().splitlines()) == 2 if full_scan else not esp_sa.exists()
+
+    def test_esp_sa_deduplicated(self, tmp_path: Path):
+        """Test that the esp_sa rows are not repeated in the Wireshark configuration."""
+        ipsec = IPSec()
+        ipsec.wireshark_config = str(tmp_path / "esp_sa")
+        for line in TUNNEL_LIST.decode().splitlines():
+            ipsec.feedLine(line)
+        rows = ipsec.esp_sa_rows()
+        assert len(rows) == 2
+
+        ipsec.configure_wireshark()
+        ipsec.configure_wireshark()
+        assert (tmp_path / "esp_sa").read_text().splitlines() == rows